@@ -1,27 +1,198 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import uvicorn
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import os
-import subprocess
 import asyncio
 from pathlib import Path
 import re
-import tempfile
 import shutil
+import uuid
+import json
+import logging
+import time
+from typing import Optional
+
+import config
+import engine
+import metrics
+from batch import Batch, BatchItem, PlaylistError, expand_playlist, iter_zip
+from broker import create_broker
+from cache import ResultCache, make_cache_key
+from engine import EngineCrashError, EngineError, InProcessEngine
+from events import ProgressBroadcaster
+from fileserve import RangeFileResponse, content_disposition, offload_response
+from formats import FORMAT_SELECTOR, FormatError, FormatOptions
+from janitor import NoSpaceError, TempJanitor
+from journal import JobJournal
+from jobstore import FINISHED_STATUSES, create_job_store
+from metrics import StageTimer
+from probe import ProbeCache, ProbeError, clean_error, extract_info, summarize_info
+from progress_parser import FILEPATH_TEMPLATE, POSTPROCESS_TEMPLATE, PROGRESS_TEMPLATE, YtDlpOutputParser
+from ratelimit import BandwidthAllocator, ClientQuotas, QuotaExceededError, RateLimiter
+from segmented import (
+    SegmentDownloadError,
+    SegmentedDownloader,
+    UnsupportedManifest,
+    is_manifest_url,
+    merge_tracks,
+)
+from scheduler import DownloadScheduler, QueueFullError, get_host
+from supervisor import ProcessLimitExceeded, SupervisedProcess
+from transcode import (
+    CONTAINER_ALIASES,
+    CONTAINER_CODECS,
+    FASTSTART_ARGS,
+    ISO_EXTENSIONS,
+    PROFILES,
+    InvalidMediaError,
+    TranscodeError,
+    TranscodePool,
+    check_media,
+    needs_faststart,
+    plan_transcode,
+    probe_media,
+    read_iso_boxes,
+    summarize_media,
+)
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# Статика ищется рядом с модулем, а не в текущей папке (cli.py запускается откуда угодно)
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+
 # Монтируем статические файлы
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 # Модель для запроса
 class DownloadRequest(BaseModel):
     url: str
+    priority: int = 0  # Больше — раньше в очереди
+    stream: bool = False  # Отдавать файл клиенту ещё во время загрузки
+    max_height: Optional[int] = None    # Не выше этой высоты кадра (720, 480...)
+    audio_only: bool = False  # Только звук
+    container: Optional[str] = None     # mp4, mkv, webm, m4a, mp3
+    profile: Optional[str] = None       # Профиль обработки (см. /api/profiles)
+
+    def format_options(self):
+        return FormatOptions(self.max_height, self.audio_only, self.container, self.profile)
+
+class ProbeRequest(BaseModel):
+    url: str
+
+class BatchRequest(BaseModel):
+    urls: list[str] = []        # Список ссылок
+    playlist_url: Optional[str] = None    # Или ссылка на плейлист (разворачивается в список)
+    priority: int = 0
+    parallel: Optional[int] = None        # Сколько видео пакета качать одновременно
+    max_height: Optional[int] = None      # Параметры формата — как у /api/download
+    audio_only: bool = False
+    container: Optional[str] = None
+    profile: Optional[str] = None
+
+    def format_options(self):
+        return FormatOptions(self.max_height, self.audio_only, self.container, self.profile)
+
+# Состояние задач (в памяти или в общей базе для нескольких воркеров)
+job_store = create_job_store(
+    config.JOB_STORE, config.JOB_STORE_PATH, config.JOB_TTL, config.JOB_MAX_RECORDS, url=config.BROKER_URL,
+)
+
+# Раздельный режим: общая очередь между API-узлами и воркерами
+broker = None
+if config.ROLE in ("api", "worker"):
+    broker = create_broker(
+        config.BROKER, config.BROKER_PATH, config.BROKER_URL, config.LEASE_SECONDS, config.BROKER_MAX_ATTEMPTS,
+    )
+leased_jobs = set()     # Задачи брокера, которые выполняет этот воркер
+lost_jobs = set()       # Задачи, аренду которых брокер уже отдал другому воркеру
+
+# Оповещения об изменениях прогресса для /api/progress/{id}/stream
+progress_events = ProgressBroadcaster()
+
+# Журнал незавершённых задач: переживает перезапуск сервера.
+# В раздельном режиме задачи и так хранит брокер.
+job_journal = None
+if config.JOURNAL_ENABLED and config.ROLE == "all":
+    config.JOURNAL_PATH.parent.mkdir(parents=True, exist_ok=True)
+    job_journal = JobJournal(config.JOURNAL_PATH, owner=config.WORKER_ID, lease_seconds=config.LEASE_SECONDS)
+
+def set_progress(download_id, **fields):
+    """Обновляет состояние загрузки и оповещает подписчиков потока прогресса"""
+    job_store.update(download_id, **fields)
+    progress_events.publish(download_id)
+    if fields.get("status") == "error":
+        metrics.ERRORS.labels(fields.get("error_type") or "other").inc()
+    
+    # Сохраняем продвижение, чтобы после перезапуска продолжить с того же места
+    if job_journal is not None and "downloaded_bytes" in fields:
+        checkpoint = {"bytes_done": fields["downloaded_bytes"] or 0}
+        if fields.get("fragment_index") is not None:
+            checkpoint["fragment_index"] = fields["fragment_index"]
+        if "resume_state" in fields:
+            checkpoint["resume_state"] = fields["resume_state"]
+        job_journal.checkpoint(download_id, **checkpoint)
+
+# Объединение одинаковых запросов: несколько download_id подписаны на одну задачу.
+# Подписки хранит job_store (общий для воркеров uvicorn с VD_JOB_STORE=sqlite/redis),
+# поэтому /api/progress и /api/cleanup подписчика работают в любом процессе.
+inflight_jobs = {}      # ключ кэша -> id задачи, которая сейчас качает
+
+def resolve_job_id(download_id):
+    """Возвращает id задачи, к которой подписан download_id"""
+    return job_store.resolve(download_id)
+
+# Замер времени этапов выполняющихся задач
+job_timers = {}         # id задачи -> StageTimer
+
+def start_job_timer(download_id):
+    """Начинает отсчёт времени задачи с ожидания в очереди"""
+    job_timers[download_id] = StageTimer()
+    enter_stage(download_id, "queue")
 
-# Глобальная переменная для отслеживания прогресса
-download_progress = {}
+def enter_stage(download_id, stage):
+    """Отмечает начало этапа: время этапов уходит в прогресс и в метрики"""
+    timer = job_timers.get(download_id)
+    if timer is None or timer.stage == stage:
+        return
+    timer.enter(stage)
+    set_progress(download_id, stage=stage, timings=timer.snapshot())
+
+# Файлы, которые сейчас пишутся: id задачи -> путь (для /api/stream)
+active_outputs = {}
+
+# Запущенные процессы yt-dlp: id задачи -> SupervisedProcess
+active_processes = {}
+
+# Кэш готовых файлов: повторные запросы того же видео не скачиваются заново
+result_cache = ResultCache(config.CACHE_DIR, config.CACHE_MAX_BYTES) if config.CACHE_ENABLED else None
+
+# Общая полоса загрузок делится поровну между выполняющимися задачами
+bandwidth = BandwidthAllocator(config.RATE_LIMIT_TOTAL, config.RATE_LIMIT_PER_JOB, config.MAX_CONCURRENT_DOWNLOADS)
+
+# Квоты клиентов по IP: одновременные задачи и объём за час
+client_quotas = ClientQuotas(config.CLIENT_MAX_ACTIVE_JOBS, config.CLIENT_MAX_BYTES_PER_HOUR)
+
+# Смена контейнера и перекодирование — в своём пуле ffmpeg, а не в слотах загрузок
+transcode_pool = TranscodePool(config.TRANSCODE_WORKERS, config.TRANSCODE_THREADS, config.TRANSCODE_NICE)
+
+# Результаты извлечения (/api/probe): загрузка того же URL не разбирает страницу повторно
+probe_cache = ProbeCache(config.PROBE_CACHE_TTL, config.PROBE_CACHE_MAX_ENTRIES)
+probe_slots = asyncio.Semaphore(config.PROBE_CONCURRENCY)
+
+# Планировщик ограничивает число одновременных процессов yt-dlp/ffmpeg
+scheduler = DownloadScheduler(
+    max_workers=config.MAX_CONCURRENT_DOWNLOADS,
+    max_per_host=config.MAX_DOWNLOADS_PER_HOST,
+    max_queue=config.MAX_QUEUE_SIZE,
+    retry_after=config.QUEUE_RETRY_AFTER,
+)
 
 def get_downloads_folder():
     """Получает путь к папке Downloads"""
@@ -39,6 +210,40 @@ def sanitize_filename(filename):
         filename = filename[:200]
     return filename
 
+# Встроенный движок yt-dlp (VD_ENGINE=inprocess), создаётся при старте
+ytdlp_engine = None
+
+# Цикл получения задач из брокера (VD_ROLE=worker)
+broker_worker_task = None
+
+# Общий пул HTTP-соединений (keep-alive) для встроенной загрузки фрагментов
+http_client = None
+
+def get_http_client():
+    """Возвращает общий HTTP-клиент, создавая его при первом обращении"""
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=config.HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=config.HTTP_POOL_SIZE,
+                max_keepalive_connections=config.HTTP_POOL_SIZE,
+            ),
+            headers={"User-Agent": "Mozilla/5.0 (compatible; VideoDownloader)"},
+        )
+    return http_client
+
+# Результат проверки yt-dlp кэшируется, чтобы не запускать процесс на каждую задачу
+ytdlp_available = False
+
+async def ensure_ytdlp_available():
+    """Проверяет yt-dlp один раз; отрицательный результат перепроверяется"""
+    global ytdlp_available
+    if not ytdlp_available:
+        ytdlp_available = ytdlp_engine is not None or await check_ytdlp_available()
+    return ytdlp_available
+
 async def check_ytdlp_available():
     """Проверяет доступность yt-dlp"""
     try:
@@ -52,41 +257,290 @@ async def check_ytdlp_available():
     except (FileNotFoundError, asyncio.TimeoutError):
         return False
 
-async def download_video(url: str, download_id: str):
+def job_work_dir(download_id: str):
+    """Рабочая папка задачи: все её файлы лежат только здесь"""
+    return config.TEMP_DIR / download_id
+
+async def finalize_download(download_id: str, filename: str, last_progress: float, cache_key: str = None,
+                            options: FormatOptions = None):
+    """Проверяет скачанный файл, приводит его к нужному формату и отмечает загрузку завершённой.
+
+    options — запрошенный формат; None — оставить файл как есть (при отдаче во время загрузки).
+    """
+    enter_stage(download_id, "finalize")
+    # Проверяем размер файла - видео должно быть больше 1 МБ
+    file_size = os.path.getsize(filename)
+    min_file_size = 1024 * 1024  # 1 МБ минимум
+    if options is not None and options.wants_audio_only:
+        min_file_size = 100 * 1024  # Звук короткого ролика весит немного
+    
+    # Проверяем, не является ли файл HTML/MHTML/текстовым
+    file_path = Path(filename)
+    file_ext = file_path.suffix.lower()
+    invalid_extensions = ['.html', '.htm', '.mhtml', '.txt', '.json', '.xml', '.webarchive']
+    
+    # Также проверяем первые байты файла на HTML сигнатуру
+    is_html_file = False
+    try:
+        with open(filename, 'rb') as f:
+            first_bytes = f.read(1024)
+            # Проверяем на HTML/MHTML сигнатуры
+            if b'<!DOCTYPE' in first_bytes or b'<html' in first_bytes or b'Content-Type: multipart/related' in first_bytes:
+                is_html_file = True
+    except:
+        pass
+    
+    if file_ext in invalid_extensions or is_html_file:
+        # Это не видео файл
+        set_progress(
+            download_id,
+            status="error",
+            error_type="invalid_file",
+            progress=last_progress,
+            message=f"Скачан файл неправильного типа ({file_ext}). Возможно, это HTML страница вместо видео.",
+            filename=None,
+            filepath=None,
+        )
+        # Удаляем неправильный файл
+        try:
+            os.remove(filename)
+        except:
+            pass
+    elif file_size < min_file_size:
+        # Файл слишком маленький - это не видео
+        size_mb = file_size / (1024 * 1024)
+        set_progress(
+            download_id,
+            status="error",
+            error_type="invalid_file",
+            progress=last_progress,
+            message=f"Скачанный файл слишком маленький ({size_mb:.2f} МБ). Это не видео файл. Возможно, скачались метаданные вместо видео.",
+            filename=None,
+            filepath=None,
+        )
+        # Удаляем неправильный файл
+        try:
+            os.remove(filename)
+        except:
+            pass
+    else:
+        # Файл похож на видео: проверяем контейнер и приводим к запрошенному контейнеру/профилю
+        try:
+            media, faststart = await validate_output(download_id, filename, options)
+            if options is not None:
+                converted = await convert_output(download_id, filename, options, media)
+                if converted == filename and faststart:
+                    await faststart_output(download_id, filename, media)
+                filename = converted
+        except TranscodeError as e:
+            invalid = isinstance(e, InvalidMediaError)
+            set_progress(
+                download_id,
+                status="error",
+                error_type="invalid_file" if invalid else "transcode",
+                progress=last_progress,
+                message=f"Скачанный файл повреждён: {e}" if invalid else f"Ошибка обработки файла: {e}",
+                filename=None,
+                filepath=None,
+            )
+            if invalid:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            return
+        file_size = os.path.getsize(filename)
+        
+        # Сохраняем полный путь к файлу для последующей отдачи клиенту
+        clean_filename = os.path.basename(filename)
+        
+        # Переносим файл в кэш, чтобы повторные запросы отдавались сразу
+        if result_cache is not None and cache_key:
+            try:
+                entry = result_cache.put(cache_key, filename, clean_filename, download_id)
+                filename = entry.path
+                # В рабочей папке остались только промежуточные файлы
+                shutil.rmtree(job_work_dir(download_id), ignore_errors=True)
+            except OSError:
+                pass
+        
+        set_progress(
+            download_id,
+            status="completed",
+            progress=100,
+            message=f"Загрузка завершена! Размер: {file_size / (1024 * 1024):.2f} МБ",
+            filename=clean_filename,
+            filepath=filename,  # Полный путь для скачивания
+            cache_hit=False,
+        )
+
+async def validate_output(download_id: str, filename: str, options: FormatOptions = None):
+    """Проверяет контейнер скачанного файла: структуру mp4 и дорожки через ffprobe.
+
+    Бросает InvalidMediaError для обрезанного или повреждённого файла. Возвращает
+    (результат ffprobe или None, нужно ли переносить индекс mp4 в начало).
+    Профиль с optimize=False и VD_MEDIA_VALIDATE=0 пропускают этап.
+    """
+    profile = options.transcode_profile if options is not None else None
+    if not config.MEDIA_VALIDATE or (profile is not None and not profile.optimize):
+        return None, False
+    enter_stage(download_id, "validate")
+    set_progress(download_id, message="Проверка файла...")
+    
+    # Атомы mp4 читаются без ffprobe: так видно обрезанный файл и индекс в конце
+    faststart = False
+    summary = {}
+    if Path(filename).suffix.lower().lstrip(".") in ISO_EXTENSIONS:
+        boxes = read_iso_boxes(filename)
+        if boxes is not None:
+            faststart = needs_faststart(boxes)
+            summary["faststart"] = not faststart
+    
+    media = None
+    if shutil.which("ffprobe") is not None:
+        media = await probe_media(filename)
+        check_media(media, options is not None and options.requires_video)
+        summary.update(summarize_media(media))
+    if summary:
+        set_progress(download_id, media=summary)
+    return media, faststart and config.FASTSTART
+
+async def faststart_output(download_id: str, filename: str, media: dict = None):
+    """Переносит индекс mp4 в начало файла без перекодирования (+faststart).
+
+    Без ffmpeg или при его ошибке файл остаётся как есть: он исправен, просто
+    воспроизведение начнётся только после полной загрузки.
+    """
+    if shutil.which("ffmpeg") is None:
+        return
+    enter_stage(download_id, "faststart")
+    scheduler.release(download_id)
+    bandwidth.remove(download_id)
+    set_progress(download_id, message="Перенос индекса в начало файла...")
+    source = Path(filename)
+    target = source.with_name(f"{source.stem}.faststart{source.suffix}")
+    try:
+        await transcode_pool.run(source, target, FASTSTART_ARGS, "copy", media["duration"] if media else None)
+    except TranscodeError as e:
+        metrics.TRANSCODES.labels("failed").inc()
+        logger.warning("faststart %s не удался, файл отдаётся как есть: %s", download_id, e)
+        return
+    os.replace(target, source)
+    metrics.TRANSCODES.labels("faststart").inc()
+    record = job_store.get(download_id)
+    set_progress(download_id, media=dict(record.media or {}, faststart=True))
+
+async def convert_output(download_id: str, filename: str, options: FormatOptions, media: dict = None):
+    """Приводит файл к контейнеру и профилю из options в пуле ffmpeg.
+
+    Дорожки по возможности копируются без перекодирования. media — результат
+    ffprobe, если файл уже проверен. Возвращает путь к итоговому файлу.
+    """
+    container = options.target_container
+    profile = options.transcode_profile
+    source = Path(filename)
+    ext = source.suffix.lower().lstrip(".")
+    if CONTAINER_ALIASES.get(ext, ext) == container and (profile is None or profile.remux_only):
+        return filename
+    if shutil.which("ffmpeg") is None:
+        if profile is not None or options.container is not None:
+            raise TranscodeError("ffmpeg не найден, обработка файла недоступна")
+        # Без ffmpeg оставляем файл как есть — с настоящим расширением
+        return filename
+    
+    enter_stage(download_id, "transcode")
+    # Загрузка закончена: её слот нужен следующей задаче, а ffmpeg ждёт места в своём пуле
+    scheduler.release(download_id)
+    bandwidth.remove(download_id)
+    set_progress(download_id, message="Ожидание обработки...")
+    
+    if media is None:
+        media = await probe_media(source)
+    args, mode = plan_transcode(media, container, profile)
+    suffix = f".{profile.name}" if profile is not None and ext == container else ""
+    target = source.with_name(f"{source.stem}{suffix}.{container}")
+    action = "Смена контейнера" if mode == "copy" else "Перекодирование"
+    set_progress(download_id, message=f"{action}...")
+    
+    def on_progress(percent):
+        set_progress(download_id, message=f"{action}: {percent:.0f}%")
+    
+    try:
+        await transcode_pool.run(source, target, args, mode, media["duration"], on_progress)
+    except TranscodeError:
+        metrics.TRANSCODES.labels("failed").inc()
+        raise
+    metrics.TRANSCODES.labels(mode).inc()
+    try:
+        os.remove(source)
+    except OSError:
+        pass
+    return str(target)
+
+async def download_video(url: str, download_id: str, cache_key: str = None, stream: bool = False,
+                         options: FormatOptions = None):
     """Скачивает видео используя yt-dlp во временную папку"""
     try:
         # Проверяем доступность yt-dlp
-        download_progress[download_id] = {
-            "status": "downloading",
-            "progress": 0,
-            "message": "Проверка yt-dlp...",
-            "filename": None,
-            "filepath": None
-        }
+        set_progress(
+            download_id,
+            status="downloading",
+            progress=0,
+            message="Проверка yt-dlp...",
+            filename=None,
+            filepath=None,
+            queue_position=None,
+        )
+        
+        options = options or FormatOptions()
+        
+        # Манифесты HLS/DASH качаем сами, параллельно по фрагментам (звук отдельно — через yt-dlp)
+        if config.SEGMENTED_ENABLED and is_manifest_url(url) and not options.wants_audio_only:
+            try:
+                await download_video_segmented(url, download_id, cache_key, stream, options)
+                return
+            except UnsupportedManifest as e:
+                set_progress(download_id, message=f"{e}: используется yt-dlp")
         
-        if not await check_ytdlp_available():
-            download_progress[download_id] = {
-                "status": "error",
-                "progress": 0,
-                "message": "yt-dlp не найден или недоступен. Установите: pip install yt-dlp",
-                "filename": None,
-                "filepath": None
-            }
+        enter_stage(download_id, "ytdlp_check")
+        if not await ensure_ytdlp_available():
+            set_progress(
+                download_id,
+                status="error",
+                error_type="ytdlp_missing",
+                progress=0,
+                message="yt-dlp не найден или недоступен. Установите: pip install yt-dlp",
+                filename=None,
+                filepath=None,
+            )
             return
         
-        # Используем временную папку для хранения файлов на сервере
-        temp_dir = Path(tempfile.gettempdir()) / "video_downloader"
-        temp_dir.mkdir(exist_ok=True)
+        if ytdlp_engine is not None:
+            enter_stage(download_id, "extract")
+            await download_video_inprocess(url, download_id, cache_key, stream, options)
+            return
+        
+        # У каждой задачи своя рабочая папка во временной папке сервера
+        work_dir = job_work_dir(download_id)
+        work_dir.mkdir(parents=True, exist_ok=True)
         
         # Используем yt-dlp для скачивания
         # Он поддерживает m3u8, HLS и многие другие форматы
-        output_template = str(temp_dir / f"{download_id}_%(title)s.%(ext)s")
+        output_template = str(work_dir / "%(title)s.%(ext)s")
+        
+        # Видео уже разобрано через /api/probe — передаём готовый info вместо ссылки
+        source = [url]
+        info = get_probed_info(url)
+        if info is not None:
+            info_path = work_dir / "probe.info.json"
+            info_path.write_text(json.dumps(info, ensure_ascii=False), encoding="utf-8")
+            source = ["--load-info-json", str(info_path)]
         
         cmd = [
             "yt-dlp",
-            url,
-            "-f", "best[ext=mp4]/bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",  # Предпочитаем mp4
-            "--merge-output-format", "mp4",     # Объединяем в mp4
+            *source,
+            "-f", options.selector(stream),     # Предпочитаем mp4 (или запрошенное качество/контейнер)
+            "--merge-output-format", options.merge_format(),  # Объединяем в mp4
             "--no-playlist",                    # Не скачивать плейлисты
             "--no-write-info-json",             # Не сохранять JSON метаданные
             "--no-write-thumbnail",             # Не сохранять миниатюру
@@ -94,498 +548,1531 @@ async def download_video(url: str, download_id: str):
             "--no-write-annotations",           # Не сохранять аннотации
             "--no-download-archive",            # Не использовать архив загрузок
             "--extractor-args", "youtube:player_client=android",  # Используем Android клиент для лучшей совместимости
-            "--no-part",                        # Не сохранять частичные файлы
+            "--continue",                       # Продолжать с .part после перезапуска
             "--no-mtime",                       # Не изменять время модификации
             "-o", output_template,
             "--progress",  # Показываем прогресс
             "--newline",   # Новая строка для каждого обновления
             "--no-warnings",  # Убираем предупреждения
+            "--progress-template", PROGRESS_TEMPLATE,     # Прогресс в виде JSON
+            "--progress-template", POSTPROCESS_TEMPLATE,  # Этапы постобработки в виде JSON
+            "--print", FILEPATH_TEMPLATE,  # Итоговый путь к файлу
+            "--no-quiet",                  # --print включает тихий режим, а прогресс нам нужен
         ]
+        if stream:
+            cmd.append("--hls-use-mpegts")  # HLS пишется как MPEG-TS, его можно отдавать по мере записи
+        # Процессу yt-dlp ограничение передаётся один раз — доля на момент запуска
+        rate = bandwidth.add(download_id)
+        if rate:
+            cmd += ["--limit-rate", str(rate)]
         
-        download_progress[download_id]["message"] = "Запуск процесса..."
+        set_progress(download_id, message="Запуск процесса..." if info is None else "Запуск процесса (информация о видео из кэша)...")
+        enter_stage(download_id, "extract")
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,  # Объединяем stderr в stdout
+        process = SupervisedProcess(
+            cmd,
+            max_runtime=config.DOWNLOAD_MAX_RUNTIME,
+            stall_timeout=config.DOWNLOAD_STALL_TIMEOUT,
+            kill_grace=config.PROCESS_KILL_GRACE,
         )
+        await process.start()
+        active_processes[download_id] = process
         
-        filename = None
-        last_progress = 0
-        error_lines = []
-        all_output = []
-        lines_read = 0
-        no_output_timeout = 30  # Таймаут 30 секунд без вывода
+        parser = YtDlpOutputParser()
         
         # Обновляем сообщение о начале работы
-        download_progress[download_id]["message"] = "Инициализация загрузки..."
-        start_time = asyncio.get_event_loop().time()
-        last_output_time = start_time
+        set_progress(download_id, message="Инициализация загрузки...")
         
-        # Читаем вывод процесса с таймаутом
-        while True:
-            try:
-                # Читаем строку с таймаутом
-                line = await asyncio.wait_for(process.stdout.readline(), timeout=5.0)
-                if not line:
-                    # Проверяем, завершился ли процесс
-                    if process.returncode is not None:
-                        break
-                    # Если нет вывода долгое время, проверяем таймаут
-                    current_time = asyncio.get_event_loop().time()
-                    if current_time - last_output_time > no_output_timeout:
-                        download_progress[download_id] = {
-                            "status": "error",
-                            "progress": last_progress,
-                            "message": f"Таймаут: процесс не выводит данные более {no_output_timeout} секунд",
-                            "filename": None,
-                            "filepath": None
-                        }
-                        process.kill()
-                        return
-                    continue
-                
-                last_output_time = asyncio.get_event_loop().time()
-                
-                # Обрабатываем прочитанную строку
-                line_str = line.decode('utf-8', errors='ignore').strip()
-                if line_str:
-                    all_output.append(line_str)
-                    lines_read += 1
-                    
-                    # Если это первая строка, обновляем сообщение
-                    if lines_read == 1:
-                        download_progress[download_id]["message"] = f"Запуск: {line_str[:60]}"
-                    elif lines_read <= 3:
-                        # Показываем первые несколько строк для диагностики
-                        download_progress[download_id]["message"] = f"Инициализация: {line_str[:60]}"
-                    
-                        # Проверяем, не скачиваются ли только фрагменты (HLS/m3u8)
-                        if "frag" in line_str.lower() and ("of ~" in line_str or "ETA Unknown" in line_str):
-                            # Это фрагмент HLS потока - предупреждаем
-                            download_progress[download_id]["message"] = f"⚠️ Скачивание фрагментов HLS: {line_str[:70]}"
-                        
-                        # Ищем процент прогресса (формат: [download] 45.2% of 123.45MiB)
-                        progress_match = re.search(r'(\d+\.?\d*)%', line_str)
-                        if progress_match:
-                            progress = float(progress_match.group(1))
-                            last_progress = progress
-                            download_progress[download_id]["progress"] = progress
-                            
-                            # Извлекаем размер файла если есть
-                            size_match = re.search(r'of\s+([\d.]+[KMGT]?i?B)', line_str, re.IGNORECASE)
-                            if size_match:
-                                size_str = size_match.group(1)
-                                # Проверяем, не слишком ли маленький файл (меньше 1 МБ)
-                                try:
-                                    size_value = float(re.search(r'([\d.]+)', size_str).group(1))
-                                    if 'KiB' in size_str and size_value < 1000:
-                                        download_progress[download_id]["message"] = f"⚠️ Внимание: маленький файл ({size_str}). Возможно, это не полное видео."
-                                    else:
-                                        download_progress[download_id]["message"] = f"Загрузка: {progress:.1f}% ({size_str})"
-                                except:
-                                    download_progress[download_id]["message"] = f"Загрузка: {progress:.1f}% ({size_str})"
-                            else:
-                                download_progress[download_id]["message"] = f"Загрузка: {progress:.1f}%"
-                        
-                        # Ищем имя файла в различных форматах вывода yt-dlp
-                        if "Destination:" in line_str:
-                            filename_match = re.search(r'Destination:\s*(.+)', line_str)
-                            if filename_match:
-                                filename = filename_match.group(1).strip()
-                        elif "has already been downloaded" in line_str:
-                            # Извлекаем имя файла из сообщения
-                            filename_match = re.search(r'\[download\]\s*(.+\.(?:mp4|webm|mkv|m4a|m4v))', line_str)
-                            if filename_match:
-                                filename = filename_match.group(1).strip()
-                        elif "Merging formats into" in line_str:
-                            # Извлекаем имя файла при объединении
-                            filename_match = re.search(r'into\s+(.+)', line_str)
-                            if filename_match:
-                                filename = filename_match.group(1).strip()
-                        elif "Writing video metadata" in line_str or "Writing metadata" in line_str:
-                            # Извлекаем имя файла из метаданных
-                            filename_match = re.search(r'to\s+(.+)', line_str)
-                            if filename_match:
-                                filename = filename_match.group(1).strip()
-                        elif "Deleting original file" in line_str:
-                            # yt-dlp удаляет оригинальный файл после объединения
-                            # Ищем имя файла в предыдущих строках
-                            pass
-                        elif "Post-process file" in line_str or "has been downloaded" in line_str:
-                            # Извлекаем имя файла из сообщения о завершении
-                            filename_match = re.search(r'(\S+\.(?:mp4|webm|mkv|m4a|m4v))', line_str)
-                            if filename_match:
-                                potential_filename = filename_match.group(1).strip()
-                                if os.path.exists(potential_filename) or os.path.exists(os.path.join(temp_dir, potential_filename)):
-                                    filename = potential_filename if os.path.exists(potential_filename) else os.path.join(temp_dir, potential_filename)
-                    elif "[Merger]" in line_str:
-                        download_progress[download_id]["message"] = "Объединение видео и аудио..."
-                    elif "[ExtractAudio]" in line_str:
-                        download_progress[download_id]["message"] = "Обработка аудио..."
-                    elif "ERROR" in line_str.upper() or "error" in line_str.lower():
-                        error_lines.append(line_str)
-                        download_progress[download_id]["message"] = f"Ошибка: {line_str[:100]}"
-                    elif "WARNING" in line_str.upper():
-                        # Логируем предупреждения, но продолжаем
-                        pass
-                    elif not any(x in line_str for x in ["[download]", "[Merger]", "[ExtractAudio]", "WARNING"]):
-                        # Если это информационное сообщение, обновляем статус
-                        if "Extracting" in line_str or "Downloading" in line_str or "Merging" in line_str:
-                            download_progress[download_id]["message"] = line_str[:80]
-            except asyncio.TimeoutError:
-                # Проверяем, не завис ли процесс
-                current_time = asyncio.get_event_loop().time()
-                if current_time - last_output_time > no_output_timeout:
-                    download_progress[download_id] = {
-                        "status": "error",
-                        "progress": last_progress,
-                        "message": f"Таймаут: процесс не отвечает более {no_output_timeout} секунд",
-                        "filename": None,
-                        "filepath": None
-                    }
-                    process.kill()
-                    return
-                # Продолжаем ждать
-                continue
-        
-        # Ждем завершения процесса
-        returncode = await process.wait()
+        def on_line(line):
+            # Разбираем строку и публикуем изменения прогресса
+            update = parser.feed(line.decode('utf-8', errors='ignore'))
+            if parser.stage:
+                enter_stage(download_id, parser.stage)
+            if update:
+                set_progress(download_id, **update)
+            output_path = parser.tmpfilename or parser.filename
+            if output_path and active_outputs.get(download_id) != output_path:
+                active_outputs[download_id] = output_path
+                if job_journal is not None:
+                    job_journal.checkpoint(download_id, force=True, output_path=output_path)
         
-        # Даем время файлу записаться на диск
-        await asyncio.sleep(2)
+        # Строки приходят по мере вывода; при отмене задачи процесс останавливается вместе с ffmpeg
+        try:
+            returncode = await process.run(on_line)
+        except ProcessLimitExceeded as e:
+            set_progress(
+                download_id,
+                status="error",
+                error_type="timeout",
+                progress=parser.progress,
+                message=f"Таймаут: {e}",
+                filename=None,
+                filepath=None,
+            )
+            return
         
         # Если процесс завершился без вывода, это может быть ошибка
-        if lines_read == 0 and returncode != 0:
-            download_progress[download_id] = {
-                "status": "error",
-                "progress": 0,
-                "message": "Процесс завершился без вывода. Возможно, yt-dlp не установлен или недоступен.",
-                "filename": None,
-                "filepath": None
-            }
+        if parser.lines_read == 0 and returncode != 0:
+            set_progress(
+                download_id,
+                status="error",
+                error_type="ytdlp_missing",
+                progress=0,
+                message="Процесс завершился без вывода. Возможно, yt-dlp не установлен или недоступен.",
+                filename=None,
+                filepath=None,
+            )
             return
         
+        # Путь к файлу yt-dlp сообщает сам (--print after_move:filepath)
+        filename = parser.final_path
+        last_progress = parser.progress
+        
         if returncode == 0:
-            # Если имя файла не найдено, ищем последний созданный файл
-            if not filename:
-                # Ищем все файлы с нашим download_id (любые расширения)
-                all_files = list(temp_dir.glob(f"{download_id}_*"))
-                # Фильтруем только файлы (не директории) и исключаем маленькие/неправильные файлы
-                video_files = []
-                invalid_extensions = ['.html', '.htm', '.mhtml', '.txt', '.json', '.xml', '.webarchive']
-                min_size = 1024 * 1024  # 1 МБ минимум
-                
-                for f in all_files:
-                    if f.is_file():
-                        # Пропускаем маленькие файлы и файлы неправильного типа
-                        if f.suffix.lower() in invalid_extensions:
-                            # Удаляем неправильные файлы
-                            try:
-                                os.remove(f)
-                            except:
-                                pass
-                            continue
-                        if os.path.getsize(f) < min_size:
-                            # Удаляем маленькие файлы (вероятно, метаданные)
-                            try:
-                                os.remove(f)
-                            except:
-                                pass
-                            continue
-                        # Проверяем, не является ли файл HTML по содержимому
-                        try:
-                            with open(f, 'rb') as file_check:
-                                first_bytes = file_check.read(1024)
-                                if b'<!DOCTYPE' in first_bytes or b'<html' in first_bytes or b'Content-Type: multipart/related' in first_bytes:
-                                    os.remove(f)
-                                    continue
-                        except:
-                            pass
-                        video_files.append(f)
-                
-                if video_files:
-                    # Берем самый новый файл
-                    filename = str(max(video_files, key=os.path.getctime))
-                else:
-                    # Если не нашли по download_id, ищем все недавно созданные файлы в папке
-                    all_recent_files = [f for f in temp_dir.iterdir() if f.is_file()]
-                    if all_recent_files:
-                        # Фильтруем только валидные видео файлы
-                        recent_files = []
-                        for f in all_recent_files:
-                            if os.path.getctime(f) >= start_time:
-                                if f.suffix.lower() in invalid_extensions:
-                                    try:
-                                        os.remove(f)
-                                    except:
-                                        pass
-                                    continue
-                                if os.path.getsize(f) < min_size:
-                                    try:
-                                        os.remove(f)
-                                    except:
-                                        pass
-                                    continue
-                                # Проверяем содержимое на HTML
-                                try:
-                                    with open(f, 'rb') as file_check:
-                                        first_bytes = file_check.read(1024)
-                                        if b'<!DOCTYPE' in first_bytes or b'<html' in first_bytes or b'Content-Type: multipart/related' in first_bytes:
-                                            os.remove(f)
-                                            continue
-                                except:
-                                    pass
-                                recent_files.append(f)
-                        if recent_files:
-                            filename = str(max(recent_files, key=os.path.getctime))
-            
             if filename and os.path.exists(filename):
-                # Проверяем размер файла - видео должно быть больше 1 МБ
-                file_size = os.path.getsize(filename)
-                min_file_size = 1024 * 1024  # 1 МБ минимум
-                
-                # Проверяем, не является ли файл HTML/MHTML/текстовым
-                file_path = Path(filename)
-                file_ext = file_path.suffix.lower()
-                invalid_extensions = ['.html', '.htm', '.mhtml', '.txt', '.json', '.xml', '.webarchive']
-                
-                # Также проверяем первые байты файла на HTML сигнатуру
-                is_html_file = False
-                try:
-                    with open(filename, 'rb') as f:
-                        first_bytes = f.read(1024)
-                        # Проверяем на HTML/MHTML сигнатуры
-                        if b'<!DOCTYPE' in first_bytes or b'<html' in first_bytes or b'Content-Type: multipart/related' in first_bytes:
-                            is_html_file = True
-                except:
-                    pass
-                
-                if file_ext in invalid_extensions or is_html_file:
-                    # Это не видео файл
-                    download_progress[download_id] = {
-                        "status": "error",
-                        "progress": last_progress,
-                        "message": f"Скачан файл неправильного типа ({file_ext}). Возможно, это HTML страница вместо видео.",
-                        "filename": None,
-                        "filepath": None
-                    }
-                    # Удаляем неправильный файл
-                    try:
-                        os.remove(filename)
-                    except:
-                        pass
-                elif file_size < min_file_size:
-                    # Файл слишком маленький - это не видео
-                    size_mb = file_size / (1024 * 1024)
-                    download_progress[download_id] = {
-                        "status": "error",
-                        "progress": last_progress,
-                        "message": f"Скачанный файл слишком маленький ({size_mb:.2f} МБ). Это не видео файл. Возможно, скачались метаданные вместо видео.",
-                        "filename": None,
-                        "filepath": None
-                    }
-                    # Удаляем неправильный файл
-                    try:
-                        os.remove(filename)
-                    except:
-                        pass
-                else:
-                    # Файл валидный, продолжаем обработку
-                    # Убеждаемся, что файл имеет расширение .mp4
-                    if file_path.suffix.lower() not in ['.mp4', '.webm', '.mkv', '.m4v']:
-                        # Переименовываем файл в .mp4
-                        new_filename = file_path.with_suffix('.mp4')
-                        try:
-                            shutil.move(str(file_path), str(new_filename))
-                            filename = str(new_filename)
-                        except Exception as e:
-                            # Если не удалось переименовать, используем оригинальное имя
-                            pass
-                    
-                    # Сохраняем полный путь к файлу для последующей отдачи клиенту
-                    clean_filename = os.path.basename(filename)
-                    # Убеждаемся, что имя файла заканчивается на .mp4
-                    if not clean_filename.lower().endswith('.mp4'):
-                        clean_filename = os.path.splitext(clean_filename)[0] + '.mp4'
-                    
-                    download_progress[download_id] = {
-                        "status": "completed",
-                        "progress": 100,
-                        "message": f"Загрузка завершена! Размер: {file_size / (1024 * 1024):.2f} МБ",
-                        "filename": clean_filename,
-                        "filepath": filename  # Полный путь для скачивания
-                    }
+                await finalize_download(download_id, filename, last_progress, cache_key, None if stream else options)
             else:
                 # Формируем детальное сообщение об ошибке
-                error_details = []
                 if not filename:
-                    error_details.append("Имя файла не было извлечено из вывода")
+                    error_details = ["yt-dlp не сообщил путь к итоговому файлу"]
                 else:
-                    error_details.append(f"Файл не существует: {filename}")
-                
-                # Проверяем, какие файлы есть в папке
-                if temp_dir.exists():
-                    files_in_dir = list(temp_dir.iterdir())
-                    if files_in_dir:
-                        file_details = []
-                        for f in files_in_dir[:10]:
-                            if f.is_file():
-                                size = os.path.getsize(f)
-                                size_str = f"{size / 1024:.1f}KB" if size < 1024*1024 else f"{size / (1024*1024):.1f}MB"
-                                file_details.append(f"{f.name} ({size_str})")
-                        file_list = ", ".join(file_details)
-                        error_details.append(f"Найдено файлов в папке: {len(files_in_dir)} ({file_list})")
-                    else:
-                        error_details.append("Папка пуста")
+                    error_details = [f"Файл не существует: {filename}"]
                 
                 # Добавляем последние строки вывода для диагностики
-                if all_output:
-                    last_lines = "\n".join(all_output[-3:])
+                if parser.recent:
+                    last_lines = "\n".join(list(parser.recent)[-3:])
                     error_details.append(f"Последние строки: {last_lines[:200]}")
                 
                 error_message = "Файл не найден после загрузки. " + " | ".join(error_details)
                 
-                download_progress[download_id] = {
-                    "status": "error",
-                    "progress": last_progress,
-                    "message": error_message[:500],
-                    "filename": None,
-                    "filepath": None
-                }
+                set_progress(
+                    download_id,
+                    status="error",
+                    error_type="output_missing",
+                    progress=last_progress,
+                    message=error_message[:500],
+                    filename=None,
+                    filepath=None,
+                )
         else:
-            # Читаем оставшийся вывод для ошибок
-            try:
-                remaining_output = await process.stdout.read()
-                error_msg = remaining_output.decode('utf-8', errors='ignore')
-            except:
-                error_msg = ""
+            # Парсер уже выделил текст последней ошибки yt-dlp
+            error_msg = parser.error_summary()
+            # Ссылки в сохранённом info могли истечь — следующая попытка извлечёт заново
+            probe_cache.discard(url)
             
-            # Объединяем все сообщения об ошибках
-            if error_lines:
-                error_msg = "\n".join(error_lines[-5:])  # Последние 5 ошибок
-            elif error_msg:
-                error_msg = error_msg[:500]
-            else:
-                # Если нет явных ошибок, но процесс завершился с ошибкой
-                error_msg = "\n".join(all_output[-10:]) if all_output else "Неизвестная ошибка при загрузке"
-            
-            # Формируем понятное сообщение об ошибке
-            if "yt-dlp: error" in error_msg or "ERROR" in error_msg.upper():
-                # Извлекаем основную ошибку
-                error_match = re.search(r'ERROR:\s*(.+?)(?:\n|$)', error_msg, re.IGNORECASE)
-                if error_match:
-                    error_msg = error_match.group(1).strip()
-                else:
-                    error_msg = error_msg.split('\n')[0] if '\n' in error_msg else error_msg[:200]
-            
-            download_progress[download_id] = {
-                "status": "error",
-                "progress": last_progress,
-                "message": f"Ошибка: {error_msg[:300]}",
-                "filename": None,
-                "filepath": None
-            }
+            set_progress(
+                download_id,
+                status="error",
+                error_type="ytdlp",
+                progress=last_progress,
+                message=f"Ошибка: {error_msg[:300]}",
+                filename=None,
+                filepath=None,
+            )
     
     except FileNotFoundError:
-        download_progress[download_id] = {
-            "status": "error",
-            "progress": 0,
-            "message": "yt-dlp не найден. Установите его: pip install yt-dlp",
-            "filename": None,
-            "filepath": None
-        }
+        set_progress(
+            download_id,
+            status="error",
+            error_type="ytdlp_missing",
+            progress=0,
+            message="yt-dlp не найден. Установите его: pip install yt-dlp",
+            filename=None,
+            filepath=None,
+        )
     except asyncio.TimeoutError:
-        download_progress[download_id] = {
-            "status": "error",
-            "progress": 0,
-            "message": "Превышено время ожидания загрузки",
-            "filename": None,
-            "filepath": None
-        }
+        set_progress(
+            download_id,
+            status="error",
+            error_type="timeout",
+            progress=0,
+            message="Превышено время ожидания загрузки",
+            filename=None,
+            filepath=None,
+        )
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
-        download_progress[download_id] = {
-            "status": "error",
-            "progress": 0,
-            "message": f"Ошибка: {str(e)}",
-            "filename": None,
-            "filepath": None
-        }
+        set_progress(
+            download_id,
+            status="error",
+            error_type="internal",
+            progress=0,
+            message=f"Ошибка: {str(e)}",
+            filename=None,
+            filepath=None,
+        )
+
+async def download_video_segmented(url: str, download_id: str, cache_key: str = None, stream: bool = False,
+                                   options: FormatOptions = None):
+    """Скачивает HLS/DASH встроенным загрузчиком фрагментов"""
+    work_dir = job_work_dir(download_id)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    
+    def on_progress(data):
+        total = data["fragment_count"] or 1
+        progress = round(data["fragment_index"] / total * 100, 1)
+        speed_mb = data["throughput"] / (1024 * 1024)
+        set_progress(
+            download_id,
+            progress=progress,
+            message=f"Загрузка фрагментов: {data['fragment_index']}/{total} ({speed_mb:.1f} МБ/с)",
+            downloaded_bytes=data["downloaded_bytes"],
+            fragment_index=data["fragment_index"],
+            fragment_count=data["fragment_count"],
+            speed=data["throughput"],
+            throughput=data["throughput"],
+            fragment_retries=data["retries"],
+            resume_state=data["resume_state"],
+        )
+    
+    # Ограничение общее для всех соединений задачи и меняется вместе с долей полосы
+    limiter = RateLimiter()
+    limiter.rate = bandwidth.add(download_id, lambda rate: setattr(limiter, "rate", rate))
+    
+    downloader = SegmentedDownloader(
+        get_http_client(),
+        concurrency=config.SEGMENT_CONCURRENCY,
+        retries=config.SEGMENT_RETRIES,
+        on_progress=on_progress,
+        limiter=limiter,
+    )
+    
+    set_progress(download_id, message="Загрузка манифеста...")
+    enter_stage(download_id, "manifest")
+    try:
+        tracks = await downloader.resolve(url, options.effective_height if options else None)
+    except httpx.HTTPError as e:
+        raise UnsupportedManifest(f"Манифест недоступен ({e})")
+    
+    need_ffmpeg = len(tracks) > 1 or (tracks[0].container == "ts" and not stream)
+    has_ffmpeg = shutil.which("ffmpeg") is not None
+    if len(tracks) > 1 and not has_ffmpeg:
+        raise UnsupportedManifest("Для объединения дорожек нужен ffmpeg")
+    
+    downloader.fragments_total = sum(len(t.fragments) + (1 if t.init else 0) for t in tracks)
+    title = sanitize_filename(Path(url.split("?")[0]).stem) or "video"
+    base = work_dir / title
+    
+    # Продолжаем прерванную загрузку с последнего записанного фрагмента
+    journal_entry = job_journal.get(download_id) if job_journal is not None else None
+    resume = (journal_entry.resume_state if journal_entry else None) or {}
+    
+    enter_stage(download_id, "download")
+    try:
+        paths = []
+        for index, track in enumerate(tracks):
+            suffix = {"video": ".video", "audio": ".audio"}.get(track.kind, "")
+            path = f"{base}{suffix}.{track.container}"
+            paths.append(path)
+            if len(tracks) == 1:
+                active_outputs[download_id] = path
+            
+            downloader.track_index = index
+            if index < resume.get("track", 0) and os.path.exists(path):
+                # Дорожка уже скачана до перезапуска
+                downloader.fragments_done += len(track.fragments) + (1 if track.init else 0)
+                downloader.bytes_done += os.path.getsize(path)
+                continue
+            if index == resume.get("track", 0) and resume.get("fragment"):
+                set_progress(download_id, message=f"Продолжение с фрагмента {resume['fragment']}...")
+                await downloader.download_track(track, path, resume["fragment"], resume["bytes"])
+            else:
+                await downloader.download_track(track, path)
+        
+        filename = paths[0]
+        if need_ffmpeg and has_ffmpeg:
+            set_progress(download_id, message="Сборка файла...")
+            enter_stage(download_id, "postprocess")
+            filename = f"{base}.mp4"
+            await merge_tracks(paths, filename, remux_ts=tracks[0].container == "ts")
+    except (SegmentDownloadError, httpx.HTTPError, OSError) as e:
+        set_progress(
+            download_id,
+            status="error",
+            error_type="segments",
+            message=f"Ошибка загрузки фрагментов: {str(e)[:300]}",
+            filename=None,
+            filepath=None,
+        )
+        return
+    
+    await finalize_download(download_id, filename, 100, cache_key, None if stream else options)
+
+async def download_video_inprocess(url: str, download_id: str, cache_key: str = None, stream: bool = False,
+                                   options: FormatOptions = None):
+    """Скачивает видео через встроенный движок (Python API yt-dlp в пуле процессов)"""
+    work_dir = job_work_dir(download_id)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Те же параметры, что и у командной строки в download_video
+    options = options or FormatOptions()
+    ydl_opts = {
+        "format": options.selector(stream),
+        "hls_use_mpegts": stream,
+        "merge_output_format": options.merge_format(),
+        "noplaylist": True,
+        "extractor_args": {"youtube": {"player_client": ["android"]}},
+        "nopart": False,
+        "continuedl": True,   # Продолжать с .part после перезапуска
+        "updatetime": False,
+        "outtmpl": str(work_dir / "%(title)s.%(ext)s"),
+        # Доля полосы; при её изменении воркер получает новое значение на ходу
+        "ratelimit": bandwidth.add(download_id, lambda rate: ytdlp_engine.set_rate(download_id, rate)) or None,
+    }
+    last_progress = 0
+    
+    def on_event(kind, data):
+        nonlocal last_progress
+        if kind == "download":
+            enter_stage(download_id, "download")
+            output_path = data.get("tmpfilename") or data.get("filename")
+            if output_path and active_outputs.get(download_id) != output_path:
+                active_outputs[download_id] = output_path
+                if job_journal is not None:
+                    job_journal.checkpoint(download_id, force=True, output_path=output_path)
+            downloaded = data.get("downloaded_bytes") or 0
+            total = data.get("total_bytes")
+            if data.get("fragment_count"):
+                last_progress = (data.get("fragment_index") or 0) / data["fragment_count"] * 100
+            elif total:
+                last_progress = downloaded / total * 100
+            if total:
+                message = f"Загрузка: {last_progress:.1f}% ({total / (1024 * 1024):.1f} МБ)"
+            else:
+                message = f"Загрузка: {downloaded / (1024 * 1024):.1f} МБ"
+            set_progress(
+                download_id,
+                progress=round(min(last_progress, 100), 1),
+                message=message,
+                downloaded_bytes=downloaded,
+                total_bytes=total,
+                speed=data.get("speed"),
+                eta=data.get("eta"),
+                fragment_index=data.get("fragment_index"),
+                fragment_count=data.get("fragment_count"),
+            )
+        elif kind == "postprocess":
+            enter_stage(download_id, "postprocess")
+            if data.get("postprocessor") == "Merger":
+                set_progress(download_id, message="Объединение видео и аудио...")
+            else:
+                set_progress(download_id, message="Обработка видео...")
+    
+    info = get_probed_info(url)
+    if info is None:
+        set_progress(download_id, message="Извлечение информации о видео...")
+    else:
+        set_progress(download_id, message="Информация о видео взята из кэша...")
+    try:
+        result = await ytdlp_engine.download(download_id, url, ydl_opts, on_event, info)
+    except EngineCrashError as e:
+        logger.error("Встроенный движок, задача %s: %s", download_id, e)
+        set_progress(
+            download_id,
+            status="error",
+            error_type="engine",
+            progress=last_progress,
+            message=f"Ошибка движка загрузки: {e}",
+            filename=None,
+            filepath=None,
+        )
+        return
+    except EngineError as e:
+        probe_cache.discard(url)
+        error_msg = str(e)
+        error_match = re.search(r'ERROR:\s*(.+?)(?:\n|$)', error_msg)
+        if error_match:
+            error_msg = error_match.group(1).strip()
+        set_progress(
+            download_id,
+            status="error",
+            error_type="ytdlp",
+            progress=last_progress,
+            message=f"Ошибка: {error_msg[:300]}",
+            filename=None,
+            filepath=None,
+        )
+        return
+    
+    filename = result.get("filepath")
+    if filename and os.path.exists(filename):
+        await finalize_download(download_id, filename, last_progress, cache_key, None if stream else options)
+    else:
+        set_progress(
+            download_id,
+            status="error",
+            error_type="output_missing",
+            progress=last_progress,
+            message=f"Файл не найден после загрузки: {filename}",
+            filename=None,
+            filepath=None,
+        )
+
+@app.on_event("startup")
+async def on_startup():
+    """Проверяет yt-dlp и запускает встроенный движок, если он выбран"""
+    global ytdlp_engine, broker_worker_task
+    if broker is not None:
+        asyncio.create_task(run_broker_heartbeat())
+    if config.ROLE == "api":
+        # API-узел не качает: движок и yt-dlp нужны только воркерам
+        asyncio.create_task(evict_finished_jobs())
+        asyncio.create_task(run_janitor())
+        return
+    if config.ENGINE == "inprocess":
+        if engine.is_available():
+            ytdlp_engine = InProcessEngine(config.ENGINE_WORKERS)
+            await ytdlp_engine.start()
+        else:
+            logger.warning("VD_ENGINE=inprocess, но пакет yt_dlp не установлен — используется subprocess")
+    await ensure_ytdlp_available()
+    if job_journal is not None:
+        if config.RESUME_ON_STARTUP:
+            resume_pending_jobs()
+        asyncio.create_task(run_journal_heartbeat())
+    asyncio.create_task(evict_finished_jobs())
+    asyncio.create_task(run_janitor())
+    if config.ROLE == "worker":
+        broker_worker_task = asyncio.create_task(run_broker_worker())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Останавливает задачи вместе с их процессами; незавершённые продолжатся после перезапуска"""
+    if broker_worker_task is not None:
+        broker_worker_task.cancel()
+    # Задачи, которые воркер не успел начать, сразу отдаём другим воркерам
+    for job_id in list(leased_jobs):
+        if scheduler.cancel(job_id):
+            finish_leased_job(job_id, requeue=True)
+    await scheduler.shutdown(config.SHUTDOWN_TIMEOUT)
+    if job_journal is not None:
+        job_journal.release()
+    for batch in batches.values():
+        if batch.task is not None:
+            batch.task.cancel()
+    if ytdlp_engine is not None:
+        await ytdlp_engine.stop()
+    if http_client is not None:
+        await http_client.aclose()
+    job_store.close()
+    if broker is not None:
+        broker.close()
 
 @app.get("/")
 async def read_root():
     """Главная страница"""
-    return FileResponse("static/index.html")
+    return FileResponse(STATIC_DIR / "index.html")
 
 @app.post("/api/download")
-async def download_video_endpoint(request: DownloadRequest):
-    """Начинает загрузку видео"""
-    import uuid
-    download_id = str(uuid.uuid4())
+async def download_video_endpoint(request: DownloadRequest, http_request: Request):
+    """Ставит загрузку видео в очередь"""
+    ip = client_ip(http_request)
+    try:
+        client_quotas.check(ip, is_job_running)
+        response = submit_download(request.url, request.priority, request.stream, options=request.format_options())
+    except QuotaExceededError as e:
+        return quota_response(e)
+    except FormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NoSpaceError:
+        return JSONResponse(
+            status_code=507,
+            content={"detail": "На сервере недостаточно места, повторите позже"},
+            headers={"Retry-After": str(config.QUEUE_RETRY_AFTER)},
+        )
+    except QueueFullError as e:
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Очередь загрузок переполнена, повторите позже"},
+            headers={"Retry-After": str(e.retry_after)},
+        )
     
-    # Запускаем загрузку в фоне
-    asyncio.create_task(download_video(request.url, download_id))
+    client_quotas.add_job(ip, response["download_id"])
+    if response.get("cache_hit"):
+        # Файл из кэша уходит клиенту так же, как скачанный
+        charge_clients(response["download_id"])
+    return response
+
+def submit_download(url: str, priority: int = 0, stream: bool = False, download_id: str = None,
+                    options: FormatOptions = None):
+    """Ставит загрузку в очередь (или отдаёт из кэша, или подписывает на такую же).
+
+    Возвращает ответ для клиента; при недопустимых параметрах формата бросает
+    FormatError, при переполнении очереди — QueueFullError, при нехватке места — NoSpaceError.
+    """
+    options = options or FormatOptions()
+    options.validate(stream)
+    download_id = download_id or str(uuid.uuid4())
+    
+    # Готовый файл уже есть в кэше — отдаём его сразу
+    cache_key = make_cache_key(url, options.cache_variant(stream))
+    entry = result_cache.get(cache_key, download_id) if result_cache is not None else None
+    if entry is not None:
+        job_store.subscribe(download_id, download_id)
+        set_progress(
+            download_id,
+            status="completed",
+            progress=100,
+            message=f"Файл взят из кэша. Размер: {entry.size / (1024 * 1024):.2f} МБ",
+            filename=entry.filename,
+            filepath=entry.path,
+            cache_hit=True,
+        )
+        metrics.JOBS.labels("cache_hit").inc()
+        return {"download_id": download_id, "status": "completed", "cache_hit": True}
+    
+    # Такой же запрос уже выполняется — подписываемся на него вместо нового процесса
+    job_id = inflight_jobs.get(cache_key)
+    if job_id is not None and not job_store.subscribers(job_id):
+        # От задачи отписались все клиенты — её файл будет удалён, подключаться к ней нельзя
+        del inflight_jobs[cache_key]
+        job_id = None
+    if job_id is not None and config.ROLE == "api" and not is_job_running(job_id):
+        # Задачу выполнил воркер — API-узел узнаёт об этом только из общего хранилища
+        del inflight_jobs[cache_key]
+        job_id = None
+    if job_id is not None:
+        job_store.delete(download_id)
+        job_store.subscribe(job_id, download_id)
+        if job_journal is not None:
+            job_journal.set_subscribers(job_id, job_store.subscribers(job_id))
+        metrics.JOBS.labels("coalesced").inc()
+        status = job_store.get(job_id).status
+        position = queue_position(job_id)
+        if position:
+            return {"download_id": download_id, "status": status, "queue_position": position}
+        return {"download_id": download_id, "status": status}
+    
+    # Места на диске мало — сначала пробуем убрать лишнее, потом отказываем.
+    # На API-узле место проверяет воркер перед тем, как взять задачу.
+    if config.ROLE != "api" and not janitor.has_room():
+        janitor.sweep()
+        if not janitor.has_room():
+            janitor.rejected_jobs += 1
+            metrics.JOBS.labels("no_space").inc()
+            raise NoSpaceError()
+    
+    set_progress(
+        download_id,
+        status="queued",
+        progress=0,
+        message="В очереди...",
+        filename=None,
+        filepath=None,
+        queue_position=None,
+        streamable=stream,
+    )
+    if broker is not None:
+        # Качает воркер: задача уходит в общую очередь
+        broker.enqueue(
+            download_id, url, {"stream": stream, "priority": priority, "format": options.to_dict()}, cache_key, priority,
+        )
+        inflight_jobs[cache_key] = download_id
+        job_store.subscribe(download_id, download_id)
+        metrics.JOBS.labels("queued").inc()
+        position = broker.position(download_id)
+        set_progress(download_id, queue_position=position)
+        job_store.hand_off(download_id)   # Дальше задачу обновляет воркер
+        return {"download_id": download_id, "status": "queued", "queue_position": position}
+    start_job_timer(download_id)
+    
+    # Передаём загрузку планировщику вместо запуска без ограничений
+    try:
+        position = scheduler.submit(
+            download_id,
+            url,
+            lambda: run_download_job(url, download_id, cache_key, stream, options),
+            priority=priority,
+        )
+    except QueueFullError:
+        job_store.delete(download_id)
+        job_timers.pop(download_id, None)
+        metrics.JOBS.labels("queue_full").inc()
+        raise
+    
+    inflight_jobs[cache_key] = download_id
+    job_store.subscribe(download_id, download_id)
+    metrics.JOBS.labels("queued").inc()
+    if job_journal is not None:
+        job_journal.add(
+            download_id, url, {"stream": stream, "priority": priority, "format": options.to_dict()}, cache_key,
+        )
+    
+    if position:
+        set_progress(download_id, queue_position=position)
+        return {"download_id": download_id, "status": "queued", "queue_position": position}
     
     return {"download_id": download_id, "status": "started"}
 
+async def run_download_job(url: str, job_id: str, cache_key: str, stream: bool = False,
+                           options: FormatOptions = None):
+    """Выполняет задачу и снимает её с учёта выполняющихся"""
+    try:
+        await download_video(url, job_id, cache_key, stream, options)
+    except asyncio.CancelledError:
+        # Остановка сервера: задача остаётся в журнале и продолжится после перезапуска
+        if job_id not in cancelled_jobs:
+            raise
+        set_cancelled(job_id)
+    finally:
+        cancelled_jobs.discard(job_id)
+        if job_id in leased_jobs:
+            record = job_store.get(job_id)
+            finish_leased_job(job_id, requeue=record is None or record.status not in FINISHED_STATUSES)
+        active_outputs.pop(job_id, None)
+        active_processes.pop(job_id, None)
+        if inflight_jobs.get(cache_key) == job_id:
+            del inflight_jobs[cache_key]
+        bandwidth.remove(job_id)
+        record_job_metrics(url, job_id)
+        charge_clients(job_id)
+        # Задача дошла до конца — в журнале она больше не нужна.
+        # Если процесс прервали (перезапуск), запись остаётся и задача продолжится.
+        record = job_store.get(job_id)
+        if job_journal is not None and record is not None and record.status in FINISHED_STATUSES:
+            job_journal.remove(job_id)
+        # Недокачанные файлы неудачной задачи больше не понадобятся
+        if record is not None and record.status == "error":
+            shutil.rmtree(job_work_dir(job_id), ignore_errors=True)
+        # Все подписчики ушли, пока шла загрузка — файл больше никому не нужен
+        if record is not None and not job_store.subscribers(job_id):
+            release_job_file(job_id)
+
+# Задачи, отменённые клиентом (DELETE /api/download/{id}), а не остановкой сервера
+cancelled_jobs = set()
+
+def set_cancelled(download_id: str):
+    set_progress(
+        download_id,
+        status="error",
+        error_type="cancelled",
+        message="Загрузка отменена",
+        filename=None,
+        filepath=None,
+        queue_position=None,
+    )
+
+def drop_inflight(job_id: str):
+    """Новые одинаковые запросы больше не подключаются к этой задаче"""
+    for cache_key, inflight_id in list(inflight_jobs.items()):
+        if inflight_id == job_id:
+            del inflight_jobs[cache_key]
+
+def cancel_job(job_id: str):
+    """Отменяет задачу: убирает из очереди или останавливает вместе с процессами"""
+    if config.ROLE == "api":
+        # Выполняющуюся задачу воркер остановит по следующему пульсу
+        if broker.cancel(job_id) == "leased":
+            return
+        drop_inflight(job_id)
+        set_cancelled(job_id)
+        return
+    if scheduler.stop(job_id):
+        # Дальше задача завершится сама: процесс остановлен, файлы удалит run_download_job.
+        # Пока процесс завершается, новые такие же запросы к ней уже не подключаются
+        drop_inflight(job_id)
+        cancelled_jobs.add(job_id)
+        return
+    if scheduler.cancel(job_id):
+        # Задача не начиналась — убираем её следы здесь
+        drop_inflight(job_id)
+        job_timers.pop(job_id, None)
+        if job_journal is not None:
+            job_journal.remove(job_id)
+    # Задача пакета, ещё не переданная в очередь, просто помечается отменённой
+    set_cancelled(job_id)
+
+def runs_elsewhere(job_id: str, record):
+    """Незавершённую задачу выполняет другой процесс с тем же хранилищем задач.
+
+    В раздельном режиме (VD_ROLE=api) задачи останавливает брокер, это не про него.
+    """
+    return config.ROLE != "api" and record.status not in FINISHED_STATUSES and not job_store.is_local(job_id)
+
+def queue_position(job_id: str):
+    """Позиция задачи в очереди: своей или, в раздельном режиме, общей"""
+    if config.ROLE == "api":
+        return broker.position(job_id)
+    return scheduler.position(job_id)
+
+def start_leased_job(job):
+    """Запускает задачу из брокера в планировщике этого воркера"""
+    stream = job.options.get("stream", False)
+    options = FormatOptions.from_dict(job.options.get("format"))
+    cache_key = job.cache_key or make_cache_key(job.url, options.cache_variant(stream))
+    leased_jobs.add(job.id)
+    job_store.subscribe(job.id, job.id)
+    
+    entry = result_cache.get(cache_key, job.id) if result_cache is not None else None
+    if entry is not None:
+        set_progress(
+            job.id,
+            status="completed",
+            progress=100,
+            message=f"Файл взят из кэша. Размер: {entry.size / (1024 * 1024):.2f} МБ",
+            filename=entry.filename,
+            filepath=entry.path,
+            cache_hit=True,
+            worker=config.WORKER_ID,
+        )
+        metrics.JOBS.labels("cache_hit").inc()
+        finish_leased_job(job.id)
+        return
+    
+    set_progress(
+        job.id,
+        status="queued",
+        message="Задача у воркера, ожидает слота...",
+        queue_position=None,
+        resumed=True if job.attempts > 1 else None,
+        worker=config.WORKER_ID,
+    )
+    start_job_timer(job.id)
+    scheduler.submit(
+        job.id,
+        job.url,
+        lambda: run_download_job(job.url, job.id, cache_key, stream, options),
+        priority=job.priority,
+    )
+    metrics.JOBS.labels("leased").inc()
+
+def finish_leased_job(job_id: str, requeue: bool = False):
+    """Сообщает брокеру, что задача закончена (или возвращает её в очередь)"""
+    leased_jobs.discard(job_id)
+    if job_id in lost_jobs:
+        # Задачу уже выполняет другой воркер
+        lost_jobs.discard(job_id)
+        job_store.hand_off(job_id)
+        return
+    if requeue:
+        broker.release(job_id, config.WORKER_ID)
+    else:
+        broker.complete(job_id, config.WORKER_ID)
+
+async def run_broker_worker():
+    """Воркер раздельного режима: берёт задачи из брокера, пока есть свободные слоты"""
+    while True:
+        scheduler_stats = scheduler.stats()
+        free = scheduler.max_workers - scheduler_stats["active"] - scheduler_stats["queued"]
+        jobs = []
+        if free > 0 and janitor.has_room():
+            try:
+                jobs = broker.lease(config.WORKER_ID, free)
+            except Exception as e:
+                logger.warning("Брокер недоступен: %s", e)
+        for job in jobs:
+            start_leased_job(job)
+        await asyncio.sleep(0 if jobs else config.BROKER_POLL_INTERVAL)
+
+async def run_broker_heartbeat():
+    """Пульс воркера и возврат в очередь задач пропавших воркеров (на любом узле)"""
+    while True:
+        try:
+            if config.ROLE == "worker":
+                cancelled, lost = broker.heartbeat(config.WORKER_ID, config.WORKER_URL, list(leased_jobs))
+                for job_id in cancelled:
+                    cancel_job(job_id)
+                for job_id in lost:
+                    # Пульс опоздал, задачу уже отдали другому — останавливаем свою копию молча
+                    lost_jobs.add(job_id)
+                    scheduler.stop(job_id) or scheduler.cancel(job_id)
+            expired = broker.requeue_expired()
+        except Exception as e:
+            logger.warning("Брокер недоступен: %s", e)
+        else:
+            for job_id in expired["requeued"]:
+                set_progress(job_id, status="queued", message="Воркер недоступен, задача передана другому...", worker=None)
+                job_store.hand_off(job_id)
+                metrics.JOBS.labels("requeued").inc()
+            for job_id in expired["failed"]:
+                set_progress(
+                    job_id,
+                    status="error",
+                    error_type="worker_lost",
+                    message="Воркер, выполнявший задачу, недоступен",
+                    filename=None,
+                    filepath=None,
+                )
+            for job_id in expired["cancelled"]:
+                set_cancelled(job_id)
+        await asyncio.sleep(config.HEARTBEAT_INTERVAL)
+
+def record_job_metrics(url: str, job_id: str):
+    """Итоговое время этапов задачи и объём скачанного по хосту"""
+    timer = job_timers.pop(job_id, None)
+    if timer is None:
+        return
+    timer.stop()
+    record = job_store.get(job_id)
+    status = record.status if record is not None else "unknown"
+    metrics.JOB_SECONDS.labels(status).observe(timer.total())
+    set_progress(job_id, stage=None, timings=dict(timer.timings, total=round(timer.total(), 3)))
+    
+    if record is None:
+        return
+    size = record.downloaded_bytes or 0
+    if status == "completed" and record.filepath and os.path.exists(record.filepath):
+        size = os.path.getsize(record.filepath)
+    host = metrics.host_label(get_host(url), config.METRICS_HOSTS)
+    metrics.DOWNLOADED_BYTES.labels(host).inc(size)
+    download_time = timer.timings.get("download")
+    if status == "completed" and download_time:
+        metrics.THROUGHPUT.labels(host).observe(size / download_time)
+
+def charge_clients(job_id: str):
+    """Засчитывает объём задачи в часовую квоту всех клиентов, ждавших её"""
+    record = job_store.get(job_id)
+    if record is None:
+        return
+    size = record.downloaded_bytes or 0
+    if record.status == "completed" and record.filepath and os.path.exists(record.filepath):
+        size = os.path.getsize(record.filepath)
+    for download_id in job_store.subscribers(job_id) or {job_id}:
+        client_quotas.record_bytes(download_id, size)
+
+def client_ip(request: Request):
+    """IP клиента (за своим прокси — из X-Forwarded-For)"""
+    if config.TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def is_job_running(download_id: str):
+    """Выполняется ли ещё задача (или та, на которую подписан download_id)"""
+    record = job_store.get(resolve_job_id(download_id))
+    return record is not None and record.status not in FINISHED_STATUSES
+
+def quota_response(error: QuotaExceededError):
+    metrics.JOBS.labels("client_quota").inc()
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(error)},
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+def resume_pending_jobs():
+    """Ставит в очередь задачи, прерванные перезапуском сервера.
+
+    Журнал общий для всех воркеров uvicorn: каждая задача достаётся одному из них (claim).
+    """
+    for entry in job_journal.claim():
+        if job_store.is_local(entry.id):
+            continue   # Своя задача, аренду которой не успели продлить
+        stream = entry.options.get("stream", False)
+        options = FormatOptions.from_dict(entry.options.get("format"))
+        cache_key = entry.cache_key or make_cache_key(entry.url, options.cache_variant(stream))
+        set_progress(
+            entry.id,
+            status="queued",
+            progress=0,
+            message="Возобновление после перезапуска...",
+            filename=None,
+            filepath=None,
+            queue_position=None,
+            streamable=stream,
+            resumed=True,
+        )
+        start_job_timer(entry.id)
+        for subscriber in set(entry.subscribers) | {entry.id}:
+            job_store.subscribe(entry.id, subscriber)
+        inflight_jobs[cache_key] = entry.id
+        try:
+            scheduler.submit(
+                entry.id,
+                entry.url,
+                lambda entry=entry, cache_key=cache_key, stream=stream, options=options: run_download_job(
+                    entry.url, entry.id, cache_key, stream, options,
+                ),
+                priority=entry.options.get("priority", 0),
+            )
+        except QueueFullError:
+            set_progress(entry.id, status="error", error_type="queue_full", message="Очередь переполнена, задача не возобновлена")
+            job_journal.remove(entry.id)
+
+async def run_journal_heartbeat():
+    """Продлевает аренду своих записей журнала и забирает задачи остановившихся процессов"""
+    while True:
+        await asyncio.sleep(config.HEARTBEAT_INTERVAL)
+        job_journal.renew()
+        if config.RESUME_ON_STARTUP:
+            resume_pending_jobs()
+
+async def evict_finished_jobs():
+    """Периодически удаляет давно завершённые задачи и их файлы"""
+    while True:
+        await asyncio.sleep(config.JOB_SWEEP_INTERVAL)
+        for record in job_store.evict():
+            forget_job(record)
+        # Пакеты забываем вместе с их задачами
+        now = time.time()
+        for batch_id, batch in list(batches.items()):
+            if batch.finished_at is not None and now - batch.finished_at > config.JOB_TTL:
+                del batches[batch_id]
+
+def forget_job(record):
+    """Убирает все следы вытесненной задачи"""
+    job_id = record.id
+    if config.ROLE == "api":
+        # На API-узле задачу не снимает run_download_job — убираем её из выполняющихся здесь
+        drop_inflight(job_id)
+    for subscriber in job_store.drop_subscribers(job_id):
+        client_quotas.forget(subscriber)
+    client_quotas.forget(job_id)
+    progress_events.forget(job_id)
+    release_job_file(job_id, record)
+
+def job_storage_state(download_id):
+    """Состояние задачи для уборщика временной папки"""
+    record = job_store.get(download_id)
+    if record is None:
+        # Задача из журнала ещё будет продолжена — её .part-файлы нужны
+        if job_journal is not None and job_journal.get(download_id) is not None:
+            return "active"
+        return None
+    return "finished" if record.status in FINISHED_STATUSES else "active"
+
+def evict_job(download_id):
+    """Забывает завершённую задачу, файлы которой удаляет уборщик"""
+    record = job_store.get(download_id)
+    if record is not None:
+        job_store.delete(download_id)
+        forget_job(record)
+
+# Уборщик временной папки: квота, возраст файлов и файлы без задач
+janitor = TempJanitor(
+    config.TEMP_DIR,
+    job_storage_state,
+    evict_job,
+    max_bytes=config.TEMP_MAX_BYTES,
+    max_age=config.TEMP_MAX_AGE,
+    low_watermark=config.TEMP_LOW_WATERMARK,
+    min_free_bytes=config.MIN_FREE_BYTES,
+    orphan_grace=config.TEMP_ORPHAN_GRACE,
+)
+
+async def run_janitor():
+    while True:
+        try:
+            janitor.sweep()
+        except Exception as e:
+            logger.exception("Ошибка уборки временной папки: %s", e)
+        await asyncio.sleep(config.JANITOR_INTERVAL)
+
+def get_progress_data(job_id: str):
+    """Текущее состояние задачи с актуальной позицией в очереди"""
+    record = job_store.get(job_id)
+    if record is None:
+        return None
+    progress_data = record.to_dict()
+    # Очередь своя у каждого процесса: позицию чужой задачи берём из базы как есть
+    if record.status == "queued" and config.ROLE == "api":
+        progress_data["queue_position"] = broker.position(job_id)
+    elif record.status == "queued" and job_store.is_local(job_id):
+        progress_data["queue_position"] = scheduler.position(job_id)
+    return progress_data
+
+# Пакетные загрузки: batch_id -> Batch
+batches = {}
+
+@app.get("/api/profiles")
+async def get_profiles():
+    """Доступные контейнеры и профили обработки для параметров загрузки"""
+    return {
+        "containers": list(CONTAINER_CODECS),
+        "profiles": {
+            name: {"container": profile.container, "max_height": profile.max_height, "description": profile.description}
+            for name, profile in PROFILES.items()
+        },
+    }
+
+@app.post("/api/probe")
+async def probe_video(request: ProbeRequest):
+    """Информация о видео (название, длительность, форматы, размеры) без загрузки"""
+    try:
+        info, cache_hit = await probe_cache.fetch(request.url, extract_video_info)
+    except ProbeError as e:
+        metrics.PROBES.labels("error").inc()
+        raise HTTPException(status_code=400, detail=str(e))
+    metrics.PROBES.labels("hit" if cache_hit else "miss").inc()
+    return {**summarize_info(info), "cache_hit": cache_hit}
+
+async def extract_video_info(url: str):
+    """Извлекает info через встроенный движок или отдельный процесс yt-dlp"""
+    async with probe_slots:
+        if ytdlp_engine is None:
+            try:
+                return await extract_info(url, FORMAT_SELECTOR, config.PROBE_TIMEOUT)
+            except FileNotFoundError:
+                raise ProbeError("yt-dlp не найден. Установите его: pip install yt-dlp")
+        
+        ydl_opts = {
+            "format": FORMAT_SELECTOR,
+            "noplaylist": True,
+            "extractor_args": {"youtube": {"player_client": ["android"]}},
+        }
+        try:
+            return await asyncio.wait_for(ytdlp_engine.extract(url, ydl_opts), config.PROBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ProbeError(f"Информация о видео не получена за {config.PROBE_TIMEOUT} с")
+        except EngineError as e:
+            raise ProbeError(clean_error(str(e)))
+
+def get_probed_info(url: str):
+    """info из кэша /api/probe, если он подходит для загрузки одного видео"""
+    info = probe_cache.get(url)
+    if info is None or info.get("_type", "video") != "video":
+        return None
+    metrics.PROBES.labels("reused").inc()
+    return info
+
+@app.post("/api/batch")
+async def create_batch(request: BatchRequest, http_request: Request):
+    """Ставит в очередь список ссылок или все видео плейлиста"""
+    urls = [url.strip() for url in request.urls if url.strip()]
+    options = request.format_options()
+    try:
+        options.validate()
+    except FormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    ip = client_ip(http_request)
+    try:
+        # Клиенту, исчерпавшему квоту, плейлист не разворачиваем
+        client_quotas.check(ip, is_job_running, max(len(urls), 1))
+    except QuotaExceededError as e:
+        return quota_response(e)
+    title = None
+    if request.playlist_url:
+        try:
+            title, playlist_urls = await expand_playlist(
+                request.playlist_url, config.BATCH_MAX_ITEMS, config.PLAYLIST_EXTRACT_TIMEOUT,
+            )
+        except PlaylistError as e:
+            raise HTTPException(status_code=400, detail=f"Не удалось получить плейлист: {e}")
+        urls.extend(playlist_urls)
+    if not urls:
+        raise HTTPException(status_code=400, detail="Нет ссылок для загрузки")
+    if len(urls) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Слишком много ссылок (максимум {config.BATCH_MAX_ITEMS})")
+    if request.playlist_url:
+        try:
+            # Каждое видео плейлиста — отдельная задача клиента
+            client_quotas.check(ip, is_job_running, len(urls))
+        except QuotaExceededError as e:
+            return quota_response(e)
+    
+    parallel = request.parallel or config.BATCH_PARALLEL
+    parallel = max(1, min(parallel, config.MAX_CONCURRENT_DOWNLOADS))
+    batch = Batch(
+        str(uuid.uuid4()),
+        [BatchItem(url, str(uuid.uuid4())) for url in urls],
+        parallel,
+        priority=request.priority,
+        title=title,
+        options=options,
+    )
+    for item in batch.items:
+        set_pending(item.download_id)
+        client_quotas.add_job(ip, item.download_id)
+    batches[batch.id] = batch
+    batch.task = asyncio.create_task(run_batch(batch))
+    
+    return {
+        "batch_id": batch.id,
+        "title": title,
+        "total": len(batch.items),
+        "items": [{"url": item.url, "download_id": item.download_id} for item in batch.items],
+    }
+
+def set_pending(download_id: str):
+    """Задача пакета, которая ещё не передана в общую очередь"""
+    set_progress(
+        download_id,
+        status="queued",
+        progress=0,
+        message="Ожидает в пакете...",
+        filename=None,
+        filepath=None,
+        queue_position=None,
+    )
+
+async def run_batch(batch: Batch):
+    """Передаёт задачи пакета в очередь, не больше batch.parallel одновременно"""
+    semaphore = asyncio.Semaphore(batch.parallel)
+    
+    async def run_item(item):
+        async with semaphore:
+            record = job_store.get(item.download_id)
+            if record is not None and record.error_type == "cancelled":
+                return
+            while True:
+                try:
+                    submit_download(item.url, batch.priority, download_id=item.download_id, options=batch.options)
+                    item.submitted = True
+                    break
+                except QueueFullError as e:
+                    # Общая очередь занята — ждём, пакет сам держит свои задачи
+                    set_pending(item.download_id)
+                    await asyncio.sleep(e.retry_after)
+                except NoSpaceError:
+                    set_progress(
+                        item.download_id,
+                        status="error",
+                        error_type="no_space",
+                        message="На сервере недостаточно места",
+                    )
+                    return
+            await wait_job_finished(resolve_job_id(item.download_id))
+    
+    try:
+        await asyncio.gather(*(run_item(item) for item in batch.items))
+    finally:
+        batch.finished_at = time.time()
+
+async def wait_job_finished(job_id: str):
+    """Ждёт, пока задача завершится (или исчезнет)"""
+    while True:
+        seen_version = progress_events.version(job_id)
+        record = job_store.get(job_id)
+        if record is None or record.status in FINISHED_STATUSES:
+            return
+        await progress_events.wait(job_id, seen_version, 5)
+
+def get_batch_data(batch: Batch):
+    """Прогресс каждой задачи пакета и общий итог"""
+    items = []
+    completed = failed = 0
+    progress_sum = 0
+    downloaded_bytes = 0
+    for item in batch.items:
+        record = job_store.get(resolve_job_id(item.download_id))
+        status = record.status if record is not None else "unknown"
+        if status == "completed":
+            completed += 1
+        elif status == "error":
+            failed += 1
+        if record is not None:
+            progress_sum += 100 if status == "completed" else (record.progress or 0)
+            downloaded_bytes += record.downloaded_bytes or 0
+        items.append({
+            "url": item.url,
+            "download_id": item.download_id,
+            "status": status,
+            "progress": record.progress if record is not None else 0,
+            "message": record.message if record is not None else None,
+            "filename": record.filename if record is not None else None,
+        })
+    
+    total = len(batch.items)
+    return {
+        "batch_id": batch.id,
+        "title": batch.title,
+        "status": "completed" if batch.finished_at is not None else "running",
+        "total": total,
+        "completed": completed,
+        "failed": failed,
+        "active": total - completed - failed,
+        "progress": round(progress_sum / total, 1) if total else 100,
+        "downloaded_bytes": downloaded_bytes,
+        "items": items,
+    }
+
+def get_batch(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch ID not found")
+    return batch
+
+@app.get("/api/batch/{batch_id}")
+async def get_batch_progress(batch_id: str):
+    """Прогресс пакета: по каждой задаче и общий"""
+    return get_batch_data(get_batch(batch_id))
+
+@app.get("/api/batch/{batch_id}/zip")
+async def download_batch_zip(batch_id: str):
+    """Отдаёт все готовые файлы пакета одним ZIP-архивом, собирая его на лету"""
+    batch = get_batch(batch_id)
+    if batch.finished_at is None:
+        raise HTTPException(status_code=409, detail="Batch is still running")
+    
+    files = []
+    seen_paths = set()   # Одна ссылка дважды — один файл (из кэша или общей задачи)
+    for item in batch.items:
+        record = job_store.get(resolve_job_id(item.download_id))
+        if record is None or record.status != "completed" or record.filepath in seen_paths:
+            continue
+        if record.filepath and os.path.exists(record.filepath):
+            seen_paths.add(record.filepath)
+            files.append((record.filename or os.path.basename(record.filepath), record.filepath))
+    if not files:
+        raise HTTPException(status_code=404, detail="No completed files in batch")
+    
+    filename = sanitize_filename(batch.title or "") or f"batch-{batch.id[:8]}"
+    return StreamingResponse(
+        iter_zip(files, config.STREAM_CHUNK_SIZE),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": content_disposition(f"{filename}.zip"),
+            "Cache-Control": "no-cache",
+        },
+    )
+
+@app.delete("/api/batch/{batch_id}")
+async def cleanup_batch(batch_id: str):
+    """Останавливает постановку задач пакета и удаляет его файлы"""
+    batch = get_batch(batch_id)
+    if batch.task is not None and not batch.task.done():
+        batch.task.cancel()
+    item_ids = {item.download_id for item in batch.items}
+    for item in batch.items:
+        if not item.submitted:
+            job_store.delete(item.download_id)
+            continue
+        job_id = resolve_job_id(item.download_id)
+        record = job_store.get(job_id)
+        if (record is not None and record.status not in FINISHED_STATUSES
+                and job_store.subscribers(job_id) <= item_ids):
+            # Загрузка нужна только этому пакету — сначала останавливаем её,
+            # чтобы не удалять файлы из-под выполняющейся задачи
+            cancel_job(job_id)
+        await cleanup_file(item.download_id)
+    del batches[batch_id]
+    return {"status": "deleted"}
+
+@app.get("/api/stats")
+async def get_stats():
+    """Состояние очереди, кэша, хранилища задач и временной папки"""
+    return {
+        "scheduler": scheduler.stats(),
+        "cache": result_cache.stats() if result_cache is not None else None,
+        "probe": probe_cache.stats(),
+        "transcode": transcode_pool.stats(),
+        "bandwidth": bandwidth.stats(),
+        "clients": client_quotas.stats(),
+        "jobs": job_store.stats(),
+        "storage": janitor.stats(),
+        "role": config.ROLE,
+        "broker": broker.stats() if broker is not None else None,
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    scheduler_stats = scheduler.stats()
+    metrics.QUEUE_DEPTH.set(scheduler_stats["queued"])
+    metrics.ACTIVE_JOBS.set(scheduler_stats["active"])
+    metrics.ACTIVE_SUBPROCESSES.set(len(active_processes))
+    metrics.TRANSCODE_ACTIVE.set(transcode_pool.active)
+    metrics.TRANSCODE_WAITING.set(transcode_pool.waiting)
+    if result_cache is not None:
+        cache_stats = result_cache.stats()
+        lookups = cache_stats["hits"] + cache_stats["misses"]
+        metrics.CACHE_HITS.set(cache_stats["hits"])
+        metrics.CACHE_MISSES.set(cache_stats["misses"])
+        metrics.CACHE_HIT_RATIO.set(cache_stats["hits"] / lookups if lookups else 0)
+        metrics.CACHE_BYTES.set(cache_stats["bytes"])
+    metrics.TEMP_BYTES.set(janitor.bytes_used)
+    metrics.TEMP_FREE_BYTES.set(janitor.free_bytes())
+    metrics.JOB_RECORDS.set(len(job_store))
+    return Response(generate_latest(metrics.REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/api/progress/{download_id}")
 async def get_progress(download_id: str):
     """Получает прогресс загрузки"""
-    if download_id not in download_progress:
+    progress_data = get_progress_data(resolve_job_id(download_id))
+    if progress_data is None:
         raise HTTPException(status_code=404, detail="Download ID not found")
     
-    return download_progress[download_id]
+    return progress_data
 
-@app.get("/api/download-file/{download_id}")
-async def download_file(download_id: str):
-    """Отдает файл клиенту для скачивания"""
-    if download_id not in download_progress:
+@app.get("/api/progress/{download_id}/stream")
+async def stream_progress(download_id: str, request: Request):
+    """Отправляет изменения прогресса через Server-Sent Events"""
+    job_id = resolve_job_id(download_id)
+    if job_id not in job_store:
         raise HTTPException(status_code=404, detail="Download ID not found")
     
-    progress_data = download_progress[download_id]
+    min_interval = 1.0 / config.PROGRESS_STREAM_MAX_RATE if config.PROGRESS_STREAM_MAX_RATE > 0 else 0
+    
+    async def event_stream():
+        last_payload = None
+        last_sent = 0.0
+        while True:
+            seen_version = progress_events.version(job_id)
+            progress_data = get_progress_data(job_id)
+            if progress_data is None:
+                break
+            payload = json.dumps(progress_data, ensure_ascii=False)
+            if payload != last_payload:
+                yield f"data: {payload}\n\n"
+                last_payload = payload
+                last_sent = time.monotonic()
+            
+            status = progress_data["status"]
+            if status in FINISHED_STATUSES:
+                break
+            
+            # Пока задача в очереди, позиция меняется без событий — проверяем чаще.
+            # Задачу другого воркера перечитываем из базы раз в секунду.
+            if not job_store.is_local(job_id):
+                timeout = 1
+            elif status == "queued":
+                timeout = 2
+            else:
+                timeout = config.PROGRESS_STREAM_KEEPALIVE
+            changed = await progress_events.wait(job_id, seen_version, timeout)
+            if await request.is_disconnected():
+                break
+            if not changed and timeout == config.PROGRESS_STREAM_KEEPALIVE:
+                yield ": keepalive\n\n"
+                continue
+            
+            # Сливаем частые обновления: не чаще PROGRESS_STREAM_MAX_RATE событий в секунду
+            delay = min_interval - (time.monotonic() - last_sent)
+            if delay > 0:
+                await asyncio.sleep(delay)
     
-    if progress_data["status"] != "completed":
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.api_route("/api/download-file/{download_id}", methods=["GET", "HEAD"])
+async def download_file(download_id: str, request: Request):
+    """Отдает файл клиенту для скачивания (с поддержкой Range и ETag)"""
+    record = job_store.get(resolve_job_id(download_id))
+    if record is None:
+        raise HTTPException(status_code=404, detail="Download ID not found")
+    
+    if record.status != "completed":
         raise HTTPException(status_code=400, detail="Download not completed")
     
-    filepath = progress_data.get("filepath")
+    filepath = record.filepath
+    if filepath and not os.path.exists(filepath) and record.worker and broker is not None:
+        # Файл на диске воркера, который его скачал
+        return await proxy_worker_file(record, request)
     if not filepath or not os.path.exists(filepath):
         raise HTTPException(status_code=404, detail="File not found")
     
-    filename = progress_data.get("filename", "video.mp4")
+    filename = record.filename or os.path.basename(filepath)
+    
+    # Байты отдаёт стоящий впереди веб-сервер, воркер в передаче не участвует
+    if config.FILE_OFFLOAD in ("x-accel", "x-sendfile"):
+        response = offload_response(
+            config.FILE_OFFLOAD, filepath, config.TEMP_DIR, config.ACCEL_REDIRECT_PREFIX, filename,
+        )
+        if response is not None:
+            return response
+    
+    # Range/206 для перемотки и докачки, ETag/Last-Modified для повторных запросов
+    return RangeFileResponse(filepath, request.headers, filename=filename)
+
+# Заголовки ответа воркера, которые передаются клиенту как есть
+_PROXY_HEADERS = (
+    "content-type", "content-length", "content-range", "content-disposition",
+    "accept-ranges", "etag", "last-modified", "cache-control",
+)
+
+def worker_url(record):
+    url = broker.worker_url(record.worker)
+    if not url:
+        raise HTTPException(status_code=404, detail="File not found: worker is not reachable")
+    return url.rstrip("/")
+
+async def proxy_worker_file(record, request: Request):
+    """Отдаёт файл с воркера: Range и условные заголовки передаются ему"""
+    headers = {
+        name: request.headers[name]
+        for name in ("range", "if-range", "if-none-match", "if-modified-since")
+        if name in request.headers
+    }
+    client = get_http_client()
+    try:
+        upstream = await client.send(
+            client.build_request(request.method, f"{worker_url(record)}/api/download-file/{record.id}", headers=headers),
+            stream=True,
+        )
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+        # Воркер не отвечает — возможно, перезапускается
+        raise HTTPException(status_code=503, detail=f"Worker is not reachable: {e}")
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Worker request failed: {e}")
+    return StreamingResponse(
+        upstream.aiter_raw(),
+        status_code=upstream.status_code,
+        headers={name: value for name, value in upstream.headers.items() if name in _PROXY_HEADERS},
+        background=BackgroundTask(upstream.aclose),
+    )
+
+def sniff_media_type(first_bytes: bytes):
+    """Определяет MIME-тип по первым байтам контейнера"""
+    if first_bytes[:1] == b'\x47':
+        return "video/mp2t"
+    if first_bytes[4:8] == b'ftyp':
+        return "video/mp4"
+    if first_bytes[:4] == b'\x1a\x45\xdf\xa3':
+        return "video/webm"
+    return "application/octet-stream"
+
+async def tail_file(job_id: str, f):
+    """Отдаёт файл по мере того, как yt-dlp его дописывает"""
+    try:
+        while True:
+            seen_version = progress_events.version(job_id)
+            chunk = f.read(config.STREAM_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+            
+            record = job_store.get(job_id)
+            if record is None or record.status in FINISHED_STATUSES:
+                # Загрузка закончилась — дочитываем то, что успело записаться
+                while True:
+                    chunk = f.read(config.STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+            
+            # Ждём следующего обновления прогресса (значит, файл подрос)
+            await progress_events.wait(job_id, seen_version, 0.5)
+    finally:
+        f.close()
+
+@app.get("/api/stream/{download_id}")
+async def stream_file(download_id: str, request: Request):
+    """Отдает файл клиенту, пока он ещё скачивается"""
+    job_id = resolve_job_id(download_id)
+    record = job_store.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Download ID not found")
+    
+    if record.status == "completed":
+        return await download_file(download_id, request)
+    if not record.streamable:
+        raise HTTPException(status_code=409, detail="Download was not started in stream mode")
     
-    # Убеждаемся, что имя файла безопасно для заголовков
-    safe_filename = filename.replace('"', '\\"')
+    # Ждём, пока yt-dlp создаст файл и запишет заголовок контейнера
+    deadline = time.monotonic() + config.STREAM_START_TIMEOUT
+    f = None
+    while f is None:
+        record = job_store.get(job_id)
+        if record.status == "completed":
+            return await download_file(download_id, request)
+        if record.status == "error":
+            raise HTTPException(status_code=400, detail=record.message)
+        if time.monotonic() > deadline:
+            raise HTTPException(status_code=504, detail="Download did not start in time")
+        
+        seen_version = progress_events.version(job_id)
+        path = active_outputs.get(job_id)
+        if path and os.path.exists(path) and os.path.getsize(path) >= 16:
+            f = open(path, 'rb')
+        else:
+            await progress_events.wait(job_id, seen_version, 0.5)
     
-    # Отдаем файл клиенту с правильными заголовками для скачивания
-    return FileResponse(
-        filepath,
-        media_type="video/mp4",
-        filename=filename,
+    media_type = sniff_media_type(f.read(16))
+    f.seek(0)
+    
+    filename = os.path.basename(f.name)
+    if media_type == "video/mp2t":
+        filename = os.path.splitext(filename)[0] + ".ts"
+    
+    return StreamingResponse(
+        tail_file(job_id, f),
+        media_type=media_type,
         headers={
-            "Content-Disposition": f'attachment; filename="{safe_filename}"; filename*=UTF-8\'\'{safe_filename}',
-            "Content-Type": "video/mp4",
-            "Cache-Control": "no-cache"
+            "Content-Disposition": content_disposition(filename),
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
         }
     )
 
+@app.delete("/api/download/{download_id}")
+async def cancel_download(download_id: str):
+    """Отменяет загрузку; процесс yt-dlp останавливается вместе с дочерними"""
+    job_id = resolve_job_id(download_id)
+    record = job_store.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Download ID not found")
+    if record.status in FINISHED_STATUSES:
+        # Готовый файл удаляется через /api/cleanup
+        return {"status": record.status}
+    
+    # Задача нужна и другим подписчикам — отписываем только этого клиента
+    subscribers = job_store.subscribers(job_id)
+    if subscribers - {download_id}:
+        job_store.unsubscribe(job_id, download_id)
+        if job_journal is not None:
+            job_journal.set_subscribers(job_id, subscribers - {download_id})
+        if download_id != job_id:
+            set_cancelled(download_id)
+            return {"status": "cancelled"}
+        # Отписался владелец задачи: она продолжается для остальных
+        return {"status": "released"}
+    
+    if runs_elsewhere(job_id, record):
+        raise HTTPException(status_code=409, detail="Download is running in another server process, retry later")
+    cancel_job(job_id)
+    metrics.JOBS.labels("cancelled").inc()
+    return {"status": "cancelled"}
+
 @app.delete("/api/cleanup/{download_id}")
 async def cleanup_file(download_id: str):
     """Удаляет временный файл после скачивания"""
-    if download_id not in download_progress:
+    job_id = resolve_job_id(download_id)
+    record = job_store.get(job_id)
+    if record is None:
         return {"status": "not_found"}
     
-    progress_data = download_progress[download_id]
-    filepath = progress_data.get("filepath")
+    # Клиент забрал файл: объём ему уже засчитан при завершении задачи
+    if record.status in FINISHED_STATUSES:
+        client_quotas.forget(download_id)
+    
+    # Последний подписчик уходит от загрузки другого процесса: остановить её отсюда
+    # нельзя, а удалить её рабочую папку — значит испортить загрузку
+    if runs_elsewhere(job_id, record) and job_store.subscribers(job_id) <= {download_id}:
+        raise HTTPException(status_code=409, detail="Download is running in another server process, retry later")
+    
+    # Файл удаляется только когда от него отписался последний подписчик
+    if job_store.unsubscribe(job_id, download_id):
+        return {"status": "released"}
+    if record.status not in FINISHED_STATUSES:
+        # Файл ещё качается, но больше никому не нужен — останавливаем загрузку
+        drop_inflight(job_id)
+        cancel_job(job_id)
+        metrics.JOBS.labels("cancelled").inc()
+        return {"status": "cancelled"}
+    
+    if config.ROLE == "api" and record.worker:
+        # Файл удаляет воркер, у которого он лежит
+        try:
+            response = await get_http_client().delete(f"{worker_url(record)}/api/cleanup/{job_id}")
+            return response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            return {"status": "error", "message": str(e)}
+    return release_job_file(job_id)
+
+def release_job_file(job_id: str, record=None):
+    """Удаляет файл задачи (или освобождает запись кэша)"""
+    record = record or job_store.get(job_id)
+    filepath = record.filepath if record is not None else None
+    
+    # Файлы из кэша не удаляем, только освобождаем их для вытеснения
+    if result_cache is not None and result_cache.owns(filepath):
+        result_cache.release(job_id)
+        return {"status": "released"}
     
     if filepath and os.path.exists(filepath):
         try:
             os.remove(filepath)
+            shutil.rmtree(job_work_dir(job_id), ignore_errors=True)
             return {"status": "deleted"}
         except Exception as e:
             return {"status": "error", "message": str(e)}
     
+    shutil.rmtree(job_work_dir(job_id), ignore_errors=True)
     return {"status": "no_file"}
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+"""Пакетные загрузки: разворачивание плейлиста и отдача результатов одним ZIP"""
+import asyncio
+import json
+import os
+import time
+import zipfile
+
+
+class PlaylistError(Exception):
+    """Не удалось получить список видео плейлиста"""
+
+
+class BatchItem:
+    __slots__ = ("url", "download_id", "submitted")
+
+    def __init__(self, url, download_id):
+        self.url = url
+        self.download_id = download_id
+        self.submitted = False   # Передана ли в общую очередь
+
+
+class Batch:
+    """Набор загрузок под одним batch_id"""
+
+    def __init__(self, batch_id, items, parallel, priority=0, title=None, options=None):
+        self.id = batch_id
+        self.items = items
+        self.parallel = parallel
+        self.priority = priority
+        self.title = title
+        self.options = options     # Параметры формата, общие для всех видео пакета
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+
+
+async def expand_playlist(url, max_items, timeout):
+    """Получает ссылки на видео плейлиста одним вызовом yt-dlp.
+
+    Возвращает (название, [ссылки]). Если ссылка не на плейлист — список из неё самой.
+    """
+    process = await asyncio.create_subprocess_exec(
+        "yt-dlp",
+        "--flat-playlist",        # Только список, без извлечения каждого видео
+        "--dump-single-json",
+        "--no-warnings",
+        "--playlist-end", str(max_items),
+        url,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise PlaylistError(f"Плейлист не получен за {timeout} с")
+    if process.returncode != 0:
+        lines = stderr.decode("utf-8", errors="ignore").strip().splitlines()
+        raise PlaylistError(lines[-1] if lines else "yt-dlp завершился с ошибкой")
+
+    try:
+        info = json.loads(stdout)
+    except ValueError:
+        raise PlaylistError("yt-dlp вернул некорректный JSON")
+    if info.get("_type") != "playlist":
+        return info.get("title"), [info.get("webpage_url") or url]
+
+    urls = []
+    for entry in info.get("entries") or []:
+        entry_url = entry and (entry.get("url") or entry.get("webpage_url"))
+        if entry_url:
+            urls.append(entry_url)
+    return info.get("title"), urls[:max_items]
+
+
+class _ZipSink:
+    """Приёмник для zipfile без seek: накапливает записанное до выдачи клиенту"""
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def iter_zip(files, chunk_size):
+    """Собирает ZIP (без сжатия — видео и так сжато) по мере отдачи.
+
+    files — список (имя в архиве, путь). Генератор синхронный: StreamingResponse
+    выполняет его в пуле потоков, чтобы чтение файлов не блокировало event loop.
+    """
+    sink = _ZipSink()
+    used_names = set()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, path in files:
+            # Одинаковые названия видео в плейлисте — не редкость
+            base, ext = os.path.splitext(name)
+            counter = 2
+            while name in used_names:
+                name = f"{base} ({counter}){ext}"
+                counter += 1
+            used_names.add(name)
+
+            with open(path, "rb") as src, archive.open(name, "w", force_zip64=True) as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield from sink.drain()
+    yield from sink.drain()
@@ -0,0 +1,534 @@
+"""Нагрузочный тест: локальный источник синтетического видео и прогон задач через API.
+
+Поднимает HTTP-источник с прогрессивным MP4 и HLS (в памяти), запускает сервер
+(uvicorn app:app) с отдельной временной папкой и гоняет цикл
+POST /api/download -> /api/progress -> /api/download-file -> /api/cleanup
+с заданной параллельностью. Результат — JSON, чтобы сравнивать коммиты:
+
+    python bench.py --jobs 40 --concurrency 8 --kind mp4 --output bench.json
+    python bench.py --kind hls --engine inprocess --env VD_SEGMENTED_ENABLED=0
+
+Потребление памяти и процессора читается из /proc (Linux) по всему дереву
+процессов сервера, включая yt-dlp и воркеры встроенного движка.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+FINISHED_STATUSES = ("completed", "error")
+
+
+# --- Источник видео ---
+
+def make_mp4(size):
+    """Прогрессивный «MP4»: заголовок ftyp, пустой индекс moov и mdat со случайными байтами"""
+    ftyp = b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isommp42"
+    moov = b"\x00\x00\x00\x08moov"
+    payload = max(size - len(ftyp) - len(moov) - 8, 0)
+    return ftyp + moov + (payload + 8).to_bytes(4, "big") + b"mdat" + os.urandom(payload)
+
+
+def make_ts_segment(size):
+    """Фрагмент MPEG-TS: пакеты по 188 байт с байтом синхронизации 0x47"""
+    packets = max(size // 188, 1)
+    return b"".join(b"\x47" + os.urandom(187) for _ in range(packets))
+
+
+def make_playlist(segments, duration):
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{duration}", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for index in range(segments):
+        lines += [f"#EXTINF:{duration}.0,", f"seg{index}.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Отдаёт файлы из files (путь -> байты) с поддержкой Range и ограничением скорости"""
+
+    protocol_version = "HTTP/1.1"
+    files = {}
+    rate = 0          # Байт в секунду на соединение, 0 — без ограничения
+    chunk_size = 64 * 1024
+    requests = 0
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body):
+        OriginHandler.requests += 1
+        data = self.files.get(self.path.split("?", 1)[0])
+        if data is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            if first.isdigit():
+                start = int(first)
+                end = min(int(last), end) if last.isdigit() else end
+        if start > end:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(data)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206 if range_header else 200)
+        content_type = "application/vnd.apple.mpegurl" if self.path.endswith(".m3u8") else (
+            "video/mp2t" if ".ts" in self.path else "video/mp4")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if range_header:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        if not body:
+            return
+
+        view = memoryview(data)[start:end + 1]
+        try:
+            for offset in range(0, len(view), self.chunk_size):
+                self.wfile.write(view[offset:offset + self.chunk_size])
+                if self.rate:
+                    time.sleep(self.chunk_size / self.rate)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиенты обрывают соединения (отмена, докачка) — это не ошибка источника
+        pass
+
+
+def start_origin(mp4_size, segments, segment_size, rate):
+    """Запускает источник в фоновом потоке; возвращает (сервер, базовый URL)"""
+    OriginHandler.files = {
+        "/video.mp4": make_mp4(mp4_size),
+        "/hls/index.m3u8": make_playlist(segments, 2),
+    }
+    segment = make_ts_segment(segment_size)
+    for index in range(segments):
+        OriginHandler.files[f"/hls/seg{index}.ts"] = segment
+    OriginHandler.rate = rate
+
+    server = OriginServer(("127.0.0.1", 0), OriginHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --- Ресурсы сервера ---
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _read_stat(pid):
+    """(ppid, процессорное время с завершёнными потомками в секундах, RSS в байтах) или None"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Имя процесса в скобках может содержать пробелы
+    fields = stat[stat.rindex(")") + 2:].split()
+    ppid = int(fields[1])
+    utime, stime, cutime, cstime = (int(value) for value in fields[11:15])
+    rss = int(fields[21]) * _PAGE_SIZE
+    return ppid, (utime + stime + cutime + cstime) / _CLOCK_TICKS, rss
+
+
+def process_tree_usage(root_pid):
+    """Процессорное время и RSS процесса root_pid и всех его потомков.
+
+    Возвращает (cpu_seconds, rss корня, rss дерева); None, если /proc недоступен.
+    """
+    root = _read_stat(root_pid)
+    if root is None:
+        return None
+    stats = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            stat = _read_stat(int(name))
+            if stat is not None:
+                stats[int(name)] = stat
+    stats[root_pid] = root
+
+    children = {}
+    for pid, (ppid, _, _) in stats.items():
+        children.setdefault(ppid, []).append(pid)
+    cpu = rss = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        _, pid_cpu, pid_rss = stats[pid]
+        cpu += pid_cpu
+        rss += pid_rss
+        pending += children.get(pid, [])
+    return cpu, root[2], rss
+
+
+class ResourceSampler:
+    """Периодически замеряет RSS дерева процессов сервера и запоминает пик"""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_tree_rss = 0
+        self.samples = 0
+
+    def usage(self):
+        usage = process_tree_usage(self.pid) if self.pid else None
+        if usage is not None:
+            self.samples += 1
+            self.peak_rss = max(self.peak_rss, usage[1])
+            self.peak_tree_rss = max(self.peak_tree_rss, usage[2])
+        return usage
+
+    async def run(self):
+        while True:
+            self.usage()
+            await asyncio.sleep(self.interval)
+
+
+# --- Сервер ---
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, env):
+    """Запускает uvicorn app:app из папки проекта с дополнительными переменными env"""
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, **env},
+    )
+
+
+async def wait_ready(client, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился с кодом {process.returncode}")
+        try:
+            if (await client.get("/api/stats")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"Сервер не ответил за {timeout} с")
+
+
+# --- Нагрузка ---
+
+class Recorder:
+    """Замеры всех задач и запросов прогресса"""
+
+    def __init__(self):
+        self.jobs = []
+        self.progress_latencies = []
+        self.rejected = 0
+
+
+async def run_job(client, url, poll_interval, recorder, expected_size=None):
+    """Одна задача от постановки до удаления файла; замеры — в recorder.jobs"""
+    job = {"status": None, "error": None}
+    started = time.monotonic()
+    while True:
+        response = await client.post("/api/download", json={"url": url})
+        if response.status_code != 429:
+            break
+        recorder.rejected += 1
+        await asyncio.sleep(float(response.headers.get("retry-after") or 1))
+    if response.status_code != 200:
+        job.update(status="error", error=f"POST /api/download: {response.status_code} {response.text[:200]}")
+        recorder.jobs.append(job)
+        return
+    download_id = response.json()["download_id"]
+    job["accepted"] = time.monotonic() - started
+
+    while True:
+        sent = time.monotonic()
+        response = await client.get(f"/api/progress/{download_id}")
+        recorder.progress_latencies.append(time.monotonic() - sent)
+        progress = response.json()
+        if "first_byte" not in job and (progress.get("downloaded_bytes") or progress.get("progress")):
+            job["first_byte"] = time.monotonic() - started
+        if progress.get("status") in FINISHED_STATUSES:
+            break
+        await asyncio.sleep(poll_interval)
+    job["complete"] = time.monotonic() - started
+    job["status"] = progress["status"]
+    if progress["status"] != "completed":
+        job["error"] = progress.get("message")
+        recorder.jobs.append(job)
+        await client.delete(f"/api/cleanup/{download_id}")
+        return
+    # Задача без промежуточного прогресса (маленький файл) — первый байт не позже конца
+    job.setdefault("first_byte", job["complete"])
+
+    sent = time.monotonic()
+    size = 0
+    async with client.stream("GET", f"/api/download-file/{download_id}") as response:
+        async for chunk in response.aiter_bytes():
+            if size == 0:
+                job["file_ttfb"] = time.monotonic() - sent
+            size += len(chunk)
+    job["file_seconds"] = time.monotonic() - sent
+    job["file_bytes"] = size
+    if response.status_code != 200 or (expected_size is not None and size != expected_size):
+        job["status"] = "error"
+        job["error"] = f"download-file: {response.status_code}, {size} байт вместо {expected_size}"
+
+    sent = time.monotonic()
+    await client.delete(f"/api/cleanup/{download_id}")
+    job["cleanup"] = time.monotonic() - sent
+    job["total"] = time.monotonic() - started
+    recorder.jobs.append(job)
+
+
+async def hammer_progress(client, download_id, seconds, concurrency):
+    """Максимальная частота ответов /api/progress: concurrency клиентов в течение seconds"""
+    latencies = []
+    deadline = time.monotonic() + seconds
+
+    async def worker():
+        while time.monotonic() < deadline:
+            sent = time.monotonic()
+            await client.get(f"/api/progress/{download_id}")
+            latencies.append(time.monotonic() - sent)
+
+    started = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - started
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "rate_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency": summarize(latencies),
+    }
+
+
+def percentile(values, q):
+    """Процентиль по ближайшему рангу"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "max": round(max(values), 4),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run_benchmark(args):
+    origin, origin_url = start_origin(args.mp4_size, args.segments, args.segment_size, args.origin_rate)
+    if args.kind == "mp4":
+        source, expected_size = f"{origin_url}/video.mp4", args.mp4_size
+    else:
+        source, expected_size = f"{origin_url}/hls/index.m3u8", None
+
+    process = None
+    temp_dir = None
+    base_url = args.server
+    if base_url is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="vd_bench_")
+        port = free_port()
+        env = {
+            "VD_TEMP_DIR": temp_dir.name,
+            "VD_ENGINE": args.engine,
+            "VD_CACHE_ENABLED": "0",      # Каждая задача качается заново
+            "VD_JOURNAL_ENABLED": "0",
+            "VD_MAX_CONCURRENT_DOWNLOADS": str(args.concurrency),
+            "VD_MAX_DOWNLOADS_PER_HOST": str(args.concurrency),   # Все задачи с одного источника
+            "VD_MAX_QUEUE_SIZE": str(max(args.jobs, 100)),
+            "VD_CLIENT_MAX_ACTIVE_JOBS": "0",
+            "VD_CLIENT_MAX_BYTES_PER_HOUR": "0",
+            "VD_MEDIA_VALIDATE": "0",     # Синтетические байты ffprobe не разберёт
+        }
+        env.update(item.split("=", 1) for item in args.env)
+        process = start_server(port, env)
+        base_url = f"http://127.0.0.1:{port}"
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2 + args.progress_concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits, trust_env=False) as client:
+            await wait_ready(client, process)
+            sampler = ResourceSampler(process.pid if process is not None else args.server_pid)
+            usage_before = sampler.usage()
+            sampler_task = asyncio.create_task(sampler.run())
+
+            recorder = Recorder()
+            slots = asyncio.Semaphore(args.concurrency)
+
+            async def one(index):
+                async with slots:
+                    # Разные URL: кэш и объединение одинаковых запросов не срабатывают
+                    url = f"{source}?bench={index}"
+                    try:
+                        await asyncio.wait_for(
+                            run_job(client, url, args.poll_interval, recorder, expected_size), args.timeout,
+                        )
+                    except (asyncio.TimeoutError, httpx.HTTPError) as e:
+                        recorder.jobs.append({"status": "error", "error": f"{type(e).__name__}: {e}"})
+
+            started = time.monotonic()
+            await asyncio.gather(*[one(index) for index in range(args.jobs)])
+            wall = time.monotonic() - started
+            usage_after = sampler.usage()
+
+            hammer = None
+            if args.progress_seconds > 0:
+                # Отдельный замер на задаче, которая уже есть в хранилище
+                response = await client.post("/api/download", json={"url": f"{source}?bench=progress"})
+                if response.status_code == 200:
+                    hammer = await hammer_progress(
+                        client, response.json()["download_id"], args.progress_seconds, args.progress_concurrency,
+                    )
+                    await client.delete(f"/api/cleanup/{response.json()['download_id']}")
+
+            sampler_task.cancel()
+            server_stats = (await client.get("/api/stats")).json()
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        origin.shutdown()
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    completed = [job for job in recorder.jobs if job["status"] == "completed"]
+    errors = [job["error"] for job in recorder.jobs if job["status"] != "completed"]
+    resources = None
+    if usage_before is not None and usage_after is not None:
+        cpu = usage_after[0] - usage_before[0]
+        resources = {
+            "cpu_seconds": round(cpu, 3),
+            "cpu_per_job_s": round(cpu / len(completed), 4) if completed else None,
+            "rss_bytes": usage_after[1],
+            "rss_peak_bytes": sampler.peak_rss,
+            "tree_rss_peak_bytes": sampler.peak_tree_rss,
+            "samples": sampler.samples,
+        }
+    return {
+        "revision": git_revision(),
+        "config": {
+            "kind": args.kind,
+            "engine": args.engine if args.server is None else None,
+            "jobs": args.jobs,
+            "concurrency": args.concurrency,
+            "mp4_size": args.mp4_size,
+            "segments": args.segments,
+            "segment_size": args.segment_size,
+            "origin_rate": args.origin_rate,
+            "poll_interval": args.poll_interval,
+            "env": args.env,
+        },
+        "wall_seconds": round(wall, 3),
+        "jobs": {
+            "completed": len(completed),
+            "failed": len(errors),
+            "rejected_429": recorder.rejected,
+            "per_second": round(len(completed) / wall, 3) if wall else None,
+            "errors": errors[:10],
+        },
+        "time_to_complete": summarize([job["complete"] for job in completed]),
+        "time_to_first_byte": summarize([job["first_byte"] for job in completed]),
+        "time_accepted": summarize([job["accepted"] for job in recorder.jobs if "accepted" in job]),
+        "file_ttfb": summarize([job["file_ttfb"] for job in completed if "file_ttfb" in job]),
+        "file_seconds": summarize([job["file_seconds"] for job in completed]),
+        "cleanup": summarize([job["cleanup"] for job in completed]),
+        "progress": {
+            "requests": len(recorder.progress_latencies),
+            "rate_per_s": round(len(recorder.progress_latencies) / wall, 1) if wall else None,
+            "latency": summarize(recorder.progress_latencies),
+            "max_rate": hammer,
+        },
+        "server": resources,
+        "origin_requests": OriginHandler.requests,
+        "stats": server_stats,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест загрузчика на синтетическом видео")
+    parser.add_argument("--kind", choices=("mp4", "hls"), default="mp4", help="Что качать: прогрессивный MP4 или HLS")
+    parser.add_argument("--jobs", type=int, default=20, help="Сколько задач выполнить")
+    parser.add_argument("--concurrency", type=int, default=4, help="Сколько задач одновременно")
+    parser.add_argument("--engine", choices=("subprocess", "inprocess"), default="subprocess")
+    parser.add_argument("--mp4-size", type=int, default=4 * 1024 * 1024, help="Размер MP4, байт")
+    parser.add_argument("--segments", type=int, default=10, help="Фрагментов в HLS")
+    parser.add_argument("--segment-size", type=int, default=256 * 1024, help="Размер фрагмента HLS, байт")
+    parser.add_argument("--origin-rate", type=int, default=0, help="Скорость источника на соединение, байт/с (0 — без ограничения)")
+    parser.add_argument("--poll-interval", type=float, default=0.25, help="Как часто опрашивать /api/progress, сек")
+    parser.add_argument("--progress-seconds", type=float, default=3, help="Длительность замера предельной частоты /api/progress (0 — пропустить)")
+    parser.add_argument("--progress-concurrency", type=int, default=16, help="Клиентов в замере /api/progress")
+    parser.add_argument("--timeout", type=float, default=300, help="Предельное время одной задачи, сек")
+    parser.add_argument("--env", action="append", default=[], metavar="VD_NAME=VALUE",
+                        help="Переменная окружения для сервера (можно несколько раз)")
+    parser.add_argument("--server", help="URL уже запущенного сервера вместо запуска своего")
+    parser.add_argument("--server-pid", type=int, help="PID уже запущенного сервера для замера памяти и процессора")
+    parser.add_argument("--output", help="Куда записать JSON (по умолчанию — stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run_benchmark(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if result["jobs"]["completed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
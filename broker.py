@@ -0,0 +1,443 @@
+"""Общая очередь задач для раздельного режима: API-узлы ставят задачи, воркеры берут их в аренду.
+
+Воркер арендует задачу на lease_seconds и продлевает аренду пульсом. Если
+воркер пропал, аренда истекает и задача возвращается в очередь для другого
+воркера (не больше max_attempts попыток).
+"""
+import json
+import sqlite3
+import threading
+import time
+
+
+class BrokerError(Exception):
+    """Брокер недоступен или не настроен"""
+
+
+class BrokerJob:
+    __slots__ = ("id", "url", "options", "cache_key", "priority", "attempts")
+
+    def __init__(self, id, url, options, cache_key=None, priority=0, attempts=0):
+        self.id = id
+        self.url = url
+        self.options = options
+        self.cache_key = cache_key
+        self.priority = priority
+        self.attempts = attempts
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS broker_jobs (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    options TEXT NOT NULL,
+    cache_key TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    cancel INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS broker_jobs_queue ON broker_jobs (worker, priority, seq);
+CREATE TABLE IF NOT EXISTS broker_workers (
+    id TEXT PRIMARY KEY,
+    url TEXT,
+    active INTEGER NOT NULL DEFAULT 0,
+    heartbeat_at REAL NOT NULL
+);
+"""
+
+
+class SqliteBroker:
+    """Очередь в SQLite (WAL): для нескольких процессов на одной машине и для проверки.
+
+    Аренда — строка с worker и lease_until; выдача задач идёт в транзакции
+    BEGIN IMMEDIATE, поэтому одну задачу не получат два воркера.
+    """
+
+    def __init__(self, path, lease_seconds, max_attempts):
+        self.path = str(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def enqueue(self, job_id, url, options, cache_key=None, priority=0):
+        def insert(conn):
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM broker_jobs").fetchone()[0]
+            conn.execute(
+                "INSERT OR REPLACE INTO broker_jobs (id, url, options, cache_key, priority, seq) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, url, json.dumps(options, ensure_ascii=False), cache_key, priority, seq),
+            )
+        self._transaction(insert)
+
+    def lease(self, worker_id, limit):
+        """Выдаёт воркеру до limit задач (больше приоритет — раньше, внутри — FIFO)"""
+        if limit <= 0:
+            return []
+        lease_until = time.time() + self.lease_seconds
+
+        def take(conn):
+            rows = conn.execute(
+                "SELECT id, url, options, cache_key, priority, attempts FROM broker_jobs"
+                " WHERE worker IS NULL ORDER BY priority DESC, seq LIMIT ?",
+                (limit,),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE broker_jobs SET worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                [(worker_id, lease_until, row[0]) for row in rows],
+            )
+            return rows
+
+        return [
+            BrokerJob(job_id, url, json.loads(options), cache_key, priority, attempts + 1)
+            for job_id, url, options, cache_key, priority, attempts in self._transaction(take)
+        ]
+
+    def heartbeat(self, worker_id, url, job_ids):
+        """Отмечает воркер живым и продлевает аренду его задач.
+
+        Возвращает (отменённые клиентом, потерянные — аренду уже отдали другому воркеру).
+        """
+        now = time.time()
+
+        def beat(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO broker_workers (id, url, active, heartbeat_at) VALUES (?, ?, ?, ?)",
+                (worker_id, url, len(job_ids), now),
+            )
+            cancelled, lost = [], []
+            for job_id in job_ids:
+                row = conn.execute("SELECT worker, cancel FROM broker_jobs WHERE id = ?", (job_id,)).fetchone()
+                if row is None or row[0] != worker_id:
+                    lost.append(job_id)
+                    continue
+                if row[1]:
+                    cancelled.append(job_id)
+                conn.execute("UPDATE broker_jobs SET lease_until = ? WHERE id = ?", (now + self.lease_seconds, job_id))
+            return cancelled, lost
+
+        return self._transaction(beat)
+
+    def complete(self, job_id, worker_id):
+        """Задача дошла до конца (успешно или с ошибкой) — убирает её из очереди"""
+        self._transaction(lambda conn: conn.execute(
+            "DELETE FROM broker_jobs WHERE id = ? AND worker = ?", (job_id, worker_id),
+        ))
+
+    def release(self, job_id, worker_id):
+        """Возвращает задачу в очередь без траты попытки (воркер останавливается)"""
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE broker_jobs SET worker = NULL, lease_until = NULL, attempts = MAX(attempts - 1, 0)"
+            " WHERE id = ? AND worker = ?",
+            (job_id, worker_id),
+        ))
+
+    def cancel(self, job_id):
+        """Отменяет задачу: "queued" — убрана из очереди, "leased" — воркер остановит её
+        по следующему пульсу, None — такой задачи нет"""
+        def mark(conn):
+            row = conn.execute("SELECT worker FROM broker_jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] is None:
+                conn.execute("DELETE FROM broker_jobs WHERE id = ?", (job_id,))
+                return "queued"
+            conn.execute("UPDATE broker_jobs SET cancel = 1 WHERE id = ?", (job_id,))
+            return "leased"
+        return self._transaction(mark)
+
+    def requeue_expired(self):
+        """Возвращает в очередь задачи с истёкшей арендой.
+
+        Возвращает {"requeued": [...], "failed": [...], "cancelled": [...]}: failed —
+        исчерпали попытки, cancelled — отменены, пока их воркер был недоступен.
+        """
+        def sweep(conn):
+            result = {"requeued": [], "failed": [], "cancelled": []}
+            rows = conn.execute(
+                "SELECT id, attempts, cancel FROM broker_jobs WHERE worker IS NOT NULL AND lease_until < ?",
+                (time.time(),),
+            ).fetchall()
+            for job_id, attempts, cancel in rows:
+                if cancel or attempts >= self.max_attempts:
+                    conn.execute("DELETE FROM broker_jobs WHERE id = ?", (job_id,))
+                    result["cancelled" if cancel else "failed"].append(job_id)
+                else:
+                    conn.execute("UPDATE broker_jobs SET worker = NULL, lease_until = NULL WHERE id = ?", (job_id,))
+                    result["requeued"].append(job_id)
+            return result
+        return self._transaction(sweep)
+
+    def position(self, job_id):
+        """Позиция задачи в общей очереди (с 1) или None, если она не ждёт"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT priority, seq FROM broker_jobs WHERE id = ? AND worker IS NULL", (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM broker_jobs WHERE worker IS NULL AND (priority > ? OR (priority = ? AND seq <= ?))",
+                (row[0], row[0], row[1]),
+            ).fetchone()[0]
+
+    def worker_url(self, worker_id):
+        with self._lock:
+            row = self._conn.execute("SELECT url FROM broker_workers WHERE id = ?", (worker_id,)).fetchone()
+        return row[0] if row else None
+
+    def workers(self):
+        """Воркеры, от которых был пульс за последние три срока аренды"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, url, active, heartbeat_at FROM broker_workers WHERE heartbeat_at > ? ORDER BY id",
+                (time.time() - 3 * self.lease_seconds,),
+            ).fetchall()
+        return [{"id": r[0], "url": r[1], "active": r[2], "heartbeat_at": r[3]} for r in rows]
+
+    def stats(self):
+        with self._lock:
+            queued, leased = self._conn.execute(
+                "SELECT COUNT(*) - COUNT(worker), COUNT(worker) FROM broker_jobs",
+            ).fetchone()
+        return {"backend": "sqlite", "queued": queued, "leased": leased, "workers": self.workers()}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Скрипты Lua выполняются в Redis атомарно, как транзакции SqliteBroker
+_LEASE_SCRIPT = """
+local ids = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+local jobs = {}
+for _, id in ipairs(ids) do
+    local key = ARGV[4] .. 'job:' .. id
+    redis.call('ZREM', KEYS[1], id)
+    -- Задачу без описания (удалена между постановкой и выдачей) не выдаём
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZADD', KEYS[2], ARGV[3], id)
+        redis.call('HSET', key, 'worker', ARGV[1])
+        local attempts = redis.call('HINCRBY', key, 'attempts', 1)
+        local fields = redis.call('HMGET', key, 'url', 'options', 'cache_key', 'priority')
+        table.insert(jobs, {id, fields[1] or '', fields[2] or '{}', fields[3] or '', fields[4] or '0', attempts})
+    end
+end
+return jobs
+"""
+
+_HEARTBEAT_SCRIPT = """
+local cancelled, lost = {}, {}
+for i = 4, #ARGV do
+    local id = ARGV[i]
+    local key = ARGV[3] .. 'job:' .. id
+    if redis.call('HGET', key, 'worker') ~= ARGV[1] then
+        table.insert(lost, id)
+    else
+        if redis.call('HGET', key, 'cancel') == '1' then
+            table.insert(cancelled, id)
+        end
+        redis.call('ZADD', KEYS[1], 'XX', ARGV[2], id)
+    end
+end
+return {cancelled, lost}
+"""
+
+_COMPLETE_SCRIPT = """
+local key = ARGV[3] .. 'job:' .. ARGV[1]
+if redis.call('HGET', key, 'worker') ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+if ARGV[4] == '1' then
+    redis.call('HDEL', key, 'worker')
+    redis.call('HINCRBY', key, 'attempts', -1)
+    redis.call('ZADD', KEYS[2], redis.call('HGET', key, 'score'), ARGV[1])
+else
+    redis.call('DEL', key)
+end
+return 1
+"""
+
+_CANCEL_SCRIPT = """
+local key = ARGV[2] .. 'job:' .. ARGV[1]
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('DEL', key)
+    return 'queued'
+end
+if redis.call('EXISTS', key) == 1 then
+    redis.call('HSET', key, 'cancel', '1')
+    return 'leased'
+end
+return false
+"""
+
+_REQUEUE_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local requeued, failed, cancelled = {}, {}, {}
+for _, id in ipairs(ids) do
+    local key = ARGV[3] .. 'job:' .. id
+    redis.call('ZREM', KEYS[1], id)
+    if redis.call('HGET', key, 'cancel') == '1' then
+        redis.call('DEL', key)
+        table.insert(cancelled, id)
+    elseif tonumber(redis.call('HGET', key, 'attempts') or '0') >= tonumber(ARGV[2]) then
+        redis.call('DEL', key)
+        table.insert(failed, id)
+    else
+        redis.call('HDEL', key, 'worker')
+        redis.call('ZADD', KEYS[2], redis.call('HGET', key, 'score'), id)
+        table.insert(requeued, id)
+    end
+end
+return {requeued, failed, cancelled}
+"""
+
+
+class RedisBroker:
+    """Очередь в Redis: для воркеров на разных машинах.
+
+    Очередь — ZSET (порядок по приоритету и номеру), аренды — ZSET со сроком,
+    задача — HASH. Нужен пакет redis (pip install redis).
+    """
+
+    def __init__(self, url, lease_seconds, max_attempts, prefix="vd:", client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise BrokerError("Для VD_BROKER=redis нужен пакет redis: pip install redis") from None
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.prefix = prefix
+        self._redis = client
+        self._queue = prefix + "queue"
+        self._leases = prefix + "leases"
+        self._lease_script = client.register_script(_LEASE_SCRIPT)
+        self._heartbeat_script = client.register_script(_HEARTBEAT_SCRIPT)
+        self._complete_script = client.register_script(_COMPLETE_SCRIPT)
+        self._cancel_script = client.register_script(_CANCEL_SCRIPT)
+        self._requeue_script = client.register_script(_REQUEUE_SCRIPT)
+
+    def _job_key(self, job_id):
+        return f"{self.prefix}job:{job_id}"
+
+    def enqueue(self, job_id, url, options, cache_key=None, priority=0):
+        # Больше приоритет — меньше score; внутри приоритета — по номеру постановки
+        seq = self._redis.incr(self.prefix + "seq")
+        score = -priority * 10 ** 12 + seq
+        pipe = self._redis.pipeline()
+        pipe.hset(self._job_key(job_id), mapping={
+            "url": url,
+            "options": json.dumps(options, ensure_ascii=False),
+            "cache_key": cache_key or "",
+            "priority": priority,
+            "score": score,
+            "attempts": 0,
+            "cancel": 0,
+        })
+        pipe.zadd(self._queue, {job_id: score})
+        pipe.execute()
+
+    def lease(self, worker_id, limit):
+        if limit <= 0:
+            return []
+        # Поля задачи возвращает сам скрипт: отдельный HGETALL после него мог бы
+        # не найти задачу, которую тем временем отменили
+        rows = self._lease_script(
+            keys=[self._queue, self._leases],
+            args=[worker_id, limit, time.time() + self.lease_seconds, self.prefix],
+        )
+        return [
+            BrokerJob(job_id, url, json.loads(options), cache_key or None, int(priority or 0), int(attempts))
+            for job_id, url, options, cache_key, priority, attempts in rows
+        ]
+
+    def heartbeat(self, worker_id, url, job_ids):
+        worker_key = f"{self.prefix}worker:{worker_id}"
+        pipe = self._redis.pipeline()
+        pipe.hset(worker_key, mapping={"url": url or "", "active": len(job_ids), "heartbeat_at": time.time()})
+        pipe.expire(worker_key, 3 * self.lease_seconds)
+        pipe.sadd(self.prefix + "workers", worker_id)
+        pipe.execute()
+        cancelled, lost = self._heartbeat_script(
+            keys=[self._leases],
+            args=[worker_id, time.time() + self.lease_seconds, self.prefix, *job_ids],
+        )
+        return cancelled, lost
+
+    def complete(self, job_id, worker_id):
+        self._complete_script(keys=[self._leases, self._queue], args=[job_id, worker_id, self.prefix, 0])
+
+    def release(self, job_id, worker_id):
+        self._complete_script(keys=[self._leases, self._queue], args=[job_id, worker_id, self.prefix, 1])
+
+    def cancel(self, job_id):
+        return self._cancel_script(keys=[self._queue], args=[job_id, self.prefix])
+
+    def requeue_expired(self):
+        requeued, failed, cancelled = self._requeue_script(
+            keys=[self._leases, self._queue], args=[time.time(), self.max_attempts, self.prefix],
+        )
+        return {"requeued": requeued, "failed": failed, "cancelled": cancelled}
+
+    def position(self, job_id):
+        rank = self._redis.zrank(self._queue, job_id)
+        return rank + 1 if rank is not None else None
+
+    def worker_url(self, worker_id):
+        return self._redis.hget(f"{self.prefix}worker:{worker_id}", "url") or None
+
+    def workers(self):
+        workers = []
+        for worker_id in sorted(self._redis.smembers(self.prefix + "workers")):
+            data = self._redis.hgetall(f"{self.prefix}worker:{worker_id}")
+            if not data:
+                # Ключ истёк — воркер давно не присылал пульс
+                self._redis.srem(self.prefix + "workers", worker_id)
+                continue
+            workers.append({
+                "id": worker_id,
+                "url": data.get("url") or None,
+                "active": int(data.get("active") or 0),
+                "heartbeat_at": float(data.get("heartbeat_at") or 0),
+            })
+        return workers
+
+    def stats(self):
+        return {
+            "backend": "redis",
+            "queued": self._redis.zcard(self._queue),
+            "leased": self._redis.zcard(self._leases),
+            "workers": self.workers(),
+        }
+
+    def close(self):
+        self._redis.close()
+
+
+def create_broker(backend, path, url, lease_seconds, max_attempts):
+    """Создаёт брокер по имени из настроек (sqlite или redis)"""
+    if backend == "redis":
+        return RedisBroker(url, lease_seconds, max_attempts)
+    if backend == "sqlite":
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return SqliteBroker(path, lease_seconds, max_attempts)
+    raise BrokerError(f"Неизвестный брокер {backend}, допустимы: sqlite, redis")
@@ -0,0 +1,190 @@
+"""Кэш готовых файлов: повторная загрузка того же URL отдаётся без запуска yt-dlp"""
+import hashlib
+import os
+import re
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Параметры, которые не влияют на содержимое (метки рекламы и шаринга)
+_TRACKING_PARAMS = {"fbclid", "gclid", "yclid", "si", "feature", "ref", "ref_src", "igshid"}
+
+_YOUTUBE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+
+def extract_video_id(url):
+    """Быстро достаёт id видео для известных экстракторов (без запуска yt-dlp)"""
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if host.startswith("www.") or host.startswith("m."):
+        host = host.split(".", 1)[1]
+
+    candidate = None
+    if host == "youtu.be":
+        candidate = parts.path.lstrip("/").split("/")[0]
+    elif host in ("youtube.com", "music.youtube.com"):
+        if parts.path == "/watch":
+            candidate = dict(parse_qsl(parts.query)).get("v")
+        elif parts.path.startswith(("/shorts/", "/embed/", "/live/")):
+            candidate = parts.path.split("/")[2]
+
+    if candidate and _YOUTUBE_ID_RE.match(candidate):
+        return f"youtube:{candidate}"
+    return None
+
+
+def normalize_url(url):
+    """Приводит URL к каноническому виду: регистр хоста, порядок параметров, без меток"""
+    parts = urlsplit(url.strip())
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith("utm_") and k.lower() not in _TRACKING_PARAMS
+    ]
+    query.sort()
+    netloc = (parts.hostname or "").lower()
+    if parts.port and not (parts.scheme == "http" and parts.port == 80) \
+            and not (parts.scheme == "https" and parts.port == 443):
+        netloc = f"{netloc}:{parts.port}"
+    path = parts.path or "/"
+    return urlunsplit((parts.scheme.lower(), netloc, path, urlencode(query), ""))
+
+
+def make_cache_key(url, format_selector):
+    """Ключ кэша: id видео (если известен) или нормализованный URL плюс селектор формата"""
+    source = extract_video_id(url) or normalize_url(url)
+    return hashlib.sha256(f"{source}\n{format_selector}".encode("utf-8")).hexdigest()
+
+
+class CacheEntry:
+    __slots__ = ("key", "path", "filename", "size", "last_access")
+
+    def __init__(self, key, path, filename, size, last_access):
+        self.key = key
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.last_access = last_access
+
+
+class ResultCache:
+    """LRU-кэш файлов с ограничением по суммарному размеру.
+
+    Файл хранится как ``{key}_{filename}`` в cache_dir, время последнего доступа —
+    это mtime файла, поэтому индекс восстанавливается после перезапуска.
+    Файлы, которые сейчас отдаются клиентам (есть держатели), не вытесняются.
+    Индекс и держатели живут в памяти процесса: другой процесс с тем же cache_dir
+    о них не знает и может вытеснить файл, который этот процесс ещё отдаёт.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> CacheEntry, от старых к новым
+        self._holders = {}              # download_id -> key
+        self._total = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Восстанавливает индекс по файлам в папке кэша"""
+        found = []
+        for f in self.cache_dir.iterdir():
+            key, sep, filename = f.name.partition("_")
+            if not f.is_file() or not sep or len(key) != 64:
+                continue
+            stat = f.stat()
+            found.append(CacheEntry(key, str(f), filename, stat.st_size, stat.st_mtime))
+        for entry in sorted(found, key=lambda e: e.last_access):
+            self._entries[entry.key] = entry
+            self._total += entry.size
+        self._evict()
+
+    @property
+    def total_bytes(self):
+        return self._total
+
+    def get(self, key, download_id=None):
+        """Возвращает запись кэша и обновляет время доступа. download_id становится держателем."""
+        entry = self._entries.get(key)
+        if entry is not None and not os.path.exists(entry.path):
+            # Файл удалили снаружи
+            self._drop(entry)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touch(entry)
+        if download_id:
+            self._holders[download_id] = key
+        return entry
+
+    def put(self, key, src_path, filename, download_id=None):
+        """Переносит готовый файл в кэш и возвращает запись"""
+        old = self._entries.get(key)
+        if old is not None:
+            self._drop(old)
+
+        dest = self.cache_dir / f"{key}_{filename}"
+        shutil.move(str(src_path), str(dest))
+        entry = CacheEntry(key, str(dest), filename, os.path.getsize(dest), time.time())
+        self._entries[key] = entry
+        self._total += entry.size
+        self._touch(entry)
+        if download_id:
+            self._holders[download_id] = key
+        self._evict()
+        return entry
+
+    def owns(self, path):
+        """Лежит ли файл в папке кэша"""
+        return path is not None and Path(path).parent == self.cache_dir
+
+    def release(self, download_id):
+        """Снимает держателя. Возвращает True, если download_id держал запись кэша."""
+        if self._holders.pop(download_id, None) is None:
+            return False
+        self._evict()
+        return True
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _touch(self, entry):
+        entry.last_access = time.time()
+        self._entries.move_to_end(entry.key)
+        try:
+            os.utime(entry.path, (entry.last_access, entry.last_access))
+        except OSError:
+            pass
+
+    def _drop(self, entry):
+        self._entries.pop(entry.key, None)
+        self._total -= entry.size
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Вытесняет давно не использованные записи, пока кэш больше бюджета"""
+        if self._total <= self.max_bytes:
+            return
+        held = set(self._holders.values())
+        for entry in list(self._entries.values()):
+            if self._total <= self.max_bytes:
+                break
+            if entry.key in held:
+                continue
+            self._drop(entry)
@@ -0,0 +1,238 @@
+"""Командная строка: запуск сервера и пакетная загрузка списка ссылок без HTTP.
+
+    python cli.py serve --port 8000
+    python cli.py fetch urls.txt --output ./videos --parallel 4
+    cat urls.jsonl | python cli.py fetch - --output ./videos > summary.json
+
+fetch читает ссылки построчно (файл или stdin); строка JSONL — объект с полями как
+у /api/download ({"url": ..., "profile": "mp4-720p"}). Загрузки идут тем же путём,
+что и через API (очередь, движок yt-dlp, проверка и обработка файла), готовые файлы
+переносятся в папку --output. Манифест (--manifest, JSONL) хранит уже скачанное:
+повторный запуск пропускает эти ссылки. Итог — JSON в stdout, журнал — в stderr.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+from pathlib import Path
+
+
+def read_requests(source, defaults):
+    """Параметры загрузок из файла или stdin ("-"): ссылка в строке или объект JSON"""
+    lines = sys.stdin.readlines() if source == "-" else Path(source).read_text(encoding="utf-8").splitlines()
+    requests = []
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("{"):
+            try:
+                fields = json.loads(line)
+            except ValueError as e:
+                raise SystemExit(f"{source}:{number}: неверный JSON: {e}")
+        else:
+            fields = {"url": line}
+        requests.append({**defaults, **fields})
+    return requests
+
+
+def load_manifest(path):
+    """Ключ загрузки -> запись манифеста (последняя для ключа)"""
+    entries = {}
+    if path.exists():
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue   # Строка, оборванная при аварийной остановке
+                entries[entry["key"]] = entry
+    return entries
+
+
+def unique_path(directory, filename, download_id):
+    """Путь в папке результата; при совпадении имени добавляет начало download_id"""
+    target = directory / filename
+    if target.exists():
+        target = directory / f"{target.stem} ({download_id[:8]}){target.suffix}"
+    return target
+
+
+async def fetch(args):
+    # Настройки читаются при импорте приложения, поэтому app импортируется здесь
+    import app
+    from formats import FormatError
+    from janitor import NoSpaceError
+    from scheduler import QueueFullError
+
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    app.config.TEMP_DIR.mkdir(parents=True, exist_ok=True)
+    manifest_path = Path(args.manifest) if args.manifest else output / "manifest.jsonl"
+    manifest = load_manifest(manifest_path)
+    defaults = {
+        name: value
+        for name, value in (("max_height", args.max_height), ("container", args.container), ("profile", args.profile))
+        if value is not None
+    }
+    if args.audio_only:
+        defaults["audio_only"] = True
+
+    items = []
+    seen = set()
+    for fields in read_requests(args.source, defaults):
+        item = {"url": fields.get("url"), "status": None}
+        items.append(item)
+        try:
+            request = app.DownloadRequest(**{**fields, "stream": False})
+            options = request.format_options()
+            options.validate()
+        except (ValueError, FormatError) as e:
+            item.update(status="error", error_type="invalid_request", message=str(e))
+            continue
+        key = app.make_cache_key(request.url, options.cache_variant())
+        entry = manifest.get(key)
+        if entry is not None and (output / entry["file"]).exists():
+            item.update(status="skipped", file=entry["file"], size=entry.get("size"))
+        elif key in seen:
+            item.update(status="skipped", message="Повтор ссылки в списке")
+        else:
+            item.update(request=request, options=options, key=key)
+        seen.add(key)
+
+    semaphore = asyncio.Semaphore(args.parallel)
+    manifest_file = open(manifest_path, "a", encoding="utf-8")
+
+    async def run_item(item):
+        async with semaphore:
+            request = item.pop("request")
+            options = item.pop("options")
+            download_id = str(uuid.uuid4())
+            started = time.monotonic()
+            while True:
+                try:
+                    app.submit_download(request.url, request.priority, download_id=download_id, options=options)
+                    break
+                except QueueFullError as e:
+                    await asyncio.sleep(e.retry_after)
+                except NoSpaceError:
+                    item.update(status="error", error_type="no_space", message="Недостаточно места во временной папке")
+                    return
+            job_id = app.resolve_job_id(download_id)
+            await app.wait_job_finished(job_id)
+            record = app.job_store.get(job_id)
+            seconds = time.monotonic() - started
+            item["seconds"] = round(seconds, 3)
+            if record is None or record.status != "completed":
+                item.update(
+                    status="error",
+                    error_type=record.error_type if record is not None else None,
+                    message=record.message if record is not None else "Задача пропала",
+                )
+                print(f"error {request.url}: {item['message']}", file=sys.stderr)
+                return
+
+            # Файл из рабочей папки переносится в папку результата (обычно та же файловая система)
+            target = unique_path(output, record.filename, download_id)
+            await asyncio.to_thread(shutil.move, record.filepath, target)
+            app.release_job_file(job_id, record)
+            size = target.stat().st_size
+            item.update(
+                status="completed",
+                file=target.name,
+                size=size,
+                throughput=round(size / seconds) if seconds > 0 else None,
+                timings=record.timings,
+            )
+            manifest_file.write(json.dumps(
+                {"key": item.pop("key"), "url": request.url, "file": target.name, "size": size, "completed_at": time.time()},
+                ensure_ascii=False,
+            ) + "\n")
+            manifest_file.flush()   # Прерванный запуск продолжится с того же места
+            print(f"done {request.url} -> {target.name} ({size / (1024 * 1024):.1f} МБ, {seconds:.1f} с)", file=sys.stderr)
+
+    started = time.monotonic()
+    for handler in app.app.router.on_startup:
+        await handler()
+    try:
+        await asyncio.gather(*(run_item(item) for item in items if item["status"] is None))
+    finally:
+        for handler in app.app.router.on_shutdown:
+            await handler()
+        manifest_file.close()
+    elapsed = time.monotonic() - started
+
+    for item in items:
+        item.pop("key", None)
+    total_bytes = sum(item.get("size") or 0 for item in items if item["status"] == "completed")
+    return {
+        "total": len(items),
+        "completed": sum(item["status"] == "completed" for item in items),
+        "skipped": sum(item["status"] == "skipped" for item in items),
+        "failed": sum(item["status"] == "error" for item in items),
+        "bytes": total_bytes,
+        "seconds": round(elapsed, 3),
+        "throughput": round(total_bytes / elapsed) if elapsed > 0 else None,
+        "output": str(output),
+        "manifest": str(manifest_path),
+        "items": items,
+    }
+
+
+def run_fetch(args):
+    # Без HTTP-сервера: журнал и кэш сервера не нужны, их заменяет манифест,
+    # а рабочие файлы лежат рядом с результатом, чтобы перенос был переименованием
+    os.environ.setdefault("VD_TEMP_DIR", str(Path(args.output) / ".work"))
+    os.environ.setdefault("VD_JOURNAL_ENABLED", "0")
+    os.environ.setdefault("VD_CACHE_ENABLED", "0")
+    os.environ["VD_ROLE"] = "all"
+    os.environ["VD_MAX_CONCURRENT_DOWNLOADS"] = str(args.parallel)
+
+    # stdout — только для итогового JSON: сообщения приложения уходят в stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = asyncio.run(fetch(args))
+    json.dump(summary, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write("\n")
+    return 1 if summary["failed"] else 0
+
+
+def run_serve(args):
+    import uvicorn
+    uvicorn.run("app:app", host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="запустить HTTP-сервер")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--workers", type=int, default=1)
+    serve.set_defaults(handler=run_serve)
+
+    fetch_parser = commands.add_parser("fetch", help="скачать список ссылок в папку")
+    fetch_parser.add_argument("source", help="файл со ссылками (по одной в строке или JSONL), '-' — stdin")
+    fetch_parser.add_argument("--output", "-o", default="downloads", help="папка для готовых файлов")
+    fetch_parser.add_argument("--parallel", "-p", type=int, default=2, help="сколько загрузок одновременно")
+    fetch_parser.add_argument("--manifest", help="манифест скачанного (по умолчанию <output>/manifest.jsonl)")
+    fetch_parser.add_argument("--max-height", type=int, help="не выше этой высоты кадра")
+    fetch_parser.add_argument("--audio-only", action="store_true", help="только звук")
+    fetch_parser.add_argument("--container", help="mp4, mkv, webm, m4a, mp3")
+    fetch_parser.add_argument("--profile", help="профиль обработки (см. /api/profiles)")
+    fetch_parser.set_defaults(handler=run_fetch)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "parallel", 1) < 1:
+        parser.error("--parallel должен быть не меньше 1")
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
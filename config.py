@@ -0,0 +1,146 @@
+"""Настройки приложения. Любое значение можно переопределить переменной окружения."""
+import os
+import socket
+import tempfile
+from pathlib import Path
+
+
+def _env_int(name, default):
+    """Читает целое число из переменной окружения"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def _env_bool(name, default):
+    """Читает флаг (1/0, true/false, yes/no) из переменной окружения"""
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Временная папка для файлов на сервере
+TEMP_DIR = Path(os.environ.get("VD_TEMP_DIR") or Path(tempfile.gettempdir()) / "video_downloader")
+
+# Планировщик загрузок
+MAX_CONCURRENT_DOWNLOADS = _env_int("VD_MAX_CONCURRENT_DOWNLOADS", 4)   # Общий размер пула
+MAX_DOWNLOADS_PER_HOST = _env_int("VD_MAX_DOWNLOADS_PER_HOST", 2)       # Лимит на один хост-источник
+MAX_QUEUE_SIZE = _env_int("VD_MAX_QUEUE_SIZE", 100)                     # Максимум задач в очереди
+QUEUE_RETRY_AFTER = _env_int("VD_QUEUE_RETRY_AFTER", 10)                # Retry-After (сек) при переполнении
+
+# Кэш готовых файлов
+CACHE_ENABLED = _env_bool("VD_CACHE_ENABLED", True)
+CACHE_DIR = Path(os.environ.get("VD_CACHE_DIR") or TEMP_DIR / "cache")
+CACHE_MAX_BYTES = _env_int("VD_CACHE_MAX_BYTES", 5 * 1024 ** 3)           # 5 ГБ
+
+# Потоковая отдача прогресса (Server-Sent Events)
+PROGRESS_STREAM_MAX_RATE = float(os.environ.get("VD_PROGRESS_STREAM_MAX_RATE") or 4)   # Событий в секунду на клиента
+PROGRESS_STREAM_KEEPALIVE = _env_int("VD_PROGRESS_STREAM_KEEPALIVE", 15)               # Пинг раз в N секунд
+
+# Движок загрузки: "subprocess" — отдельный процесс yt-dlp на задачу,
+# "inprocess" — Python API yt-dlp в пуле прогретых процессов
+ENGINE = (os.environ.get("VD_ENGINE") or "subprocess").strip().lower()
+ENGINE_WORKERS = _env_int("VD_ENGINE_WORKERS", MAX_CONCURRENT_DOWNLOADS)
+
+# Отдача файла во время загрузки
+STREAM_START_TIMEOUT = _env_int("VD_STREAM_START_TIMEOUT", 60)   # Сколько ждать появления файла, сек
+STREAM_CHUNK_SIZE = _env_int("VD_STREAM_CHUNK_SIZE", 256 * 1024)
+
+# Встроенная загрузка HLS/DASH по фрагментам
+SEGMENTED_ENABLED = _env_bool("VD_SEGMENTED_ENABLED", True)
+SEGMENT_CONCURRENCY = _env_int("VD_SEGMENT_CONCURRENCY", 8)      # Фрагментов одновременно на задачу
+SEGMENT_RETRIES = _env_int("VD_SEGMENT_RETRIES", 3)              # Повторов на фрагмент
+HTTP_POOL_SIZE = _env_int("VD_HTTP_POOL_SIZE", 64)               # Соединений в общем пуле
+HTTP_TIMEOUT = _env_int("VD_HTTP_TIMEOUT", 30)                   # Таймаут запроса, сек
+
+# Журнал незавершённых задач для продолжения после перезапуска
+JOURNAL_ENABLED = _env_bool("VD_JOURNAL_ENABLED", True)
+JOURNAL_PATH = Path(os.environ.get("VD_JOURNAL_PATH") or TEMP_DIR / "jobs.sqlite3")
+RESUME_ON_STARTUP = _env_bool("VD_RESUME_ON_STARTUP", True)
+
+# Хранилище состояния задач: "memory" — в памяти процесса,
+# "sqlite" — общая база, чтобы несколько воркеров отвечали по одной задаче
+JOB_STORE = (os.environ.get("VD_JOB_STORE") or "memory").strip().lower()
+JOB_STORE_PATH = Path(os.environ.get("VD_JOB_STORE_PATH") or TEMP_DIR / "jobstate.sqlite3")
+JOB_TTL = _env_int("VD_JOB_TTL", 3600)                           # Сколько хранить завершённую задачу, сек
+JOB_MAX_RECORDS = _env_int("VD_JOB_MAX_RECORDS", 10000)          # Максимум записей о задачах
+JOB_SWEEP_INTERVAL = _env_int("VD_JOB_SWEEP_INTERVAL", 60)       # Как часто удалять устаревшие, сек
+
+# Уборка временной папки
+JANITOR_INTERVAL = _env_int("VD_JANITOR_INTERVAL", 60)                   # Проход раз в N секунд
+TEMP_MAX_BYTES = _env_int("VD_TEMP_MAX_BYTES", 20 * 1024 ** 3)           # Квота на файлы задач (0 — без квоты)
+TEMP_LOW_WATERMARK = float(os.environ.get("VD_TEMP_LOW_WATERMARK") or 0.8)   # До какой доли квоты освобождать
+TEMP_MAX_AGE = _env_int("VD_TEMP_MAX_AGE", 6 * 3600)                     # Предельный возраст файлов завершённых задач, сек
+TEMP_ORPHAN_GRACE = _env_int("VD_TEMP_ORPHAN_GRACE", 300)                # Через сколько удалять файлы без задачи, сек
+MIN_FREE_BYTES = _env_int("VD_MIN_FREE_BYTES", 1024 ** 3)                # Меньше свободного места — новые задачи не принимаются
+
+# Пакетные загрузки и плейлисты
+BATCH_MAX_ITEMS = _env_int("VD_BATCH_MAX_ITEMS", 200)            # Максимум видео в одном пакете
+BATCH_PARALLEL = _env_int("VD_BATCH_PARALLEL", 2)                # Одновременных загрузок одного пакета
+PLAYLIST_EXTRACT_TIMEOUT = _env_int("VD_PLAYLIST_EXTRACT_TIMEOUT", 120)   # Таймаут получения плейлиста, сек
+
+# Отдача готовых файлов: "" — сам сервер (Range, ETag, sendfile, если его поддерживает ASGI-сервер),
+# "x-accel" — заголовок X-Accel-Redirect для nginx, "x-sendfile" — X-Sendfile для Apache/lighttpd
+FILE_OFFLOAD = (os.environ.get("VD_FILE_OFFLOAD") or "").strip().lower()
+ACCEL_REDIRECT_PREFIX = os.environ.get("VD_ACCEL_REDIRECT_PREFIX") or "/protected-downloads"   # internal location nginx, указывающий на VD_TEMP_DIR
+
+# Информация о видео без загрузки (/api/probe)
+PROBE_CACHE_TTL = _env_int("VD_PROBE_CACHE_TTL", 600)              # Сколько хранить результат извлечения, сек
+PROBE_CACHE_MAX_ENTRIES = _env_int("VD_PROBE_CACHE_MAX_ENTRIES", 256)
+PROBE_CONCURRENCY = _env_int("VD_PROBE_CONCURRENCY", 4)            # Одновременных извлечений
+PROBE_TIMEOUT = _env_int("VD_PROBE_TIMEOUT", 60)                   # Таймаут извлечения, сек
+
+# Хосты с отдельной меткой в метриках /metrics (поддомены считаются к ним), остальные — "other"
+METRICS_HOSTS = [
+    host.strip().lower()
+    for host in (
+        os.environ.get("VD_METRICS_HOSTS")
+        or "youtube.com,youtu.be,vimeo.com,dailymotion.com,twitch.tv,tiktok.com,instagram.com,"
+        "facebook.com,twitter.com,x.com,reddit.com,vk.com,rutube.ru,ok.ru"
+    ).split(",")
+    if host.strip()
+]
+
+# Обработка готовых файлов ffmpeg (смена контейнера, профили перекодирования)
+TRANSCODE_WORKERS = _env_int("VD_TRANSCODE_WORKERS", max(1, (os.cpu_count() or 2) // 2))   # Процессов ffmpeg одновременно
+TRANSCODE_THREADS = _env_int("VD_TRANSCODE_THREADS", 2)          # Потоков на один процесс ffmpeg
+TRANSCODE_NICE = _env_int("VD_TRANSCODE_NICE", 10)               # Понижение приоритета ffmpeg (nice), 0 — не менять
+MEDIA_VALIDATE = _env_bool("VD_MEDIA_VALIDATE", True)           # Проверять контейнер готового файла (ffprobe, атомы mp4)
+FASTSTART = _env_bool("VD_FASTSTART", True)                     # Переносить индекс mp4 в начало файла (нужен ffmpeg)
+
+# Ограничение скорости загрузок (байт/с, 0 — без ограничения): общая полоса делится поровну между задачами
+RATE_LIMIT_TOTAL = _env_int("VD_RATE_LIMIT_TOTAL", 0)            # На все загрузки вместе
+RATE_LIMIT_PER_JOB = _env_int("VD_RATE_LIMIT_PER_JOB", 0)        # На одну задачу
+
+# Квоты клиента (по IP)
+CLIENT_MAX_ACTIVE_JOBS = _env_int("VD_CLIENT_MAX_ACTIVE_JOBS", 5)                 # Одновременных задач, 0 — без ограничения
+CLIENT_MAX_BYTES_PER_HOUR = _env_int("VD_CLIENT_MAX_BYTES_PER_HOUR", 20 * 1024 ** 3)   # Объём за час, 0 — без ограничения
+TRUST_FORWARDED_FOR = _env_bool("VD_TRUST_FORWARDED_FOR", False)  # Брать IP из X-Forwarded-For (за своим прокси)
+
+# Надзор за процессами yt-dlp
+DOWNLOAD_MAX_RUNTIME = _env_int("VD_DOWNLOAD_MAX_RUNTIME", 4 * 3600)   # Предельное время процесса, сек (0 — без лимита)
+DOWNLOAD_STALL_TIMEOUT = _env_int("VD_DOWNLOAD_STALL_TIMEOUT", 60)     # Сколько процесс может молчать, сек (0 — без лимита)
+PROCESS_KILL_GRACE = _env_int("VD_PROCESS_KILL_GRACE", 5)              # Пауза между SIGTERM и SIGKILL, сек
+SHUTDOWN_TIMEOUT = _env_int("VD_SHUTDOWN_TIMEOUT", 15)                 # Сколько ждать остановки задач при выключении, сек
+
+# Раздельный режим: "all" — один процесс принимает запросы и качает,
+# "api" — только принимает запросы и ставит задачи в брокер, "worker" — берёт задачи из брокера и качает
+ROLE = (os.environ.get("VD_ROLE") or "all").strip().lower()
+BROKER = (os.environ.get("VD_BROKER") or "sqlite").strip().lower()                # sqlite или redis
+BROKER_PATH = Path(os.environ.get("VD_BROKER_PATH") or TEMP_DIR / "broker.sqlite3")
+BROKER_URL = os.environ.get("VD_BROKER_URL") or "redis://localhost:6379/0"
+WORKER_ID = os.environ.get("VD_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_URL = os.environ.get("VD_WORKER_URL") or ""          # Адрес воркера, по которому API-узлы забирают готовые файлы
+LEASE_SECONDS = _env_int("VD_LEASE_SECONDS", 30)            # Аренда задачи; без пульса задача уходит другому воркеру
+HEARTBEAT_INTERVAL = _env_int("VD_HEARTBEAT_INTERVAL", 10)  # Пульс воркера, сек
+BROKER_POLL_INTERVAL = float(os.environ.get("VD_BROKER_POLL_INTERVAL") or 1)   # Как часто воркер спрашивает новые задачи, сек
+BROKER_MAX_ATTEMPTS = _env_int("VD_BROKER_MAX_ATTEMPTS", 3) # Сколько раз выдавать задачу после потери воркера
+
+# Состояние задач в раздельном режиме должно быть общим: по умолчанию там же, где брокер
+if ROLE != "all" and not os.environ.get("VD_JOB_STORE"):
+    JOB_STORE = BROKER
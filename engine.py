@@ -0,0 +1,286 @@
+"""Движок загрузки через Python API yt-dlp в пуле заранее запущенных процессов.
+
+Каждый воркер один раз импортирует yt_dlp при старте, поэтому задача не платит
+за запуск интерпретатора и импорт. Прогресс приходит из progress_hooks через
+общую очередь, а не разбором текстового вывода.
+"""
+import asyncio
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Очередь событий прогресса внутри воркера (передаётся при создании процесса)
+_progress_queue = None
+
+# Ограничение скорости по воркерам (байт/с, 0 — без ограничения) и номер этого воркера
+_rates = None
+_slot = None
+
+# Флаги отмены по воркерам: задача прерывается на ближайшем событии прогресса
+_stops = None
+
+# Не чаще стольких событий прогресса в секунду на задачу
+_HOOK_MAX_RATE = 10
+
+# Как часто воркер проверяет новое ограничение скорости, сек
+_RATE_CHECK_INTERVAL = 0.5
+
+
+class EngineError(Exception):
+    """Ошибка загрузки внутри воркера (текст ошибки yt-dlp)"""
+
+
+class EngineCrashError(EngineError):
+    """Воркер пула аварийно завершился (нехватка памяти, сбой); пул перезапущен"""
+
+
+def is_available():
+    """Можно ли использовать движок (установлен ли пакет yt_dlp)"""
+    try:
+        import yt_dlp  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _init_worker(progress_queue, rates, stops, slot_counter):
+    """Инициализация воркера: прогреваем импорт yt-dlp и его экстракторов"""
+    global _progress_queue, _rates, _stops, _slot
+    _progress_queue = progress_queue
+    _rates = rates
+    _stops = stops
+    with slot_counter.get_lock():
+        _slot = slot_counter.value
+        slot_counter.value += 1
+    import yt_dlp
+    import yt_dlp.extractor
+    yt_dlp.extractor.gen_extractor_classes()
+
+
+def _warmup():
+    return True
+
+
+def _run_extract(url, ydl_opts):
+    """Выполняется в воркере: извлекает info без загрузки"""
+    import yt_dlp
+
+    opts = dict(ydl_opts)
+    opts.update({"quiet": True, "noprogress": True, "skip_download": True})
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            return ydl.sanitize_info(ydl.extract_info(url, download=False))
+    except Exception as e:
+        raise EngineError(str(e)) from None
+
+
+def _run_download(job_id, url, ydl_opts, info=None):
+    """Выполняется в воркере: скачивает url и возвращает итоговый путь к файлу.
+
+    Если передан info (результат извлечения из кэша), страница повторно не разбирается.
+    """
+    import yt_dlp
+
+    last_sent = [0.0]
+    last_rate_check = [0.0]
+    ydl = None
+
+    # Сообщаем, в каком воркере идёт задача: через его ячейку меняется ограничение скорости
+    _rates[_slot] = ydl_opts.get("ratelimit") or 0
+    _stops[_slot] = 0
+    _progress_queue.put((job_id, "start", {"slot": _slot}))
+
+    def progress_hook(d):
+        if _stops[_slot]:
+            raise yt_dlp.utils.DownloadCancelled("Загрузка отменена")
+        now = time.monotonic()
+        if ydl is not None and now - last_rate_check[0] >= _RATE_CHECK_INTERVAL:
+            # yt-dlp читает ratelimit из params на каждом блоке — новое значение действует сразу
+            last_rate_check[0] = now
+            ydl.params["ratelimit"] = _rates[_slot] or None
+        finished = d.get("status") != "downloading"
+        if not finished and now - last_sent[0] < 1.0 / _HOOK_MAX_RATE:
+            return
+        last_sent[0] = now
+        _progress_queue.put((job_id, "download", {
+            "status": d.get("status"),
+            "downloaded_bytes": d.get("downloaded_bytes"),
+            "total_bytes": d.get("total_bytes") or d.get("total_bytes_estimate"),
+            "speed": d.get("speed"),
+            "eta": d.get("eta"),
+            "fragment_index": d.get("fragment_index"),
+            "fragment_count": d.get("fragment_count"),
+            "filename": d.get("filename"),
+            "tmpfilename": d.get("tmpfilename"),
+        }))
+
+    def postprocessor_hook(d):
+        if d.get("status") == "started":
+            _progress_queue.put((job_id, "postprocess", {"postprocessor": d.get("postprocessor")}))
+
+    opts = dict(ydl_opts)
+    opts.update({
+        "progress_hooks": [progress_hook],
+        "postprocessor_hooks": [postprocessor_hook],
+        "quiet": True,
+        "noprogress": True,
+    })
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            if info is not None:
+                info = ydl.process_ie_result(info, download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
+            info = ydl.sanitize_info(info)
+    except Exception as e:
+        # Исключения yt-dlp не всегда сериализуются — передаём только текст
+        raise EngineError(str(e)) from None
+
+    requested = info.get("requested_downloads") or [{}]
+    return {
+        "filepath": requested[0].get("filepath") or info.get("filepath") or info.get("_filename"),
+        "id": info.get("id"),
+        "extractor": info.get("extractor_key"),
+        "title": info.get("title"),
+    }
+
+
+class InProcessEngine:
+    """Пул процессов с прогретым yt-dlp и доставкой прогресса в event loop"""
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self._context = multiprocessing.get_context("spawn")
+        self._queue = self._context.Queue()
+        self._executor = None
+        self._reader = None
+        self._loop = None
+        self._callbacks = {}    # job_id -> callback(kind, data)
+        # Ограничение скорости: ячейка на воркер, задача узнаёт свою ячейку при старте
+        self._rates = self._context.Array("d", self.workers, lock=False)
+        self._stops = self._context.Array("b", self.workers, lock=False)
+        self._slot_counter = self._context.Value("i", 0)
+        self._job_slots = {}    # job_id -> номер воркера
+        self._slot_jobs = {}    # номер воркера -> job_id
+        self._job_rates = {}    # job_id -> байт/с
+        self._cancelled = set() # Отменённые задачи, о чьём воркере ещё неизвестно
+        self.restarts = 0
+
+    def _create_executor(self):
+        # Воркеры нового пула нумеруются заново и получают чистые ячейки
+        with self._slot_counter.get_lock():
+            self._slot_counter.value = 0
+        for slot in range(self.workers):
+            self._rates[slot] = 0
+            self._stops[slot] = 0
+        self._job_slots.clear()
+        self._slot_jobs.clear()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=self._context,
+            initializer=_init_worker,
+            initargs=(self._queue, self._rates, self._stops, self._slot_counter),
+        )
+
+    async def _run(self, fn, *args):
+        """Выполняет fn в пуле; если пул сломан гибелью воркера, пересоздаёт его"""
+        executor = self._executor
+        try:
+            return await self._loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool as e:
+            # Сломанный ProcessPoolExecutor больше не принимает задачи. Пересоздаёт
+            # пул первая задача, заметившая поломку; остальные задачи того же пула
+            # тоже завершаются ошибкой
+            if self._executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._create_executor()
+                self.restarts += 1
+            raise EngineCrashError(f"Процесс yt-dlp аварийно завершился ({e or 'пул сломан'})") from None
+
+    async def start(self):
+        """Запускает воркеры и ждёт, пока все импортируют yt-dlp"""
+        self._loop = asyncio.get_running_loop()
+        self._create_executor()
+        self._reader = threading.Thread(target=self._read_events, name="ytdlp-events", daemon=True)
+        self._reader.start()
+        await asyncio.gather(*(
+            self._loop.run_in_executor(self._executor, _warmup) for _ in range(self.workers)
+        ))
+
+    async def stop(self):
+        # Выполняющиеся загрузки прерываются, иначе воркеры доработали бы их после остановки
+        for slot in range(self.workers):
+            self._stops[slot] = 1
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._queue.put(None)
+
+    async def extract(self, url, ydl_opts):
+        """Извлекает info для url в воркере, не скачивая файл"""
+        return await self._run(_run_extract, url, ydl_opts)
+
+    async def download(self, job_id, url, ydl_opts, on_event, info=None):
+        """Скачивает url в воркере; on_event(kind, data) вызывается в event loop"""
+        self._callbacks[job_id] = on_event
+        self._job_rates[job_id] = ydl_opts.get("ratelimit") or 0
+        try:
+            return await self._run(_run_download, job_id, url, ydl_opts, info)
+        except asyncio.CancelledError:
+            # Отмена future не останавливает воркер — просим его прервать загрузку
+            self._cancel(job_id)
+            raise
+        finally:
+            self._callbacks.pop(job_id, None)
+            self._job_rates.pop(job_id, None)
+            slot = self._job_slots.pop(job_id, None)
+            if slot is not None and self._slot_jobs.get(slot) == job_id:
+                del self._slot_jobs[slot]
+
+    def set_rate(self, job_id, rate):
+        """Меняет ограничение скорости выполняющейся задачи (0 — без ограничения)"""
+        if job_id not in self._job_rates:
+            return
+        self._job_rates[job_id] = rate or 0
+        slot = self._job_slots.get(job_id)
+        # Воркер мог уже перейти к другой задаче — её ячейку не трогаем
+        if slot is not None and self._slot_jobs.get(slot) == job_id:
+            self._rates[slot] = rate or 0
+
+    def _cancel(self, job_id):
+        slot = self._job_slots.get(job_id)
+        if slot is not None and self._slot_jobs.get(slot) == job_id:
+            self._stops[slot] = 1
+        else:
+            self._cancelled.add(job_id)
+
+    def _on_start(self, job_id, slot):
+        if job_id in self._cancelled:
+            self._cancelled.discard(job_id)
+            self._stops[slot] = 1
+            return
+        if job_id not in self._job_rates:
+            return
+        self._job_slots[job_id] = slot
+        self._slot_jobs[slot] = job_id
+        self._rates[slot] = self._job_rates[job_id]
+
+    def _read_events(self):
+        """Поток-читатель: переносит события из очереди воркеров в event loop"""
+        while True:
+            try:
+                item = self._queue.get()
+            except (EOFError, OSError, queue.Empty):
+                return
+            if item is None:
+                return
+            job_id, kind, data = item
+            if kind == "start":
+                self._loop.call_soon_threadsafe(self._on_start, job_id, data["slot"])
+                continue
+            callback = self._callbacks.get(job_id)
+            if callback is not None:
+                self._loop.call_soon_threadsafe(callback, kind, data)
@@ -0,0 +1,44 @@
+"""Оповещение подписчиков об изменении прогресса (для потоковой отдачи вместо опроса)"""
+import asyncio
+from collections import defaultdict
+
+
+class ProgressBroadcaster:
+    """Хранит номер версии состояния каждой задачи и будит ждущих при изменении.
+
+    Подписчик запоминает версию, которую уже отправил клиенту, и ждёт следующую.
+    Несколько изменений подряд сливаются в одно: подписчик просто увидит последнюю версию.
+    """
+
+    def __init__(self):
+        self._versions = defaultdict(int)
+        self._events = {}   # job_id -> asyncio.Event, создаётся только если кто-то ждёт
+
+    def version(self, job_id):
+        return self._versions.get(job_id, 0)
+
+    def publish(self, job_id):
+        """Отмечает изменение состояния задачи"""
+        self._versions[job_id] += 1
+        event = self._events.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    async def wait(self, job_id, seen_version, timeout):
+        """Ждёт версию новее seen_version. Возвращает False по таймауту."""
+        if self.version(job_id) != seen_version:
+            return True
+        event = self._events.get(job_id)
+        if event is None:
+            event = self._events[job_id] = asyncio.Event()
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def forget(self, job_id):
+        self._versions.pop(job_id, None)
+        event = self._events.pop(job_id, None)
+        if event is not None:
+            event.set()
@@ -0,0 +1,196 @@
+"""Отдача готовых файлов: Range/206, ETag/Last-Modified, zero-copy и выгрузка на nginx"""
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+import anyio
+from starlette.responses import Response
+
+# Типы, которые mimetypes знает не везде
+_MEDIA_TYPES = {
+    ".mp4": "video/mp4",
+    ".m4v": "video/mp4",
+    ".m4a": "audio/mp4",
+    ".webm": "video/webm",
+    ".mkv": "video/x-matroska",
+    ".ts": "video/mp2t",
+    ".mp3": "audio/mpeg",
+    ".opus": "audio/ogg",
+    ".zip": "application/zip",
+}
+
+_RANGE_RE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
+
+def guess_media_type(path):
+    ext = os.path.splitext(path)[1].lower()
+    return _MEDIA_TYPES.get(ext) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def content_disposition(filename):
+    """Content-Disposition для скачивания с именем файла (включая не-ASCII)"""
+    # Заголовки HTTP — latin-1, поэтому в filename только ASCII, полное имя — в filename*
+    safe_filename = filename.encode("ascii", "replace").decode("ascii").replace("\\", "_").replace('"', "'")
+    return f'attachment; filename="{safe_filename}"; filename*=UTF-8\'\'{quote(filename)}'
+
+
+def make_etag(st):
+    """Дешёвый ETag из времени изменения и размера (как у nginx), без чтения файла"""
+    return f'"{int(st.st_mtime_ns // 1000):x}-{st.st_size:x}"'
+
+
+def parse_range(header, size):
+    """Разбирает заголовок Range для одного диапазона.
+
+    Возвращает (start, end) включительно, None — если Range нужно проигнорировать
+    (нет, несколько диапазонов, непонятный формат), "unsatisfiable" — для 416.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.group("start"), match.group("end")
+    if not start and not end:
+        return None
+    if not start:
+        # bytes=-N — последние N байт
+        length = int(end)
+        if length == 0:
+            return "unsatisfiable"
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or end < start:
+        return "unsatisfiable"
+    return start, min(end, size - 1)
+
+
+class RangeFileResponse(Response):
+    """Отдаёт файл с поддержкой Range и условных запросов.
+
+    Если сервер поддерживает расширения ASGI http.response.zerocopysend или
+    http.response.pathsend, байты передаются ядром (sendfile) без копирования
+    через Python; иначе — кусками из пула потоков, как FileResponse.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, path, request_headers, filename=None, media_type=None, headers=None, stat_result=None):
+        self.path = str(path)
+        self.range = None
+        st = stat_result or os.stat(self.path)
+        size = st.st_size
+
+        etag = make_etag(st)
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        response_headers = {
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "last-modified": last_modified,
+            "cache-control": "private, no-cache",
+        }
+        if filename:
+            response_headers["content-disposition"] = content_disposition(filename)
+        response_headers.update(headers or {})
+
+        status_code = 200
+        if _not_modified(request_headers, etag, st.st_mtime):
+            status_code = 304
+            self.range = (0, -1)
+        else:
+            requested = parse_range(request_headers.get("range"), size)
+            # If-Range: диапазон действителен, только если файл не изменился
+            if_range = request_headers.get("if-range")
+            if requested is not None and if_range and if_range != etag and if_range != last_modified:
+                requested = None
+            if requested == "unsatisfiable":
+                status_code = 416
+                response_headers["content-range"] = f"bytes */{size}"
+                self.range = (0, -1)
+            elif requested is not None:
+                status_code = 206
+                start, end = requested
+                response_headers["content-range"] = f"bytes {start}-{end}/{size}"
+                self.range = (start, end)
+            else:
+                self.range = (0, size - 1)
+
+        super().__init__(
+            content=None,
+            status_code=status_code,
+            headers=response_headers,
+            media_type=media_type or guess_media_type(self.path),
+        )
+        if status_code != 304:
+            start, end = self.range
+            self.headers["content-length"] = str(end - start + 1)
+
+    def init_headers(self, headers=None):
+        # Content-Length выставляется после разбора диапазона
+        super().init_headers(headers)
+        self.raw_headers = [(k, v) for k, v in self.raw_headers if k != b"content-length"]
+
+    async def __call__(self, scope, receive, send):
+        start, end = self.range
+        count = end - start + 1
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if count <= 0 or scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f.fileno(), "offset": start, "count": count})
+            return
+        if "http.response.pathsend" in extensions and self.status_code == 200:
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+
+        async with await anyio.open_file(self.path, mode="rb") as f:
+            await f.seek(start)
+            remaining = count
+            while remaining > 0:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            # Файл укоротился во время отдачи — закрываем ответ как есть
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def _not_modified(request_headers, etag, mtime):
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def offload_response(mode, path, root, prefix, filename=None, media_type=None):
+    """Ответ, после которого байты отдаёт nginx (X-Accel-Redirect) или Apache/lighttpd (X-Sendfile).
+
+    Возвращает None, если файл лежит вне root и nginx его не увидит.
+    """
+    headers = {}
+    if filename:
+        headers["content-disposition"] = content_disposition(filename)
+    if mode == "x-accel":
+        relative = os.path.relpath(path, root)
+        if relative.startswith(".."):
+            return None
+        headers["x-accel-redirect"] = prefix.rstrip("/") + "/" + quote(relative.replace(os.sep, "/"))
+    else:
+        headers["x-sendfile"] = os.path.abspath(path)
+    return Response(status_code=200, headers=headers, media_type=media_type or guess_media_type(path))
@@ -0,0 +1,113 @@
+"""Параметры формата из запроса: предельное качество, только звук, контейнер и профиль"""
+from dataclasses import asdict, dataclass
+
+from transcode import AUDIO_CONTAINERS, CONTAINERS, PROFILES
+
+# Селектор формата yt-dlp по умолчанию (предпочитаем mp4); входит в ключ кэша
+FORMAT_SELECTOR = "best[ext=mp4]/bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best"
+
+# Для отдачи во время загрузки нужен один файл без объединения дорожек
+# ("best" — формат, где есть и видео, и аудио): прогрессивный mp4 или HLS,
+# который пишется как MPEG-TS
+STREAM_FORMAT_SELECTOR = "best[ext=mp4]/best"
+
+
+class FormatError(ValueError):
+    """Недопустимое сочетание параметров формата"""
+
+
+@dataclass(slots=True, frozen=True)
+class FormatOptions:
+    """Что нужно клиенту: предельная высота кадра, только звук, контейнер, профиль обработки"""
+    max_height: int = None
+    audio_only: bool = False
+    container: str = None
+    profile: str = None
+
+    def validate(self, stream=False):
+        """Бросает FormatError, если параметры несовместимы"""
+        if self.max_height is not None and self.max_height <= 0:
+            raise FormatError("max_height должен быть положительным")
+        if self.container is not None and self.container not in CONTAINERS:
+            raise FormatError(f"Неизвестный контейнер {self.container}, допустимы: {', '.join(CONTAINERS)}")
+        if self.profile is not None:
+            profile = PROFILES.get(self.profile)
+            if profile is None:
+                raise FormatError(f"Неизвестный профиль {self.profile}, допустимы: {', '.join(PROFILES)}")
+            if self.container is not None and self.container != profile.container:
+                raise FormatError(f"Профиль {self.profile} даёт {profile.container}, а запрошен {self.container}")
+        if self.audio_only and self.container is not None and self.container not in AUDIO_CONTAINERS:
+            raise FormatError(f"Для звука допустимы контейнеры: {', '.join(AUDIO_CONTAINERS)}")
+        if stream and (self.wants_audio_only or self.container is not None or self.profile is not None):
+            # Файл уходит клиенту во время записи — обработать его после уже нельзя
+            raise FormatError("Во время загрузки можно получить только видео без обработки (доступен max_height)")
+
+    @property
+    def transcode_profile(self):
+        return PROFILES.get(self.profile) if self.profile else None
+
+    @property
+    def wants_audio_only(self):
+        profile = self.transcode_profile
+        return self.audio_only or self.container in AUDIO_CONTAINERS or bool(profile and profile.audio_only)
+
+    @property
+    def requires_video(self):
+        """Без видеодорожки результат не имеет смысла: запрошено перекодирование видео"""
+        profile = self.transcode_profile
+        return bool(profile and profile.video_encoder and not self.wants_audio_only)
+
+    @property
+    def target_container(self):
+        """Контейнер итогового файла"""
+        profile = self.transcode_profile
+        if profile is not None:
+            return profile.container
+        if self.container is not None:
+            return self.container
+        return "m4a" if self.audio_only else "mp4"
+
+    @property
+    def effective_height(self):
+        """Предельная высота с учётом профиля: лишнее не скачиваем, чтобы не перекодировать"""
+        profile = self.transcode_profile
+        heights = [h for h in (self.max_height, profile.max_height if profile else None) if h]
+        return min(heights) if heights else None
+
+    def selector(self, stream=False):
+        """Селектор формата yt-dlp"""
+        height = self.effective_height
+        if self.wants_audio_only:
+            if self.target_container == "m4a":
+                return "bestaudio[ext=m4a]/bestaudio/best"
+            return "bestaudio/best"
+        if height is None and self.target_container == "mp4":
+            return STREAM_FORMAT_SELECTOR if stream else FORMAT_SELECTOR
+
+        # height<=? пропускает форматы, у которых высота неизвестна
+        h = f"[height<=?{height}]" if height else ""
+        if stream:
+            return f"best[ext=mp4]{h}/best{h}"
+        if self.target_container == "webm":
+            return f"bestvideo[ext=webm]{h}+bestaudio[ext=webm]/best[ext=webm]{h}/bestvideo{h}+bestaudio/best{h}"
+        if self.target_container == "mkv":
+            return f"bestvideo{h}+bestaudio/best{h}"
+        return f"best[ext=mp4]{h}/bestvideo[ext=mp4]{h}+bestaudio[ext=m4a]/best{h}/bestvideo{h}+bestaudio"
+
+    def merge_format(self):
+        """Контейнер, в который yt-dlp объединяет отдельные дорожки видео и звука"""
+        return {"mkv": "mkv", "webm": "webm/mkv"}.get(self.target_container, "mp4")
+
+    def cache_variant(self, stream=False):
+        """Строка для ключа кэша: для параметров по умолчанию — просто селектор"""
+        variant = self.selector(stream)
+        if self.container or self.profile or self.audio_only:
+            variant += f"|{self.target_container}|{self.profile or ''}"
+        return variant
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**(data or {}))
@@ -0,0 +1,171 @@
+"""Уборка временной папки: квота по объёму, предельный возраст и файлы без задач"""
+import logging
+import os
+import re
+import shutil
+import time
+
+# Рабочая папка задачи называется {download_id} (download_id — uuid4);
+# файлы старого вида {download_id}_* в корне тоже относятся к задаче
+_JOB_ENTRY_RE = re.compile(r'^(?P<id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?:_|$)')
+
+logger = logging.getLogger(__name__)
+
+
+class NoSpaceError(Exception):
+    """Места на диске не хватает для новой загрузки"""
+
+
+class TempJanitor:
+    """Периодически чистит временную папку.
+
+    job_state(download_id) сообщает, что с задачей: "active" (файлы не трогаем),
+    "finished" (можно удалить, если место нужнее) или None (задачи нет — файлы
+    осиротели). on_evict(download_id) вызывается после удаления файлов
+    завершённой задачи, чтобы приложение забыло о ней.
+    """
+
+    def __init__(self, temp_dir, job_state, on_evict, max_bytes, max_age,
+                 low_watermark, min_free_bytes, orphan_grace):
+        self.temp_dir = temp_dir
+        self.job_state = job_state
+        self.on_evict = on_evict
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.low_watermark = low_watermark
+        self.min_free_bytes = min_free_bytes
+        self.orphan_grace = orphan_grace
+
+        self.bytes_used = 0
+        self.files = 0
+        self.deleted_files = 0
+        self.deleted_bytes = 0
+        self.orphans_removed = 0
+        self.expired_removed = 0
+        self.evicted_for_quota = 0
+        self.rejected_jobs = 0
+        self.sweeps = 0
+        self.last_sweep_duration = 0.0
+
+    def _scan(self):
+        """Файлы задач, сгруппированные по download_id: id -> [(path, size, mtime)]"""
+        groups = {}
+        try:
+            entries = list(os.scandir(self.temp_dir))
+        except FileNotFoundError:
+            return groups
+        for entry in entries:
+            match = _JOB_ENTRY_RE.match(entry.name)
+            if not match:
+                continue
+            files = groups.setdefault(match.group("id"), [])
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    # Сама папка тоже в группе: по ней видно возраст пустой папки
+                    files.append((entry.path, 0, entry.stat(follow_symlinks=False).st_mtime))
+                    for inner in os.scandir(entry.path):
+                        if inner.is_file(follow_symlinks=False):
+                            stat = inner.stat(follow_symlinks=False)
+                            files.append((inner.path, stat.st_size, stat.st_mtime))
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+            except FileNotFoundError:
+                continue
+        return {download_id: files for download_id, files in groups.items() if files}
+
+    def _remove(self, files):
+        removed = 0
+        # Сначала файлы, потом опустевшие рабочие папки
+        files = sorted(files, key=lambda f: os.path.isdir(f[0]))
+        for path, size, _ in files:
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning("Не удалось удалить %s: %s", path, e)
+                continue
+            self.deleted_files += 1
+            self.deleted_bytes += size
+            removed += size
+        return removed
+
+    def sweep(self):
+        """Один проход уборки. Возвращает число освобождённых байт."""
+        started = time.monotonic()
+        now = time.time()
+        groups = self._scan()
+        freed = 0
+        finished = []   # (последнее изменение, id) задач, чьи файлы можно вытеснить
+
+        for download_id, files in list(groups.items()):
+            newest = max(mtime for _, _, mtime in files)
+            state = self.job_state(download_id)
+            if state == "active":
+                continue
+            if state is None:
+                # Задачи нет: процесс упал, запись вытеснена или вкладку закрыли
+                if now - newest > self.orphan_grace:
+                    freed += self._remove(files)
+                    self.orphans_removed += 1
+                    del groups[download_id]
+            elif self.max_age and now - newest > self.max_age:
+                freed += self._remove(files)
+                self.on_evict(download_id)
+                self.expired_removed += 1
+                del groups[download_id]
+            else:
+                finished.append((newest, download_id))
+
+        used = sum(size for files in groups.values() for _, size, _ in files)
+
+        # Выше квоты — удаляем файлы завершённых задач, начиная со старых, до нижней отметки
+        if self.max_bytes and used > self.max_bytes:
+            target = self.max_bytes * self.low_watermark
+            for _, download_id in sorted(finished):
+                if used <= target:
+                    break
+                removed = self._remove(groups.pop(download_id))
+                self.on_evict(download_id)
+                used -= removed
+                freed += removed
+                self.evicted_for_quota += 1
+
+        self.bytes_used = used
+        self.files = sum(1 for files in groups.values() for path, _, _ in files if not os.path.isdir(path))
+        self.sweeps += 1
+        self.last_sweep_duration = time.monotonic() - started
+        return freed
+
+    def free_bytes(self):
+        try:
+            return shutil.disk_usage(self.temp_dir).free
+        except FileNotFoundError:
+            return 0
+
+    def has_room(self):
+        """Хватает ли места для новой загрузки"""
+        if self.max_bytes and self.bytes_used >= self.max_bytes:
+            return False
+        return self.free_bytes() >= self.min_free_bytes
+
+    def stats(self):
+        return {
+            "bytes_used": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "files": self.files,
+            "free_bytes": self.free_bytes(),
+            "min_free_bytes": self.min_free_bytes,
+            "deleted_files": self.deleted_files,
+            "deleted_bytes": self.deleted_bytes,
+            "orphans_removed": self.orphans_removed,
+            "expired_removed": self.expired_removed,
+            "evicted_for_quota": self.evicted_for_quota,
+            "rejected_jobs": self.rejected_jobs,
+            "sweeps": self.sweeps,
+            "last_sweep_duration": round(self.last_sweep_duration, 4),
+        }
@@ -0,0 +1,441 @@
+"""Хранилище состояния задач: в памяти с вытеснением, общее SQLite для нескольких воркеров или Redis для нескольких машин"""
+import dataclasses
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+# Статусы, после которых задача больше не меняется и может быть вытеснена
+FINISHED_STATUSES = ("completed", "error")
+
+
+@dataclass(slots=True)
+class JobRecord:
+    """Состояние одной задачи (то, что отдаёт /api/progress)"""
+    id: str
+    status: str = "queued"
+    progress: float = 0
+    message: str = ""
+    filename: str = None
+    filepath: str = None
+    queue_position: int = None
+    streamable: bool = False
+    cache_hit: bool = None
+    resumed: bool = None
+    downloaded_bytes: int = None
+    total_bytes: int = None
+    speed: float = None
+    eta: float = None
+    fragment_index: int = None
+    fragment_count: int = None
+    throughput: float = None
+    fragment_retries: int = None
+    resume_state: dict = None
+    error_type: str = None
+    stage: str = None
+    timings: dict = None
+    media: dict = None          # Контейнер, дорожки и длительность по ffprobe
+    worker: str = None          # Воркер раздельного режима, у которого лежит файл
+    updated_at: float = 0.0
+    finished_at: float = None
+
+    def to_dict(self):
+        data = dataclasses.asdict(self)
+        del data["id"], data["updated_at"], data["finished_at"]
+        return data
+
+    def apply(self, fields):
+        """Обновляет поля; неизвестное поле — ошибка (AttributeError)"""
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.updated_at = time.time()
+        if self.status in FINISHED_STATUSES:
+            if self.finished_at is None:
+                self.finished_at = self.updated_at
+        else:
+            self.finished_at = None
+
+
+class MemoryJobStore:
+    """Задачи в памяти процесса.
+
+    Завершённые задачи удаляются через ttl секунд после завершения, а при
+    превышении max_jobs — начиная с самых старых. Активные не вытесняются.
+    """
+
+    def __init__(self, ttl, max_jobs):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()   # id -> JobRecord, в порядке последнего обновления
+        self._subscriptions = {}     # download_id -> id задачи
+        self._subscribers = {}       # id задачи -> множество download_id
+        self.evicted = 0
+
+    def __contains__(self, job_id):
+        return job_id in self._jobs
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def is_local(self, job_id):
+        """Меняется ли задача этим процессом (значит, о ней есть оповещения)"""
+        return job_id in self._jobs
+
+    def update(self, job_id, **fields):
+        record = self._jobs.get(job_id)
+        if record is None:
+            record = self._jobs[job_id] = JobRecord(id=job_id)
+        else:
+            self._jobs.move_to_end(job_id)
+        record.apply(fields)
+        return record
+
+    def hand_off(self, job_id):
+        """Задачу дальше меняет другой процесс (в памяти такого не бывает)"""
+
+    def subscribe(self, job_id, download_id):
+        """Подписывает download_id на файл задачи job_id"""
+        self._subscriptions[download_id] = job_id
+        self._subscribers.setdefault(job_id, set()).add(download_id)
+
+    def unsubscribe(self, job_id, download_id):
+        """Отписывает download_id и возвращает, сколько подписчиков у задачи осталось"""
+        if self._subscriptions.get(download_id) == job_id:
+            del self._subscriptions[download_id]
+        subscribers = self._subscribers.get(job_id, set())
+        subscribers.discard(download_id)
+        if not subscribers:
+            self._subscribers.pop(job_id, None)
+        return len(subscribers)
+
+    def subscribers(self, job_id):
+        return set(self._subscribers.get(job_id, ()))
+
+    def resolve(self, download_id):
+        """Id задачи, на которую подписан download_id (или он сам)"""
+        return self._subscriptions.get(download_id, download_id)
+
+    def drop_subscribers(self, job_id):
+        """Снимает все подписки задачи и возвращает их"""
+        subscribers = self._subscribers.pop(job_id, set())
+        for download_id in subscribers:
+            if self._subscriptions.get(download_id) == job_id:
+                del self._subscriptions[download_id]
+        return subscribers
+
+    def delete(self, job_id):
+        self._jobs.pop(job_id, None)
+
+    def evict(self, now=None):
+        """Удаляет устаревшие завершённые задачи и возвращает их записи"""
+        now = time.time() if now is None else now
+        finished = [r for r in self._jobs.values() if r.finished_at is not None]
+        finished.sort(key=lambda r: r.finished_at)
+        excess = len(self._jobs) - self.max_jobs
+        evicted = []
+        for record in finished:
+            if now - record.finished_at < self.ttl and excess <= 0:
+                break
+            del self._jobs[record.id]
+            evicted.append(record)
+            excess -= 1
+        self.evicted += len(evicted)
+        return evicted
+
+    def stats(self):
+        return {"backend": "memory", "jobs": len(self._jobs), "evicted": self.evicted}
+
+    def close(self):
+        pass
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_state (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    finished_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_state_finished ON job_state (finished_at);
+CREATE TABLE IF NOT EXISTS job_subscribers (
+    download_id TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_subscribers_job ON job_subscribers (job_id);
+"""
+
+
+class SqliteJobStore:
+    """Задачи в SQLite (WAL): состояние видно всем воркерам uvicorn.
+
+    Записи задач, которые выполняет этот процесс, держатся в памяти и
+    записываются в базу при каждом обновлении; чужие читаются из базы.
+    Подписки клиентов на файлы задач — только в базе: запрос /api/cleanup
+    может прийти в любой процесс.
+    """
+
+    def __init__(self, path, ttl, max_jobs):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._local = {}   # id -> JobRecord задач этого процесса
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self.evicted = 0
+
+    def __contains__(self, job_id):
+        return self.get(job_id) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM job_state").fetchone()[0]
+
+    def get(self, job_id):
+        record = self._local.get(job_id)
+        if record is not None:
+            return record
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM job_state WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return JobRecord(**json.loads(row[0]))
+
+    def is_local(self, job_id):
+        return job_id in self._local
+
+    def update(self, job_id, **fields):
+        record = self._local.get(job_id)
+        if record is None:
+            record = self.get(job_id) or JobRecord(id=job_id)
+            self._local[job_id] = record
+        record.apply(fields)
+        data = json.dumps(dataclasses.asdict(record), ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_state (id, data, finished_at, updated_at) VALUES (?, ?, ?, ?)",
+                (job_id, data, record.finished_at, record.updated_at),
+            )
+        # Завершённую задачу больше не меняем — читать её можно из базы
+        if record.finished_at is not None:
+            self._local.pop(job_id, None)
+        return record
+
+    def hand_off(self, job_id):
+        """Задачу дальше меняет другой процесс: читаем её из базы, а не из памяти"""
+        self._local.pop(job_id, None)
+
+    def subscribe(self, job_id, download_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_subscribers (download_id, job_id) VALUES (?, ?)", (download_id, job_id),
+            )
+
+    def unsubscribe(self, job_id, download_id):
+        # Удаление и подсчёт — в одной транзакции: последнего подписчика увидит один процесс
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM job_subscribers WHERE download_id = ? AND job_id = ?", (download_id, job_id),
+                )
+                remaining = self._conn.execute(
+                    "SELECT COUNT(*) FROM job_subscribers WHERE job_id = ?", (job_id,),
+                ).fetchone()[0]
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return remaining
+
+    def subscribers(self, job_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT download_id FROM job_subscribers WHERE job_id = ?", (job_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def resolve(self, download_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id FROM job_subscribers WHERE download_id = ?", (download_id,),
+            ).fetchone()
+        return row[0] if row else download_id
+
+    def drop_subscribers(self, job_id):
+        subscribers = self.subscribers(job_id)
+        with self._lock:
+            self._conn.execute("DELETE FROM job_subscribers WHERE job_id = ?", (job_id,))
+        return subscribers
+
+    def delete(self, job_id):
+        self._local.pop(job_id, None)
+        with self._lock:
+            self._conn.execute("DELETE FROM job_state WHERE id = ?", (job_id,))
+
+    def evict(self, now=None):
+        """Удаляет устаревшие завершённые задачи и возвращает их записи"""
+        now = time.time() if now is None else now
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM job_state").fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT id, data FROM job_state WHERE finished_at IS NOT NULL"
+                " AND (finished_at < ? OR ? > 0) ORDER BY finished_at",
+                (now - self.ttl, total - self.max_jobs),
+            ).fetchall()
+            excess = total - self.max_jobs
+            evicted = []
+            for job_id, data in rows:
+                record = JobRecord(**json.loads(data))
+                if now - record.finished_at < self.ttl and excess <= 0:
+                    break
+                evicted.append(record)
+                excess -= 1
+            self._conn.executemany("DELETE FROM job_state WHERE id = ?", [(r.id,) for r in evicted])
+        self.evicted += len(evicted)
+        return evicted
+
+    def stats(self):
+        return {"backend": "sqlite", "jobs": len(self), "local_jobs": len(self._local), "evicted": self.evicted}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisJobStore:
+    """Задачи в Redis: состояние видно API-узлам и воркерам на разных машинах.
+
+    Как и в SqliteJobStore, задачи этого процесса держатся в памяти и
+    записываются при каждом обновлении. Нужен пакет redis.
+    """
+
+    def __init__(self, url, ttl, max_jobs, prefix="vd:", client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._redis = client
+        self._state = prefix + "state"          # HASH: id -> JSON записи
+        self._finished = prefix + "finished"    # ZSET: id -> время завершения
+        self._aliases = prefix + "aliases"      # HASH: download_id -> id задачи
+        self._subscribers_prefix = prefix + "subscribers:"   # SET download_id на задачу
+        self._local = {}
+        self.evicted = 0
+
+    def __contains__(self, job_id):
+        return self.get(job_id) is not None
+
+    def __len__(self):
+        return self._redis.hlen(self._state)
+
+    def get(self, job_id):
+        record = self._local.get(job_id)
+        if record is not None:
+            return record
+        data = self._redis.hget(self._state, job_id)
+        return JobRecord(**json.loads(data)) if data else None
+
+    def is_local(self, job_id):
+        return job_id in self._local
+
+    def update(self, job_id, **fields):
+        record = self._local.get(job_id)
+        if record is None:
+            record = self.get(job_id) or JobRecord(id=job_id)
+            self._local[job_id] = record
+        record.apply(fields)
+        pipe = self._redis.pipeline()
+        pipe.hset(self._state, job_id, json.dumps(dataclasses.asdict(record), ensure_ascii=False))
+        if record.finished_at is not None:
+            pipe.zadd(self._finished, {job_id: record.finished_at})
+        else:
+            pipe.zrem(self._finished, job_id)
+        pipe.execute()
+        if record.finished_at is not None:
+            self._local.pop(job_id, None)
+        return record
+
+    def hand_off(self, job_id):
+        """Задачу дальше меняет другой процесс: читаем её из базы, а не из памяти"""
+        self._local.pop(job_id, None)
+
+    def subscribe(self, job_id, download_id):
+        pipe = self._redis.pipeline()
+        pipe.hset(self._aliases, download_id, job_id)
+        pipe.sadd(self._subscribers_prefix + job_id, download_id)
+        pipe.execute()
+
+    def unsubscribe(self, job_id, download_id):
+        pipe = self._redis.pipeline()   # MULTI/EXEC: подсчёт сразу после удаления
+        pipe.srem(self._subscribers_prefix + job_id, download_id)
+        pipe.scard(self._subscribers_prefix + job_id)
+        _, remaining = pipe.execute()
+        if self._redis.hget(self._aliases, download_id) == job_id:
+            self._redis.hdel(self._aliases, download_id)
+        return remaining
+
+    def subscribers(self, job_id):
+        return set(self._redis.smembers(self._subscribers_prefix + job_id))
+
+    def resolve(self, download_id):
+        return self._redis.hget(self._aliases, download_id) or download_id
+
+    def drop_subscribers(self, job_id):
+        key = self._subscribers_prefix + job_id
+        subscribers = self.subscribers(job_id)
+        pipe = self._redis.pipeline()
+        pipe.delete(key)
+        if subscribers:
+            pipe.hdel(self._aliases, *subscribers)
+        pipe.execute()
+        return subscribers
+
+    def delete(self, job_id):
+        self._local.pop(job_id, None)
+        pipe = self._redis.pipeline()
+        pipe.hdel(self._state, job_id)
+        pipe.zrem(self._finished, job_id)
+        pipe.execute()
+
+    def evict(self, now=None):
+        """Удаляет устаревшие завершённые задачи и возвращает их записи"""
+        now = time.time() if now is None else now
+        ids = set(self._redis.zrangebyscore(self._finished, "-inf", now - self.ttl))
+        excess = len(self) - len(ids) - self.max_jobs
+        if excess > 0:
+            ids.update(self._redis.zrange(self._finished, 0, excess - 1))
+        evicted = []
+        for job_id in ids:
+            data = self._redis.hget(self._state, job_id)
+            if data:
+                evicted.append(JobRecord(**json.loads(data)))
+        if ids:
+            pipe = self._redis.pipeline()
+            pipe.hdel(self._state, *ids)
+            pipe.zrem(self._finished, *ids)
+            pipe.execute()
+        self.evicted += len(evicted)
+        return evicted
+
+    def stats(self):
+        return {"backend": "redis", "jobs": len(self), "local_jobs": len(self._local), "evicted": self.evicted}
+
+    def close(self):
+        self._redis.close()
+
+
+def create_job_store(backend, path, ttl, max_jobs, url=None):
+    """Создаёт хранилище по имени из настроек (memory, sqlite или redis)"""
+    if backend == "redis":
+        return RedisJobStore(url, ttl, max_jobs)
+    if backend == "sqlite":
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return SqliteJobStore(path, ttl, max_jobs)
+    return MemoryJobStore(ttl, max_jobs)
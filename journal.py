@@ -0,0 +1,163 @@
+"""Журнал незавершённых задач на диске: после перезапуска загрузки продолжаются"""
+import json
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    options TEXT NOT NULL,
+    cache_key TEXT,
+    subscribers TEXT NOT NULL DEFAULT '[]',
+    output_path TEXT,
+    bytes_done INTEGER NOT NULL DEFAULT 0,
+    fragment_index INTEGER,
+    resume_state TEXT,
+    owner TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class JournalEntry:
+    __slots__ = ("id", "url", "options", "cache_key", "subscribers", "output_path",
+                 "bytes_done", "fragment_index", "resume_state")
+
+    def __init__(self, row):
+        self.id = row["id"]
+        self.url = row["url"]
+        self.options = json.loads(row["options"])
+        self.cache_key = row["cache_key"]
+        self.subscribers = json.loads(row["subscribers"])
+        self.output_path = row["output_path"]
+        self.bytes_done = row["bytes_done"]
+        self.fragment_index = row["fragment_index"]
+        self.resume_state = json.loads(row["resume_state"]) if row["resume_state"] else None
+
+
+class JobJournal:
+    """SQLite-журнал (WAL) задач, которые ещё не завершились.
+
+    Запись создаётся при постановке в очередь и удаляется, когда задача дошла
+    до completed/error. Прогресс пишется не чаще checkpoint_interval секунд.
+
+    Файл может быть общим для нескольких процессов (uvicorn --workers N): запись
+    принадлежит процессу owner, пока он продлевает lease_until. Продолжить задачу
+    можно, только забрав её через claim() — свободную или с истёкшей арендой.
+    """
+
+    def __init__(self, path, checkpoint_interval=2.0, owner=None, lease_seconds=30):
+        self.path = str(path)
+        self.checkpoint_interval = checkpoint_interval
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self._last_checkpoint = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        # Журнал прежней версии — без владельца
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    def add(self, job_id, url, options, cache_key=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, url, options, cache_key, subscribers, owner, lease_until,"
+                " created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, url, json.dumps(options), cache_key, json.dumps([job_id]),
+                 self.owner, now + self.lease_seconds, now, now),
+            )
+
+    def set_subscribers(self, job_id, subscribers):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET subscribers = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(sorted(subscribers)), time.time(), job_id),
+            )
+
+    def checkpoint(self, job_id, force=False, **fields):
+        """Сохраняет прогресс (output_path, bytes_done, fragment_index, resume_state)"""
+        now = time.monotonic()
+        if not force and now - self._last_checkpoint.get(job_id, 0) < self.checkpoint_interval:
+            return
+        self._last_checkpoint[job_id] = now
+
+        if "resume_state" in fields:
+            fields["resume_state"] = json.dumps(fields["resume_state"])
+        columns = [c for c in ("output_path", "bytes_done", "fragment_index", "resume_state") if c in fields]
+        if not columns:
+            return
+        assignments = ", ".join(f"{c} = ?" for c in columns)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments}, updated_at = ? WHERE id = ?",
+                [fields[c] for c in columns] + [time.time(), job_id],
+            )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return JournalEntry(row) if row else None
+
+    def remove(self, job_id):
+        self._last_checkpoint.pop(job_id, None)
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def pending(self):
+        """Незавершённые задачи в порядке постановки"""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs ORDER BY created_at").fetchall()
+        return [JournalEntry(row) for row in rows]
+
+    def claim(self):
+        """Забирает задачи без владельца или с истёкшей арендой.
+
+        Выборка и смена владельца идут в одной транзакции BEGIN IMMEDIATE, поэтому
+        одну запись не заберут два процесса.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT * FROM jobs WHERE owner IS NULL OR lease_until IS NULL OR lease_until < ?"
+                    " ORDER BY created_at",
+                    (now,),
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE jobs SET owner = ?, lease_until = ? WHERE id = ?",
+                    [(self.owner, now + self.lease_seconds, row["id"]) for row in rows],
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return [JournalEntry(row) for row in rows]
+
+    def renew(self):
+        """Продлевает аренду всех записей этого процесса"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ?",
+                (time.time() + self.lease_seconds, self.owner),
+            )
+
+    def release(self):
+        """Отпускает записи этого процесса (при остановке) — их сразу заберёт другой"""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET owner = NULL, lease_until = NULL WHERE owner = ?", (self.owner,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,102 @@
+"""Метрики Prometheus и замер времени этапов задачи"""
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+REGISTRY = CollectorRegistry()
+
+# Этапы длятся от миллисекунд (проверка файла) до десятков минут (загрузка)
+_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+STAGE_SECONDS = Histogram(
+    "vd_stage_duration_seconds", "Длительность этапов задачи", ["stage"],
+    buckets=_DURATION_BUCKETS, registry=REGISTRY,
+)
+JOB_SECONDS = Histogram(
+    "vd_job_duration_seconds", "Длительность задачи от постановки в очередь до конца", ["status"],
+    buckets=_DURATION_BUCKETS, registry=REGISTRY,
+)
+JOBS = Counter(
+    "vd_jobs_total", "Запросы на загрузку по результату (started, cache_hit, coalesced, rejected)", ["result"],
+    registry=REGISTRY,
+)
+PROBES = Counter(
+    "vd_probes_total", "Запросы /api/probe и использование их результатов загрузками (hit, miss, reused, error)",
+    ["result"], registry=REGISTRY,
+)
+TRANSCODES = Counter(
+    "vd_transcodes_total", "Обработки ffmpeg по результату (copy — без перекодирования, encode, faststart — перенос индекса mp4, failed)", ["mode"],
+    registry=REGISTRY,
+)
+ERRORS = Counter("vd_errors_total", "Ошибки задач по категориям", ["category"], registry=REGISTRY)
+# Хост берётся из ссылок пользователей, поэтому в метку попадают только известные
+# хосты (см. host_label), остальные считаются вместе как "other"
+DOWNLOADED_BYTES = Counter("vd_downloaded_bytes_total", "Скачано байт по хостам", ["host"], registry=REGISTRY)
+THROUGHPUT = Histogram(
+    "vd_download_throughput_bytes_per_second", "Средняя скорость загрузки задачи по хостам", ["host"],
+    buckets=(64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6), registry=REGISTRY,
+)
+
+# Значения, которые снимаются в момент запроса /metrics
+QUEUE_DEPTH = Gauge("vd_queue_depth", "Задач в очереди", registry=REGISTRY)
+ACTIVE_JOBS = Gauge("vd_active_jobs", "Выполняющихся задач", registry=REGISTRY)
+ACTIVE_SUBPROCESSES = Gauge("vd_active_subprocesses", "Запущенных процессов yt-dlp", registry=REGISTRY)
+CACHE_HITS = Gauge("vd_cache_hits", "Попаданий в кэш с запуска", registry=REGISTRY)
+CACHE_MISSES = Gauge("vd_cache_misses", "Промахов кэша с запуска", registry=REGISTRY)
+CACHE_HIT_RATIO = Gauge("vd_cache_hit_ratio", "Доля попаданий в кэш", registry=REGISTRY)
+CACHE_BYTES = Gauge("vd_cache_bytes", "Объём файлов в кэше", registry=REGISTRY)
+TEMP_BYTES = Gauge("vd_temp_bytes_used", "Объём файлов задач во временной папке", registry=REGISTRY)
+TEMP_FREE_BYTES = Gauge("vd_temp_free_bytes", "Свободно на диске временной папки", registry=REGISTRY)
+TRANSCODE_ACTIVE = Gauge("vd_transcode_active", "Выполняющихся процессов ffmpeg", registry=REGISTRY)
+TRANSCODE_WAITING = Gauge("vd_transcode_waiting", "Файлов в очереди на обработку ffmpeg", registry=REGISTRY)
+JOB_RECORDS = Gauge("vd_job_records", "Записей о задачах в хранилище", registry=REGISTRY)
+
+
+def host_label(host, known_hosts):
+    """Метка хоста для метрик: известный домен (поддомены — к нему) или other"""
+    host = host.lower().rstrip(".")
+    for known in known_hosts:
+        if host == known or host.endswith("." + known):
+            return known
+    return "other"
+
+
+class StageTimer:
+    """Время этапов одной задачи.
+
+    enter() закрывает текущий этап и начинает следующий; повторный этап
+    (например, несколько загрузок дорожек) прибавляется к уже набранному.
+    """
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.stage = None
+        self.timings = {}
+        self._started = None
+
+    def enter(self, stage):
+        now = time.monotonic()
+        self._close(now)
+        self.stage = stage
+        self._started = now
+
+    def stop(self):
+        self._close(time.monotonic())
+        self.stage = None
+
+    def total(self):
+        return time.monotonic() - self.created
+
+    def snapshot(self):
+        """Время этапов в секундах, включая текущий незавершённый"""
+        timings = dict(self.timings)
+        if self.stage is not None:
+            timings[self.stage] = round(timings.get(self.stage, 0) + time.monotonic() - self._started, 3)
+        return timings
+
+    def _close(self, now):
+        if self.stage is None:
+            return
+        elapsed = now - self._started
+        STAGE_SECONDS.labels(self.stage).observe(elapsed)
+        self.timings[self.stage] = round(self.timings.get(self.stage, 0) + elapsed, 3)
@@ -0,0 +1,189 @@
+"""Информация о видео без загрузки и кэш результатов извлечения"""
+import asyncio
+import json
+import re
+import time
+from collections import OrderedDict
+
+from cache import extract_video_id, normalize_url
+
+
+class ProbeError(Exception):
+    """Не удалось получить информацию о видео"""
+
+
+_ERROR_PREFIX_RE = re.compile(r'^(?:ERROR:|yt-dlp: error:)\s*')
+_REPORT_TAIL_RE = re.compile(r';\s*please report this issue.*$', re.IGNORECASE | re.DOTALL)
+
+
+def clean_error(message):
+    """Текст ошибки yt-dlp без префикса ERROR: и просьбы сообщить о баге"""
+    lines = [line for line in message.strip().splitlines() if line.strip()]
+    message = lines[-1] if lines else "yt-dlp завершился с ошибкой"
+    return _REPORT_TAIL_RE.sub("", _ERROR_PREFIX_RE.sub("", message)).strip()
+
+
+def make_probe_key(url):
+    """Ключ кэша: id видео (если известен) или нормализованный URL"""
+    return extract_video_id(url) or normalize_url(url)
+
+
+class ProbeCache:
+    """Результаты извлечения yt-dlp (info JSON) на ttl секунд.
+
+    Ссылки на файлы внутри info подписаны и со временем истекают, поэтому ttl
+    короткий. Одновременные запросы одного URL ждут одно извлечение.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # ключ -> (время извлечения, info)
+        self._inflight = {}             # ключ -> задача извлечения
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def get(self, url):
+        """Свежий info для url или None"""
+        key = make_probe_key(url)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, url, info):
+        key = make_probe_key(url)
+        self._entries[key] = (time.time(), info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, url):
+        """Забывает info (например, если ссылки в нём уже не работают)"""
+        self._entries.pop(make_probe_key(url), None)
+
+    async def fetch(self, url, extract):
+        """Возвращает (info, cache_hit); extract(url) вызывается только при промахе"""
+        info = self.get(url)
+        if info is not None:
+            self.hits += 1
+            return info, True
+
+        key = make_probe_key(url)
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            # Отдельная задача: отключение первого клиента не прерывает извлечение для остальных
+            task = self._inflight[key] = asyncio.create_task(self._extract(url, key, extract))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task), False
+
+    async def _extract(self, url, key, extract):
+        try:
+            info = await extract(url)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        self.put(url, info)
+        return info
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+        }
+
+
+async def extract_info(url, format_selector, timeout):
+    """Извлекает info JSON одним вызовом yt-dlp без загрузки файла"""
+    process = await asyncio.create_subprocess_exec(
+        "yt-dlp",
+        "--dump-single-json",     # Только информация, без загрузки
+        "--no-playlist",
+        "--no-warnings",
+        "-f", format_selector,    # Чтобы в ответе был формат, который выберет загрузка
+        "--extractor-args", "youtube:player_client=android",
+        url,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise ProbeError(f"Информация о видео не получена за {timeout} с")
+    if process.returncode != 0:
+        raise ProbeError(clean_error(stderr.decode("utf-8", errors="ignore")))
+
+    try:
+        return json.loads(stdout)
+    except ValueError:
+        raise ProbeError("yt-dlp вернул некорректный JSON")
+
+
+def _format_size(fmt):
+    return fmt.get("filesize") or fmt.get("filesize_approx")
+
+
+def summarize_info(info):
+    """Краткая информация для клиента: название, длительность, форматы и размеры"""
+    formats = []
+    for fmt in info.get("formats") or []:
+        # Служебные форматы (раскадровки) скачать нельзя
+        if fmt.get("format_note") == "storyboard" or fmt.get("ext") == "mhtml":
+            continue
+        formats.append({
+            "format_id": fmt.get("format_id"),
+            "ext": fmt.get("ext"),
+            "resolution": fmt.get("resolution"),
+            "height": fmt.get("height"),
+            "fps": fmt.get("fps"),
+            "vcodec": fmt.get("vcodec"),
+            "acodec": fmt.get("acodec"),
+            "tbr": fmt.get("tbr"),
+            "protocol": fmt.get("protocol"),
+            "filesize": _format_size(fmt),
+        })
+
+    # Формат, который выберет загрузка по умолчанию (видео и аудио могут быть отдельно)
+    requested = info.get("requested_formats") or ([info] if info.get("format_id") else [])
+    sizes = [_format_size(fmt) for fmt in requested]
+    selected = None
+    if requested:
+        selected = {
+            "format_id": info.get("format_id"),
+            "ext": info.get("ext"),
+            "height": info.get("height"),
+            "filesize": sum(sizes) if sizes and all(sizes) else None,
+        }
+
+    return {
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "duration": info.get("duration"),
+        "uploader": info.get("uploader"),
+        "extractor": info.get("extractor_key") or info.get("extractor"),
+        "webpage_url": info.get("webpage_url"),
+        "is_live": info.get("is_live"),
+        "thumbnail": info.get("thumbnail"),
+        "thumbnails": [
+            {"url": t.get("url"), "width": t.get("width"), "height": t.get("height")}
+            for t in info.get("thumbnails") or [] if t.get("url")
+        ],
+        "formats": formats,
+        "selected": selected,
+    }
@@ -0,0 +1,204 @@
+"""Разбор вывода yt-dlp: машиночитаемый прогресс через --progress-template"""
+import json
+import re
+from collections import deque
+
+# Маркеры строк, которые печатает yt-dlp по нашим шаблонам
+PROGRESS_MARKER = "[vd-progress]"
+POSTPROCESS_MARKER = "[vd-postprocess]"
+FILEPATH_MARKER = "[vd-filepath]"
+
+_PROGRESS_FIELDS = (
+    "status", "downloaded_bytes", "total_bytes", "total_bytes_estimate",
+    "speed", "eta", "fragment_index", "fragment_count", "filename", "tmpfilename",
+)
+
+# Шаблоны для --progress-template: одна JSON-строка на каждое обновление
+PROGRESS_TEMPLATE = "download:%s {%s}" % (
+    PROGRESS_MARKER,
+    ",".join('"%s":%%(progress.%s)j' % (name, name) for name in _PROGRESS_FIELDS),
+)
+POSTPROCESS_TEMPLATE = 'postprocess:%s {"status":%%(progress.status)j,"postprocessor":%%(progress.postprocessor)j}' % (
+    POSTPROCESS_MARKER,
+)
+# Для --print: итоговый путь после всех перемещений и постобработки
+FILEPATH_TEMPLATE = "after_move:%s %%(filepath)s" % FILEPATH_MARKER
+
+# yt-dlp подставляет NA вместо отсутствующих полей — это не JSON
+_NA_RE = re.compile(r':NA(?=[,}])')
+# Классический вывод: "[download]  45.2% of ~123.45MiB at 1.2MiB/s ETA 00:10 (frag 3/40)"
+_LEGACY_PROGRESS_RE = re.compile(
+    r'^\[download\]\s+(?P<percent>\d+(?:\.\d+)?)%'
+    r'(?:\s+of\s+~?\s*(?P<size>[\d.]+\s*[KMGT]?i?B))?'
+    r'(?:.*?\(frag\s+(?P<frag>\d+)/(?P<frags>\d+)\))?'
+)
+_DESTINATION_RE = re.compile(r'^\[(?:download|ExtractAudio|VideoConvertor|VideoRemuxer)\]\s+Destination:\s*(?P<path>.+)$')
+_MERGING_RE = re.compile(r'^\[Merger\]\s+Merging formats into\s+"?(?P<path>.+?)"?$')
+_ALREADY_RE = re.compile(r'^\[download\]\s+(?P<path>.+?)\s+has already been downloaded')
+_ERROR_RE = re.compile(r'^(?:ERROR:|yt-dlp: error:)\s*(?P<message>.+)$')
+_STAGE_RE = re.compile(r'^\[(?P<extractor>[\w:]+)\]\s+(?:[\w-]+:\s+)?(?P<stage>Extracting|Downloading)\b')
+
+_POSTPROCESSOR_MESSAGES = {
+    "Merger": "Объединение видео и аудио...",
+    "ExtractAudio": "Обработка аудио...",
+    "FFmpegExtractAudio": "Обработка аудио...",
+    "FixupM3u8": "Исправление контейнера HLS...",
+    "MoveFiles": "Перемещение файла...",
+}
+
+# Меньше этого размера «видео», скорее всего, не полное
+_SMALL_FILE_BYTES = 1000 * 1024
+
+
+def _format_size(size):
+    return f"{size / (1024 * 1024):.1f} МБ" if size >= 1024 * 1024 else f"{size / 1024:.1f} КБ"
+
+
+class YtDlpOutputParser:
+    """Разбирает вывод yt-dlp построчно и накапливает состояние загрузки.
+
+    feed() возвращает словарь полей для set_progress или None, если строка
+    ничего не меняет. Для диагностики хранится только кольцевой буфер
+    последних строк и последних ошибок.
+    """
+
+    def __init__(self, history=20):
+        self.recent = deque(maxlen=history)
+        self.errors = deque(maxlen=5)
+        self.lines_read = 0
+        self.progress = 0.0
+        self.downloaded_bytes = None
+        self.total_bytes = None
+        self.speed = None
+        self.eta = None
+        self.fragment_index = None
+        self.fragment_count = None
+        self.filename = None
+        self.tmpfilename = None   # Файл, который пишется сейчас (.part)
+        self.final_path = None    # Итоговый файл, о котором сообщил yt-dlp
+        self.stage = None         # Текущий этап: download или postprocess
+
+    def feed(self, line):
+        """Обрабатывает одну строку вывода"""
+        line = line.strip()
+        if not line:
+            return None
+        self.lines_read += 1
+
+        if line.startswith(PROGRESS_MARKER):
+            return self._feed_progress(line[len(PROGRESS_MARKER):])
+        if line.startswith(POSTPROCESS_MARKER):
+            return self._feed_postprocess(line[len(POSTPROCESS_MARKER):])
+        if line.startswith(FILEPATH_MARKER):
+            self.final_path = self.filename = line[len(FILEPATH_MARKER):].strip()
+            return None
+
+        self.recent.append(line)
+
+        match = _LEGACY_PROGRESS_RE.match(line)
+        if match:
+            return self._feed_legacy_progress(match)
+
+        match = _DESTINATION_RE.match(line) or _MERGING_RE.match(line) or _ALREADY_RE.match(line)
+        if match:
+            self.filename = match.group("path").strip()
+            if line.startswith("[Merger]"):
+                self.stage = "postprocess"
+                return {"message": _POSTPROCESSOR_MESSAGES["Merger"]}
+            return None
+
+        match = _ERROR_RE.match(line)
+        if match:
+            self.errors.append(match.group("message"))
+            return {"message": f"Ошибка: {line[:100]}"}
+
+        if line.startswith("WARNING:"):
+            return None
+
+        if self.lines_read == 1:
+            return {"message": f"Запуск: {line[:60]}"}
+        if _STAGE_RE.match(line):
+            return {"message": line[:80]}
+        return None
+
+    def _feed_progress(self, payload):
+        try:
+            data = json.loads(_NA_RE.sub(":null", payload))
+        except ValueError:
+            return None
+
+        self.stage = "download"
+        self.downloaded_bytes = data.get("downloaded_bytes")
+        self.total_bytes = data.get("total_bytes") or data.get("total_bytes_estimate")
+        self.speed = data.get("speed")
+        self.eta = data.get("eta")
+        self.fragment_index = data.get("fragment_index")
+        self.fragment_count = data.get("fragment_count")
+        if data.get("filename"):
+            self.filename = data["filename"]
+        self.tmpfilename = data.get("tmpfilename") or self.filename
+
+        if self.fragment_count:
+            self.progress = min((self.fragment_index or 0) / self.fragment_count * 100, 100)
+        elif self.total_bytes and self.downloaded_bytes is not None:
+            self.progress = min(self.downloaded_bytes / self.total_bytes * 100, 100)
+        if data.get("status") == "finished":
+            self.progress = 100.0
+
+        return self._progress_update()
+
+    def _feed_legacy_progress(self, match):
+        self.progress = float(match.group("percent"))
+        if match.group("frags"):
+            self.fragment_index = int(match.group("frag"))
+            self.fragment_count = int(match.group("frags"))
+        update = {"progress": self.progress}
+        size = match.group("size")
+        if size:
+            update["message"] = f"Загрузка: {self.progress:.1f}% ({size})"
+        else:
+            update["message"] = f"Загрузка: {self.progress:.1f}%"
+        return update
+
+    def _feed_postprocess(self, payload):
+        try:
+            data = json.loads(_NA_RE.sub(":null", payload))
+        except ValueError:
+            return None
+        if data.get("status") != "started":
+            return None
+        self.stage = "postprocess"
+        name = data.get("postprocessor") or ""
+        return {"message": _POSTPROCESSOR_MESSAGES.get(name, f"Обработка: {name}...")}
+
+    def _progress_update(self):
+        progress = round(self.progress, 1)
+        if self.fragment_count:
+            message = f"Загрузка фрагментов: {self.fragment_index or 0}/{self.fragment_count} ({progress:.1f}%)"
+        elif self.total_bytes:
+            if self.total_bytes < _SMALL_FILE_BYTES:
+                message = f"⚠️ Внимание: маленький файл ({_format_size(self.total_bytes)}). Возможно, это не полное видео."
+            else:
+                message = f"Загрузка: {progress:.1f}% ({_format_size(self.total_bytes)})"
+        elif self.downloaded_bytes:
+            message = f"Загрузка: {_format_size(self.downloaded_bytes)}"
+        else:
+            message = "Загрузка..."
+        return {
+            "progress": progress,
+            "message": message,
+            "downloaded_bytes": self.downloaded_bytes,
+            "total_bytes": self.total_bytes,
+            "speed": self.speed,
+            "eta": self.eta,
+            "fragment_index": self.fragment_index,
+            "fragment_count": self.fragment_count,
+        }
+
+    def error_summary(self):
+        """Краткое описание ошибки для пользователя"""
+        if self.errors:
+            return self.errors[-1]
+        if self.recent:
+            return "\n".join(list(self.recent)[-3:])
+        return "Неизвестная ошибка при загрузке"
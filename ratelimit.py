@@ -0,0 +1,193 @@
+"""Ограничение скорости загрузок: общая полоса поровну между задачами и квоты клиентов"""
+import asyncio
+import time
+from collections import defaultdict, deque
+
+
+class QuotaExceededError(Exception):
+    """Клиент исчерпал квоту; повторить можно через retry_after секунд"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Маркерное ведро: не больше rate байт в секунду (0 — без ограничения).
+
+    rate можно менять на ходу. Потребители, взявшие больше накопленного,
+    ждут своей очереди, поэтому общий поток не превышает rate и при
+    нескольких параллельных соединениях.
+    """
+
+    def __init__(self, rate=0, burst_seconds=1.0):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+    async def consume(self, amount):
+        rate = self.rate
+        if not rate:
+            return
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated) * rate, rate * self.burst_seconds)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / rate)
+
+
+class BandwidthAllocator:
+    """Делит общую полосу между выполняющимися задачами.
+
+    Задачи с on_change получают поровну то, что осталось от total, но не больше
+    per_job (0 — без ограничения); когда задачи появляются и завершаются, доли
+    пересчитываются и сообщаются через on_change(rate).
+
+    Задача без on_change (отдельный процесс yt-dlp с --limit-rate) скорость на ходу
+    не меняет: её доля фиксируется при запуске и резервируется до конца задачи.
+    Чтобы полоса осталась и следующим задачам, фиксированная доля — это остаток
+    полосы, поделённый на свободные слоты (slots — сколько задач выполняется
+    одновременно). Сумма всех долей не превышает total.
+    """
+
+    def __init__(self, total, per_job, slots=0):
+        self.total = total
+        self.per_job = per_job
+        self.slots = slots
+        self._jobs = {}       # job_id -> on_change задачи с меняемой долей
+        self._reserved = {}   # job_id -> фиксированная доля
+        self.rebalances = 0
+
+    def _limit(self, rate):
+        limits = [limit for limit in (rate if self.total else 0, self.per_job) if limit]
+        # Доля 0 означала бы «без ограничения» — меньше 1 байта в секунду не даём
+        return max(int(min(limits)), 1) if limits else 0
+
+    def _left(self):
+        """Полоса, не занятая фиксированными долями"""
+        return max(self.total - sum(self._reserved.values()), 0)
+
+    def share(self, jobs=None):
+        """Доля одной задачи с меняемой скоростью в байтах в секунду (0 — без ограничения)"""
+        jobs = len(self._jobs) if jobs is None else jobs
+        return self._limit(self._left() / max(jobs, 1))
+
+    def add(self, job_id, on_change=None):
+        """Учитывает задачу и возвращает её долю"""
+        if on_change is None:
+            # Свободные слоты: эта задача, задачи с меняемой долей и те, что ещё могут начаться
+            free = max(self.slots - len(self._reserved), len(self._jobs) + 1)
+            rate = self._limit(self._left() / free)
+            self._reserved[job_id] = rate if self.total else 0
+            self._rebalance()
+            return rate
+        self._jobs[job_id] = on_change
+        self._rebalance()
+        return self.share()
+
+    def remove(self, job_id):
+        reserved = self._reserved.pop(job_id, None) is not None
+        if self._jobs.pop(job_id, None) is not None or reserved:
+            self._rebalance()
+
+    def _rebalance(self):
+        rate = self.share()
+        self.rebalances += 1
+        for on_change in self._jobs.values():
+            on_change(rate)
+
+    def stats(self):
+        return {
+            "total": self.total,
+            "per_job": self.per_job,
+            "jobs": len(self._jobs) + len(self._reserved),
+            "reserved": sum(self._reserved.values()),
+            "share": self.share(),
+            "rebalances": self.rebalances,
+        }
+
+
+class ClientQuotas:
+    """Квоты по IP клиента: одновременные задачи и объём за последний час"""
+
+    def __init__(self, max_active_jobs, max_bytes_per_hour, window=3600):
+        self.max_active_jobs = max_active_jobs
+        self.max_bytes_per_hour = max_bytes_per_hour
+        self.window = window
+        self._jobs = defaultdict(set)        # ip -> download_id задач клиента
+        self._owners = {}                    # download_id -> ip
+        self._usage = defaultdict(deque)     # ip -> (время, байт) за окно
+        self.rejected = 0
+
+    def check(self, ip, is_active, count=1):
+        """Бросает QuotaExceededError, если клиенту нельзя начать count новых задач.
+
+        is_active(download_id) сообщает, выполняется ли ещё задача клиента.
+        """
+        jobs = self._jobs.get(ip)
+        if jobs:
+            # Завершённые задачи забываем при проверке, отдельного учёта окончания не нужно
+            for download_id in [d for d in jobs if not is_active(d)]:
+                jobs.discard(download_id)
+                self._owners.pop(download_id, None)
+            if not jobs:
+                del self._jobs[ip]
+        active = len(jobs) if jobs else 0
+        if self.max_active_jobs and active + count > self.max_active_jobs:
+            self.rejected += 1
+            raise QuotaExceededError(
+                f"Не больше {self.max_active_jobs} одновременных загрузок с одного адреса"
+                + (f" (выполняется {active}, в пакете {count})" if count > 1 else ""),
+                10,
+            )
+        if self.max_bytes_per_hour:
+            used, retry_after = self._used(ip)
+            if used >= self.max_bytes_per_hour:
+                self.rejected += 1
+                raise QuotaExceededError(
+                    f"Превышен объём загрузок за час ({self.max_bytes_per_hour // (1024 * 1024)} МБ)", retry_after,
+                )
+
+    def add_job(self, ip, download_id):
+        self._jobs[ip].add(download_id)
+        self._owners[download_id] = ip
+
+    def forget(self, download_id):
+        """Забывает задачу клиента (она завершена и удалена)"""
+        ip = self._owners.pop(download_id, None)
+        jobs = self._jobs.get(ip)
+        if jobs is not None:
+            jobs.discard(download_id)
+            if not jobs:
+                del self._jobs[ip]
+
+    def record_bytes(self, download_id, size, ip=None):
+        """Засчитывает объём файла клиенту, поставившему задачу"""
+        ip = ip or self._owners.get(download_id)
+        if ip is None or not size:
+            return
+        self._usage[ip].append((time.time(), size))
+
+    def _used(self, ip):
+        """Объём за окно и через сколько секунд освободится самая старая запись"""
+        usage = self._usage.get(ip)
+        if not usage:
+            return 0, 0
+        cutoff = time.time() - self.window
+        while usage and usage[0][0] < cutoff:
+            usage.popleft()
+        if not usage:
+            del self._usage[ip]
+            return 0, 0
+        return sum(size for _, size in usage), max(1, int(usage[0][0] - cutoff))
+
+    def stats(self):
+        return {
+            "max_active_jobs": self.max_active_jobs,
+            "max_bytes_per_hour": self.max_bytes_per_hour,
+            "clients": len(self._jobs),
+            "tracked_jobs": len(self._owners),
+            "rejected": self.rejected,
+        }
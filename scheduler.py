@@ -0,0 +1,160 @@
+"""Планировщик загрузок: общий пул воркеров, лимит на хост и очередь с приоритетами"""
+import asyncio
+import heapq
+import itertools
+from collections import defaultdict
+from urllib.parse import urlparse
+
+
+class QueueFullError(Exception):
+    """Очередь переполнена, клиенту нужно повторить запрос позже"""
+
+    def __init__(self, retry_after):
+        super().__init__("Download queue is full")
+        self.retry_after = retry_after
+
+
+def get_host(url):
+    """Возвращает хост-источник для URL (используется для лимита на хост)"""
+    try:
+        return (urlparse(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+class _QueuedJob:
+    __slots__ = ("job_id", "host", "factory")
+
+    def __init__(self, job_id, host, factory):
+        self.job_id = job_id
+        self.host = host
+        self.factory = factory
+
+
+class DownloadScheduler:
+    """Запускает задачи не больше max_workers одновременно и не больше max_per_host на хост.
+
+    Задачи ждут в очереди, упорядоченной по приоритету (больше — раньше), внутри
+    одного приоритета — FIFO. Задача, чей хост уже занят, не блокирует остальные.
+    """
+
+    def __init__(self, max_workers, max_per_host, max_queue, retry_after=10):
+        self.max_workers = max(1, max_workers)
+        self.max_per_host = max(1, max_per_host)
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._heap = []                       # (-priority, seq, job)
+        self._queued = {}                     # job_id -> job
+        self._active = {}                     # job_id -> asyncio.Task
+        self._hosts = {}                      # job_id -> хост выполняющейся задачи
+        self._tasks = {}                      # job_id -> asyncio.Task (и после release, до конца задачи)
+        self._active_per_host = defaultdict(int)
+        self._seq = itertools.count()
+
+    def submit(self, job_id, url, factory, priority=0):
+        """Ставит задачу в очередь. factory() должна возвращать корутину загрузки.
+
+        Возвращает позицию в очереди (0 — задача уже запущена).
+        """
+        if len(self._queued) >= self.max_queue:
+            raise QueueFullError(self.retry_after)
+
+        job = _QueuedJob(job_id, get_host(url), factory)
+        heapq.heappush(self._heap, (-priority, next(self._seq), job))
+        self._queued[job_id] = job
+        self._dispatch()
+        return self.position(job_id) or 0
+
+    def cancel(self, job_id):
+        """Убирает задачу из очереди, если она ещё не запущена"""
+        job = self._queued.pop(job_id, None)
+        if job is None:
+            return False
+        self._heap = [entry for entry in self._heap if entry[2] is not job]
+        heapq.heapify(self._heap)
+        return True
+
+    def stop(self, job_id):
+        """Отменяет выполняющуюся задачу (CancelledError внутри неё)"""
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    async def shutdown(self, timeout):
+        """Очищает очередь, отменяет выполняющиеся задачи и ждёт их не дольше timeout секунд"""
+        self._heap.clear()
+        self._queued.clear()
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def position(self, job_id):
+        """Позиция задачи в очереди (с 1) или None, если задача не ждёт"""
+        if job_id not in self._queued:
+            return None
+        for index, entry in enumerate(sorted(self._heap, key=lambda e: e[:2]), start=1):
+            if entry[2].job_id == job_id:
+                return index
+        return None
+
+    def release(self, job_id):
+        """Освобождает слот задачи до её завершения.
+
+        Задача продолжает выполняться, но больше не занимает место в пуле
+        загрузок (например, пока ждёт ffmpeg в своём пуле).
+        """
+        if self._active.pop(job_id, None) is None:
+            return
+        host = self._hosts.pop(job_id)
+        self._active_per_host[host] -= 1
+        if self._active_per_host[host] <= 0:
+            del self._active_per_host[host]
+        self._dispatch()
+
+    def is_active(self, job_id):
+        return job_id in self._active
+
+    def stats(self):
+        return {
+            "active": len(self._active),
+            "queued": len(self._queued),
+            "max_workers": self.max_workers,
+            "max_per_host": self.max_per_host,
+            "active_per_host": {h: n for h, n in self._active_per_host.items() if n},
+        }
+
+    def _dispatch(self):
+        """Запускает ожидающие задачи, пока есть свободные слоты"""
+        if len(self._active) >= self.max_workers or not self._heap:
+            return
+
+        skipped = []
+        while self._heap and len(self._active) < self.max_workers:
+            entry = heapq.heappop(self._heap)
+            job = entry[2]
+            if self._active_per_host[job.host] >= self.max_per_host:
+                # Хост занят — пропускаем, чтобы не блокировать задачи других хостов
+                skipped.append(entry)
+                continue
+            self._start(job)
+
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+
+    def _start(self, job):
+        self._queued.pop(job.job_id, None)
+        self._active_per_host[job.host] += 1
+        self._hosts[job.job_id] = job.host
+        task = asyncio.create_task(job.factory())
+        # Колбэк, а не finally: задача, отменённая до первого шага, тоже освобождает слот
+        task.add_done_callback(lambda _, job_id=job.job_id: self._finished(job_id))
+        self._active[job.job_id] = task
+        self._tasks[job.job_id] = task
+
+    def _finished(self, job_id):
+        self._tasks.pop(job_id, None)
+        self.release(job_id)
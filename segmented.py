@@ -0,0 +1,431 @@
+"""Встроенная загрузка HLS/DASH: фрагменты качаются параллельно через общий пул соединений"""
+import asyncio
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from urllib.parse import urljoin, urlsplit
+
+import httpx
+
+
+class UnsupportedManifest(Exception):
+    """Манифест не поддерживается встроенным движком — нужен yt-dlp"""
+
+
+class SegmentDownloadError(Exception):
+    """Фрагмент не удалось скачать после всех повторов"""
+
+
+# Фрагмент держится в памяти, пока не дойдёт очередь записи: больший — не фрагмент, а файл целиком
+MAX_FRAGMENT_BYTES = 32 * 1024 * 1024
+
+
+class Fragment:
+    __slots__ = ("url", "byte_range")
+
+    def __init__(self, url, byte_range=None):
+        self.url = url
+        self.byte_range = byte_range   # (start, end) включительно или None
+
+
+class Track:
+    """Одна дорожка: init-сегмент (для fMP4) и список фрагментов"""
+
+    def __init__(self, fragments, init=None, container="ts", kind="muxed"):
+        self.fragments = fragments
+        self.init = init
+        self.container = container     # "ts" или "mp4"
+        self.kind = kind               # "muxed", "video" или "audio"
+
+
+def is_manifest_url(url):
+    """Похож ли URL на манифест HLS/DASH"""
+    path = urlsplit(url).path.lower()
+    return path.endswith((".m3u8", ".m3u", ".mpd"))
+
+
+# --- HLS ---
+
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+_BYTERANGE_RE = re.compile(r'(\d+)(?:@(\d+))?')
+
+
+def _parse_attrs(value):
+    return {k: v.strip('"') for k, v in _ATTR_RE.findall(value)}
+
+
+def _parse_byterange(value, next_offset):
+    match = _BYTERANGE_RE.match(value)
+    length = int(match.group(1))
+    start = int(match.group(2)) if match.group(2) is not None else next_offset
+    return (start, start + length - 1)
+
+
+def pick_hls_variant(text, base_url, max_height=None):
+    """Выбирает вариант с наибольшим битрейтом в master-плейлисте (None, если это media-плейлист)"""
+    variants = []
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if not line.startswith("#EXT-X-STREAM-INF:"):
+            continue
+        attrs = _parse_attrs(line.split(":", 1)[1])
+        uri = next((l.strip() for l in lines[i + 1:] if l.strip() and not l.startswith("#")), None)
+        if uri is None:
+            continue
+        height = None
+        if "RESOLUTION" in attrs and "x" in attrs["RESOLUTION"]:
+            height = int(attrs["RESOLUTION"].split("x")[1])
+        if "AUDIO" in attrs:
+            # Аудио отдельной дорожкой — это уже задача для yt-dlp
+            raise UnsupportedManifest("HLS с отдельными аудиодорожками")
+        variants.append((int(attrs.get("BANDWIDTH", 0)), height, urljoin(base_url, uri)))
+
+    if not variants:
+        return None
+    if max_height:
+        fitting = [v for v in variants if v[1] is None or v[1] <= max_height]
+        variants = fitting or [min(variants, key=lambda v: v[1] or 0)]
+    return max(variants, key=lambda v: v[0])[2]
+
+
+def parse_hls_media_playlist(text, base_url):
+    """Разбирает media-плейлист HLS в дорожку"""
+    if "#EXT-X-ENDLIST" not in text:
+        raise UnsupportedManifest("Прямые трансляции HLS")
+
+    fragments = []
+    init = None
+    pending_range = None
+    next_offset = 0
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        if line.startswith("#EXT-X-KEY:"):
+            attrs = _parse_attrs(line.split(":", 1)[1])
+            if attrs.get("METHOD", "NONE") != "NONE":
+                raise UnsupportedManifest("Зашифрованный HLS")
+        elif line.startswith("#EXT-X-MAP:"):
+            attrs = _parse_attrs(line.split(":", 1)[1])
+            byte_range = _parse_byterange(attrs["BYTERANGE"], 0) if "BYTERANGE" in attrs else None
+            init = Fragment(urljoin(base_url, attrs["URI"]), byte_range)
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            pending_range = _parse_byterange(line.split(":", 1)[1], next_offset)
+        elif not line.startswith("#"):
+            fragments.append(Fragment(urljoin(base_url, line), pending_range))
+            if pending_range:
+                next_offset = pending_range[1] + 1
+            pending_range = None
+
+    if not fragments:
+        raise UnsupportedManifest("Пустой плейлист HLS")
+    return Track(fragments, init, container="mp4" if init else "ts")
+
+
+# --- DASH ---
+
+def _strip_ns(tree):
+    for el in tree.iter():
+        if isinstance(el.tag, str) and "}" in el.tag:
+            el.tag = el.tag.split("}", 1)[1]
+    return tree
+
+
+def _parse_duration(value):
+    """ISO 8601 длительность (PT1H2M3.5S) в секунды"""
+    match = re.match(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?', value or "")
+    if not match:
+        return 0.0
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)
+
+
+def _fill_template(template, rep_id, bandwidth, number=None, time_=None):
+    def repl(match):
+        name, fmt = match.group(1), match.group(2)
+        value = {"RepresentationID": rep_id, "Bandwidth": bandwidth, "Number": number, "Time": time_}.get(name)
+        if value is None:
+            return match.group(0)
+        return (fmt % value) if fmt else str(value)
+    return re.sub(r'\$(RepresentationID|Bandwidth|Number|Time)(%0\d+d)?\$', repl, template).replace("$$", "$")
+
+
+def _dash_track(rep, adaptation, period, base_url, total_duration):
+    """Строит дорожку для Representation"""
+    for el in (period, adaptation, rep):
+        base = el.find("BaseURL")
+        if base is not None and base.text:
+            base_url = urljoin(base_url, base.text.strip())
+
+    rep_id = rep.get("id", "")
+    bandwidth = int(rep.get("bandwidth") or 0)   # Для $Bandwidth%05d$ нужно число
+    template = rep.find("SegmentTemplate")
+    if template is None:
+        template = adaptation.find("SegmentTemplate")
+    segment_list = rep.find("SegmentList")
+
+    if template is not None:
+        init = None
+        if template.get("initialization"):
+            init = Fragment(urljoin(base_url, _fill_template(template.get("initialization"), rep_id, bandwidth)))
+        media = template.get("media")
+        start_number = int(template.get("startNumber", "1"))
+        timescale = int(template.get("timescale", "1"))
+        fragments = []
+        timeline = template.find("SegmentTimeline")
+        if timeline is not None:
+            number, t = start_number, 0
+            for s in timeline.findall("S"):
+                t = int(s.get("t", t))
+                d = int(s.get("d"))
+                for _ in range(int(s.get("r", "0")) + 1):
+                    fragments.append(Fragment(urljoin(base_url, _fill_template(media, rep_id, bandwidth, number, t))))
+                    number += 1
+                    t += d
+        else:
+            duration = int(template.get("duration", "0"))
+            if not duration or not total_duration:
+                raise UnsupportedManifest("SegmentTemplate без длительности")
+            count = int(-(-total_duration * timescale // duration))
+            for number in range(start_number, start_number + count):
+                fragments.append(Fragment(urljoin(base_url, _fill_template(media, rep_id, bandwidth, number))))
+        return Track(fragments, init, container="mp4")
+
+    if segment_list is not None:
+        init_el = segment_list.find("Initialization")
+        init = Fragment(urljoin(base_url, init_el.get("sourceURL"))) if init_el is not None else None
+        fragments = [Fragment(urljoin(base_url, s.get("media"))) for s in segment_list.findall("SegmentURL")]
+        return Track(fragments, init, container="mp4")
+
+    # Один файл целиком (BaseURL или SegmentBase): параллельно по фрагментам его не скачать,
+    # а целиком в памяти он не поместится — это делает yt-dlp
+    raise UnsupportedManifest("DASH без сегментов (один файл на дорожку)")
+
+
+def parse_dash_manifest(text, base_url, max_height=None):
+    """Выбирает лучшие видео- и аудиодорожки в MPD"""
+    root = _strip_ns(ET.fromstring(text))
+    if root.get("type") == "dynamic":
+        raise UnsupportedManifest("Прямые трансляции DASH")
+    if root.find(".//ContentProtection") is not None:
+        raise UnsupportedManifest("DASH с DRM")
+
+    period = root.find("Period")
+    if period is None:
+        raise UnsupportedManifest("MPD без Period")
+    total_duration = _parse_duration(period.get("duration") or root.get("mediaPresentationDuration"))
+
+    best = {}
+    for adaptation in period.findall("AdaptationSet"):
+        kind = (adaptation.get("contentType") or adaptation.get("mimeType") or "").split("/")[0]
+        for rep in adaptation.findall("Representation"):
+            rep_kind = kind or (rep.get("mimeType") or "").split("/")[0]
+            if rep_kind not in ("video", "audio"):
+                continue
+            height = int(rep.get("height", "0") or 0)
+            if rep_kind == "video" and max_height and height > max_height:
+                continue
+            score = int(rep.get("bandwidth", "0"))
+            if rep_kind not in best or score > best[rep_kind][0]:
+                best[rep_kind] = (score, rep, adaptation)
+
+    if "video" not in best:
+        raise UnsupportedManifest("MPD без видеодорожки")
+    tracks = []
+    for kind in ("video", "audio"):
+        if kind in best:
+            _, rep, adaptation = best[kind]
+            track = _dash_track(rep, adaptation, period, base_url, total_duration)
+            track.kind = kind
+            tracks.append(track)
+    return tracks
+
+
+# --- Загрузка ---
+
+class SegmentedDownloader:
+    """Качает фрагменты параллельно и записывает их в файл строго по порядку"""
+
+    def __init__(self, client, concurrency=8, retries=3, on_progress=None, limiter=None,
+                 max_fragment_bytes=MAX_FRAGMENT_BYTES):
+        self.client = client
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.max_fragment_bytes = max_fragment_bytes
+        self.on_progress = on_progress
+        self.limiter = limiter    # RateLimiter на всю задачу (общий для всех соединений) или None
+        self.bytes_done = 0
+        self.fragments_done = 0
+        self.fragments_total = 0
+        self.retried = 0
+        self.started = time.monotonic()
+        # Положение внутри текущей дорожки — для продолжения после перезапуска
+        self.track_index = 0
+        self.track_fragments_done = 0
+        self.track_bytes = 0
+
+    async def resolve(self, url, max_height=None):
+        """Загружает манифест и возвращает список дорожек"""
+        response = await self.client.get(url)
+        response.raise_for_status()
+        text = response.text
+        base_url = str(response.url)
+
+        if text.lstrip().startswith("#EXTM3U"):
+            variant = pick_hls_variant(text, base_url, max_height)
+            if variant is not None:
+                response = await self.client.get(variant)
+                response.raise_for_status()
+                text, base_url = response.text, str(response.url)
+            return [parse_hls_media_playlist(text, base_url)]
+        if "<MPD" in text[:2048]:
+            return parse_dash_manifest(text, base_url, max_height)
+        raise UnsupportedManifest("Неизвестный формат манифеста")
+
+    async def fetch(self, fragment):
+        """Скачивает фрагмент с повторами.
+
+        Фрагмент больше max_fragment_bytes — UnsupportedManifest: такой файл качает yt-dlp.
+        """
+        headers = {}
+        if fragment.byte_range:
+            headers["Range"] = "bytes=%d-%d" % fragment.byte_range
+        delay = 0.5
+        for attempt in range(self.retries + 1):
+            try:
+                # Читаем по кускам: размер проверяется до того, как фрагмент окажется в памяти,
+                # а медленное чтение при ограничении скорости притормаживает и TCP
+                chunks = []
+                size = 0
+                async with self.client.stream("GET", fragment.url, headers=headers) as response:
+                    response.raise_for_status()
+                    if int(response.headers.get("content-length") or 0) > self.max_fragment_bytes:
+                        raise UnsupportedManifest("Слишком большой фрагмент")
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > self.max_fragment_bytes:
+                            raise UnsupportedManifest("Слишком большой фрагмент")
+                        if self.limiter is not None:
+                            await self.limiter.consume(len(chunk))
+                        chunks.append(chunk)
+                return b"".join(chunks)
+            except (httpx.HTTPError, httpx.StreamError) as e:
+                if attempt >= self.retries:
+                    raise SegmentDownloadError(f"{fragment.url}: {e}") from e
+                self.retried += 1
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def download_track(self, track, output_path, start_fragment=0, start_bytes=0):
+        """Скачивает дорожку в файл; фрагменты пишутся по порядку по мере готовности.
+
+        start_fragment/start_bytes продолжают прерванную загрузку: файл обрезается
+        до последнего целиком записанного фрагмента, и загрузка идёт с него.
+        """
+        fragments = ([track.init] if track.init else []) + track.fragments
+        if start_fragment and os.path.exists(output_path):
+            out = open(output_path, "r+b")
+            out.truncate(start_bytes)
+            out.seek(start_bytes)
+            self.fragments_done += start_fragment
+            self.bytes_done += start_bytes
+        else:
+            out = open(output_path, "wb")
+            start_fragment = start_bytes = 0
+        self.track_fragments_done = start_fragment
+        self.track_bytes = start_bytes
+
+        loop = asyncio.get_running_loop()
+        # Фрагмент i готов, когда завершён results[i]; первая ошибка любого воркера — в failure
+        results = {index: loop.create_future() for index in range(start_fragment, len(fragments))}
+        failure = loop.create_future()
+        # Не держим в памяти больше окна фрагментов, обгоняющих запись
+        window = asyncio.Semaphore(self.concurrency * 2)
+        queue = asyncio.Queue()
+        for index in range(start_fragment, len(fragments)):
+            queue.put_nowait((index, fragments[index]))
+
+        async def worker():
+            while True:
+                try:
+                    index, fragment = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await window.acquire()
+                try:
+                    data = await self.fetch(fragment)
+                except Exception as e:
+                    if not failure.done():
+                        failure.set_exception(e)
+                    return
+                results[index].set_result(data)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            with out:
+                for index in range(start_fragment, len(fragments)):
+                    ready = results[index]
+                    if not ready.done():
+                        await asyncio.wait((ready, failure), return_when=asyncio.FIRST_COMPLETED)
+                    if failure.done():
+                        failure.result()   # Бросает ошибку воркера
+                    data = ready.result()
+                    del results[index]
+                    out.write(data)
+                    out.flush()
+                    window.release()
+                    self.bytes_done += len(data)
+                    self.fragments_done += 1
+                    self.track_bytes += len(data)
+                    self.track_fragments_done = index + 1
+                    self._report()
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if failure.done():
+                failure.exception()   # Ошибка уже передана выше или больше не нужна
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.started
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+    def _report(self):
+        if self.on_progress is not None:
+            self.on_progress({
+                "downloaded_bytes": self.bytes_done,
+                "fragment_index": self.fragments_done,
+                "fragment_count": self.fragments_total,
+                "throughput": self.throughput(),
+                "retries": self.retried,
+                "resume_state": {
+                    "track": self.track_index,
+                    "fragment": self.track_fragments_done,
+                    "bytes": self.track_bytes,
+                },
+            })
+
+
+async def merge_tracks(paths, output_path, remux_ts=False):
+    """Собирает дорожки в mp4 через ffmpeg без перекодирования"""
+    cmd = ["ffmpeg", "-y", "-loglevel", "error"]
+    for path in paths:
+        cmd += ["-i", path]
+    for index in range(len(paths)):
+        cmd += ["-map", str(index)]
+    cmd += ["-c", "copy"]
+    if remux_ts:
+        cmd += ["-bsf:a", "aac_adtstoasc"]
+    cmd += ["-movflags", "+faststart", output_path]
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise SegmentDownloadError(f"ffmpeg: {stderr.decode('utf-8', errors='ignore')[:300]}")
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
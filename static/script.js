@@ -1,7 +1,13 @@
 let currentDownloadId = null;
 let progressInterval = null;
+let progressSource = null;
+let streamMode = false;
+let streamStarted = false;  // Файл действительно пошёл клиенту через /api/stream
+let downloadFinished = false;
 
 const videoUrlInput = document.getElementById('videoUrl');
+const streamModeInput = document.getElementById('streamMode');
+const qualityInput = document.getElementById('quality');
 const clearBtn = document.getElementById('clearBtn');
 const downloadBtn = document.getElementById('downloadBtn');
 const progressSection = document.getElementById('progressSection');
@@ -68,6 +74,7 @@ function startDownload() {
     // Скрываем предыдущие сообщения
     hideAllSections();
     showProgress();
+    streamMode = streamModeInput.checked;
     
     // Блокируем кнопку
     downloadBtn.disabled = true;
@@ -80,54 +87,118 @@ function startDownload() {
         headers: {
             'Content-Type': 'application/json',
         },
-        body: JSON.stringify({ url: url })
+        body: JSON.stringify({ url: url, stream: streamMode, ...getFormatOptions() })
+    })
+    .then(async response => {
+        const data = await response.json();
+        if (response.status === 429 || response.status === 507) {
+            // Очередь переполнена или на сервере закончилось место
+            const retryAfter = response.headers.get('Retry-After');
+            throw new Error(`${data.detail}${retryAfter ? ` (через ${retryAfter} с)` : ''}`);
+        }
+        if (!response.ok) {
+            throw new Error(data.detail || `HTTP ${response.status}`);
+        }
+        return data;
     })
-    .then(response => response.json())
     .then(data => {
         currentDownloadId = data.download_id;
-        startProgressPolling();
+        streamStarted = false;
+        downloadFinished = false;
+        startProgressStream();
+        
+        // В режиме потока файл начинает скачиваться сразу, не дожидаясь конца загрузки
+        if (streamMode && data.status !== 'completed') {
+            startStreamingFile(data.download_id);
+        }
     })
     .catch(error => {
-        showError(`Ошибка подключения: ${error.message}`);
+        showError(`Ошибка: ${error.message}`);
         resetButton();
     });
 }
 
-function startProgressPolling() {
-    if (progressInterval) {
-        clearInterval(progressInterval);
+function startProgressStream() {
+    // Без поддержки EventSource используем опрос
+    if (!window.EventSource) {
+        startProgressPolling();
+        return;
     }
     
+    stopProgressUpdates();
+    
+    // Сервер сам присылает изменения прогресса (Server-Sent Events)
+    progressSource = new EventSource(`/api/progress/${currentDownloadId}/stream`);
+    
+    progressSource.onmessage = (event) => {
+        handleProgress(JSON.parse(event.data));
+    };
+    
+    progressSource.onerror = () => {
+        // Соединение оборвалось до завершения — переходим на опрос
+        if (progressSource) {
+            stopProgressUpdates();
+            if (currentDownloadId) {
+                startProgressPolling();
+            }
+        }
+    };
+}
+
+function startProgressPolling() {
+    stopProgressUpdates();
+    
     progressInterval = setInterval(async () => {
         try {
             const response = await fetch(`/api/progress/${currentDownloadId}`);
             const data = await response.json();
             
-            updateProgress(data);
-            
-            if (data.status === 'completed' || data.status === 'error') {
-                clearInterval(progressInterval);
-                progressInterval = null;
-                
-                if (data.status === 'completed') {
-                    showSuccess(data.filename);
-                    // Пытаемся автоматически скачать файл
-                    // Если браузер блокирует, пользователь сможет нажать кнопку
-                    setTimeout(() => {
-                        downloadFileToClient(currentDownloadId, data.filename);
-                    }, 500);
-                } else {
-                    showError(data.message);
-                }
-                
-                resetButton();
-            }
+            handleProgress(data);
         } catch (error) {
             console.error('Ошибка получения прогресса:', error);
         }
     }, 500); // Обновляем каждые 500мс
 }
 
+function stopProgressUpdates() {
+    if (progressSource) {
+        progressSource.close();
+        progressSource = null;
+    }
+    if (progressInterval) {
+        clearInterval(progressInterval);
+        progressInterval = null;
+    }
+}
+
+function handleProgress(data) {
+    updateProgress(data);
+    
+    if (data.status === 'completed' || data.status === 'error') {
+        stopProgressUpdates();
+        downloadFinished = true;
+        
+        if (data.status === 'completed') {
+            const downloadId = currentDownloadId;
+            showSuccess(data.filename);
+            if (streamStarted) {
+                // Файл уже отдан потоком — остаётся только убрать его с сервера
+                scheduleCleanup(downloadId);
+            } else {
+                // Пытаемся автоматически скачать файл
+                // Если браузер блокирует, пользователь сможет нажать кнопку
+                setTimeout(() => {
+                    downloadFileToClient(downloadId, data.filename);
+                }, 500);
+            }
+        } else {
+            showError(data.message);
+        }
+        
+        resetButton();
+    }
+}
+
 function updateProgress(data) {
     const progress = data.progress || 0;
     
@@ -136,7 +207,11 @@ function updateProgress(data) {
     progressText.textContent = `${progress.toFixed(1)}%`;
     
     // Обновляем сообщение
-    statusMessage.textContent = data.message || 'Загрузка...';
+    if (data.status === 'queued' && data.queue_position) {
+        statusMessage.textContent = `В очереди: позиция ${data.queue_position}`;
+    } else {
+        statusMessage.textContent = data.message || 'Загрузка...';
+    }
     
     // Обновляем имя файла
     if (data.filename) {
@@ -149,6 +224,9 @@ function updateProgress(data) {
     
     // Обновляем иконку статуса
     switch(data.status) {
+        case 'queued':
+            statusIcon.textContent = '🕒';
+            break;
         case 'downloading':
             statusIcon.textContent = '⏳';
             break;
@@ -165,6 +243,7 @@ function updateProgress(data) {
 
 function getStatusText(status) {
     const statusMap = {
+        'queued': 'В очереди',
         'downloading': 'Загрузка',
         'completed': 'Завершено',
         'error': 'Ошибка',
@@ -224,6 +303,50 @@ function resetButton() {
     currentDownloadId = null;
 }
 
+async function startStreamingFile(downloadId) {
+    // Сначала узнаём, отдаст ли сервер поток (409/504 — нет): тогда файл
+    // скачается обычным способом после завершения загрузки
+    const controller = new AbortController();
+    try {
+        const response = await fetch(`/api/stream/${downloadId}`, { signal: controller.signal });
+        controller.abort();
+        if (!response.ok) {
+            console.warn(`Поток недоступен: HTTP ${response.status}`);
+            return;
+        }
+    } catch (error) {
+        console.warn('Поток недоступен:', error);
+        return;
+    }
+    if (downloadId !== currentDownloadId || downloadFinished) {
+        return;  // Загрузка уже закончилась — файл скачивается обычным способом
+    }
+    streamStarted = true;
+    
+    // Сервер отдаёт файл по мере записи; ссылка открывается как обычное скачивание
+    const a = document.createElement('a');
+    a.href = `/api/stream/${downloadId}`;
+    a.style.display = 'none';
+    document.body.appendChild(a);
+    a.click();
+    setTimeout(() => {
+        if (document.body.contains(a)) {
+            document.body.removeChild(a);
+        }
+    }, 1000);
+}
+
+function scheduleCleanup(downloadId) {
+    // Удаляем файл с сервера после скачивания (с задержкой, чтобы файл успел скачаться)
+    setTimeout(async () => {
+        try {
+            await fetch(`/api/cleanup/${downloadId}`, { method: 'DELETE' });
+        } catch (e) {
+            console.error('Ошибка при очистке файла на сервере:', e);
+        }
+    }, 10000); // Увеличиваем задержку до 10 секунд для больших файлов
+}
+
 async function downloadFileToClient(downloadId, filename) {
     try {
         // Используем прямой редирект на URL файла для скачивания
@@ -247,14 +370,7 @@ async function downloadFileToClient(downloadId, filename) {
             }
         }, 1000);
         
-        // Удаляем файл с сервера после скачивания (с задержкой, чтобы файл успел скачаться)
-        setTimeout(async () => {
-            try {
-                await fetch(`/api/cleanup/${downloadId}`, { method: 'DELETE' });
-            } catch (e) {
-                console.error('Ошибка при очистке файла на сервере:', e);
-            }
-        }, 10000); // Увеличиваем задержку до 10 секунд для больших файлов
+        scheduleCleanup(downloadId);
         
     } catch (error) {
         console.error('Ошибка при скачивании файла:', error);
@@ -265,8 +381,20 @@ async function downloadFileToClient(downloadId, filename) {
 
 // Очистка при размонтировании
 window.addEventListener('beforeunload', () => {
-    if (progressInterval) {
-        clearInterval(progressInterval);
-    }
+    stopProgressUpdates();
 });
 
+// Параметры формата из выбранного качества
+function getFormatOptions() {
+    const quality = qualityInput.value;
+    if (quality === 'audio') {
+        return { audio_only: true };
+    }
+    if (quality === 'mp3') {
+        return { profile: 'mp3' };
+    }
+    if (quality) {
+        return { max_height: parseInt(quality, 10) };
+    }
+    return {};
+}
@@ -0,0 +1,117 @@
+"""Внешние процессы под надзором: вывод по мере появления, лимиты времени и остановка всей группы"""
+import asyncio
+import os
+import signal
+import time
+
+# В Windows нет SIGKILL: там terminate() и так завершает процесс сразу
+_SIGKILL = getattr(signal, "SIGKILL", signal.SIGTERM)
+
+
+class ProcessLimitExceeded(Exception):
+    """Процесс остановлен по лимиту: reason — "timeout" (общее время) или "stall" (нет вывода)"""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class SupervisedProcess:
+    """Процесс в собственной группе с построчным чтением вывода.
+
+    max_runtime — предельное время работы, stall_timeout — сколько процесс может
+    молчать (0 — без лимита). При превышении лимита или отмене задачи вся группа
+    (yt-dlp и запущенный им ffmpeg) получает SIGTERM, а через kill_grace секунд — SIGKILL.
+    """
+
+    def __init__(self, cmd, max_runtime=0, stall_timeout=0, kill_grace=5):
+        self.cmd = cmd
+        self.max_runtime = max_runtime
+        self.stall_timeout = stall_timeout
+        self.kill_grace = kill_grace
+        self.process = None
+        self.started = None
+        self.last_output = None
+        self.limit = None        # Сработавший лимит: "timeout" или "stall"
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,   # Объединяем stderr в stdout
+            start_new_session=os.name == "posix",
+        )
+        self.started = self.last_output = time.monotonic()
+
+    async def run(self, on_line):
+        """Читает вывод до конца, вызывая on_line(строка), и возвращает код выхода.
+
+        Бросает ProcessLimitExceeded, если процесс остановлен по лимиту. Если задачу
+        отменили, процесс останавливается до того, как отмена пойдёт дальше.
+        """
+        if self.process is None:
+            await self.start()
+        watchdog = asyncio.create_task(self._watch())
+        try:
+            # Ждём строк без опроса по таймауту: за сроками следит сторож
+            async for line in self.process.stdout:
+                self.last_output = time.monotonic()
+                on_line(line)
+            returncode = await self.process.wait()
+        except BaseException:
+            await asyncio.shield(self.terminate())
+            raise
+        finally:
+            watchdog.cancel()
+
+        if self.limit == "timeout":
+            raise ProcessLimitExceeded("timeout", f"Загрузка дольше {self.max_runtime} с остановлена")
+        if self.limit == "stall":
+            raise ProcessLimitExceeded("stall", f"Процесс не выводит данные более {self.stall_timeout} с")
+        return returncode
+
+    async def _watch(self):
+        """Спит до ближайшего срока и останавливает процесс, если срок истёк"""
+        while self.process.returncode is None:
+            deadlines = []
+            if self.max_runtime:
+                deadlines.append((self.started + self.max_runtime, "timeout"))
+            if self.stall_timeout:
+                deadlines.append((self.last_output + self.stall_timeout, "stall"))
+            if not deadlines:
+                return
+            deadline, reason = min(deadlines)
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue   # За это время мог появиться вывод — пересчитываем сроки
+            self.limit = reason
+            await self.terminate()
+            return
+
+    async def terminate(self):
+        """SIGTERM группе, SIGKILL через kill_grace секунд; ждёт завершения процесса"""
+        if self.process is None:
+            return
+        if self.process.returncode is None:
+            self._signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(self.process.wait(), self.kill_grace)
+            except asyncio.TimeoutError:
+                self._signal(_SIGKILL)
+                await self.process.wait()
+        # Дочерние процессы могли пережить родителя
+        self._signal(_SIGKILL)
+
+    def _signal(self, sig):
+        try:
+            if os.name == "posix":
+                os.killpg(self.process.pid, sig)
+            elif self.process.returncode is None:
+                self.process.kill() if sig == _SIGKILL else self.process.terminate()
+        except (ProcessLookupError, PermissionError):
+            pass
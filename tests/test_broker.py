@@ -0,0 +1,101 @@
+"""Общая очередь раздельного режима: аренда, пульс, возврат и отмена задач"""
+import time
+
+import pytest
+
+from broker import RedisBroker, SqliteBroker
+
+
+@pytest.fixture
+def broker(tmp_path):
+    broker = SqliteBroker(tmp_path / "broker.sqlite3", lease_seconds=30, max_attempts=2)
+    yield broker
+    broker.close()
+
+
+def expire_leases(broker):
+    """Как будто воркер пропал: аренды истекли"""
+    broker._transaction(lambda conn: conn.execute("UPDATE broker_jobs SET lease_until = ?", (time.time() - 1,)))
+
+
+def test_lease_order_and_position(broker):
+    broker.enqueue("low", "http://example.com/1", {"stream": False}, "key1")
+    broker.enqueue("next", "http://example.com/2", {})
+    broker.enqueue("high", "http://example.com/3", {}, priority=5)
+    assert [broker.position(job_id) for job_id in ("high", "low", "next")] == [1, 2, 3]
+
+    job, = broker.lease("w1", 1)
+    assert (job.id, job.priority, job.attempts) == ("high", 5, 1)
+    assert broker.position("high") is None
+    assert broker.position("low") == 1
+
+    jobs = broker.lease("w2", 5)
+    assert [job.id for job in jobs] == ["low", "next"]
+    assert jobs[0].options == {"stream": False} and jobs[0].cache_key == "key1"
+    assert broker.lease("w2", 5) == []
+    assert broker.stats()["queued"] == 0 and broker.stats()["leased"] == 3
+
+
+def test_heartbeat_reports_cancelled_and_lost(broker):
+    broker.enqueue("a", "http://example.com/a", {})
+    broker.enqueue("b", "http://example.com/b", {})
+    broker.lease("w1", 2)
+    assert broker.cancel("a") == "leased"
+
+    cancelled, lost = broker.heartbeat("w1", "http://w1:8000", ["a", "b", "gone"])
+    assert cancelled == ["a"] and lost == ["gone"]
+    assert broker.worker_url("w1") == "http://w1:8000"
+    assert [worker["id"] for worker in broker.workers()] == ["w1"]
+
+
+def test_cancel_queued_job(broker):
+    broker.enqueue("a", "http://example.com/a", {})
+    assert broker.cancel("a") == "queued"
+    assert broker.cancel("a") is None
+    assert broker.lease("w1", 1) == []
+
+
+def test_requeue_expired(broker):
+    for job_id in ("retry", "cancel"):
+        broker.enqueue(job_id, f"http://example.com/{job_id}", {})
+    broker.lease("w1", 2)
+    broker.cancel("cancel")
+    expire_leases(broker)
+    assert broker.requeue_expired() == {"requeued": ["retry"], "failed": [], "cancelled": ["cancel"]}
+
+    # Другой воркер получает задачу, а старый при пульсе узнаёт, что потерял её
+    job, = broker.lease("w2", 1)
+    assert (job.id, job.attempts) == ("retry", 2)
+    assert broker.heartbeat("w1", None, ["retry"]) == ([], ["retry"])
+
+    # Попытки исчерпаны — задача снимается
+    expire_leases(broker)
+    assert broker.requeue_expired() == {"requeued": [], "failed": ["retry"], "cancelled": []}
+
+
+def test_release_and_complete(broker):
+    broker.enqueue("a", "http://example.com/a", {})
+    broker.lease("w1", 1)
+    broker.release("a", "w1")
+    job, = broker.lease("w2", 1)
+    assert job.attempts == 1   # Возврат при остановке воркера попытку не тратит
+    broker.complete("a", "w1")   # Чужая аренда не снимается
+    assert broker.stats()["leased"] == 1
+    broker.complete("a", "w2")
+    assert broker.stats()["leased"] == 0
+
+
+def test_redis_lease_skips_deleted_job():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    client = fakeredis.FakeRedis(decode_responses=True)
+    broker = RedisBroker(None, 30, 2, client=client)
+    broker.enqueue("a", "http://example.com/a", {"stream": True}, "key")
+    broker.enqueue("b", "http://example.com/b", {})
+    client.delete("vd:job:b")   # Описание задачи удалено, пока она ждала в очереди
+
+    job, = broker.lease("w1", 5)
+    assert (job.id, job.url, job.options, job.cache_key, job.attempts) == (
+        "a", "http://example.com/a", {"stream": True}, "key", 1,
+    )
+    assert broker.stats()["queued"] == 0 and broker.stats()["leased"] == 1
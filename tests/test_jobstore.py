@@ -0,0 +1,87 @@
+"""Подписки на задачи в общем хранилище: два процесса на одном файле SQLite"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+from fastapi import HTTPException
+
+# Настройки читаются при импорте приложения: рабочие файлы тестов — во временной папке
+os.environ.setdefault("VD_TEMP_DIR", tempfile.mkdtemp(prefix="vd-tests-"))
+os.environ.setdefault("VD_JOURNAL_ENABLED", "0")
+os.environ.setdefault("VD_CACHE_ENABLED", "0")
+
+import app  # noqa: E402
+from jobstore import MemoryJobStore, SqliteJobStore  # noqa: E402
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryJobStore(3600, 100)
+    return SqliteJobStore(tmp_path / "jobstate.sqlite3", 3600, 100)
+
+
+def test_subscriptions(store):
+    store.subscribe("job", "job")
+    store.subscribe("job", "alias")
+    assert store.resolve("alias") == "job"
+    assert store.resolve("other") == "other"
+    assert store.subscribers("job") == {"job", "alias"}
+    assert store.unsubscribe("job", "alias") == 1
+    assert store.resolve("alias") == "alias"
+    # Повторная отписка не уменьшает счёт
+    assert store.unsubscribe("job", "alias") == 1
+    assert store.drop_subscribers("job") == {"job"}
+    assert store.subscribers("job") == set()
+
+
+@pytest.fixture
+def two_processes(tmp_path, monkeypatch):
+    """Хранилище этого процесса (его видит app) и другого воркера uvicorn"""
+    path = tmp_path / "jobstate.sqlite3"
+    here = SqliteJobStore(path, 3600, 100)
+    other = SqliteJobStore(path, 3600, 100)
+    monkeypatch.setattr(app, "job_store", here)
+    monkeypatch.setattr(app.config, "TEMP_DIR", tmp_path)
+    yield here, other
+    here.close()
+    other.close()
+
+
+def test_cleanup_keeps_download_of_another_process(two_processes, tmp_path):
+    here, other = two_processes
+    other.update("job", status="downloading")
+    other.subscribe("job", "job")
+    other.subscribe("job", "alias")
+    part = tmp_path / "job" / "video.mp4.part"
+    part.parent.mkdir()
+    part.write_bytes(b"data")
+
+    # Подписчик, объединённый с задачей в другом процессе, виден и здесь
+    assert app.resolve_job_id("alias") == "job"
+    assert asyncio.run(app.cleanup_file("alias")) == {"status": "released"}
+
+    # Последнего подписчика отсюда не отпускаем: загрузку остановить нельзя
+    for endpoint in (app.cleanup_file, app.cancel_download):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(endpoint("job"))
+        assert error.value.status_code == 409
+    assert part.exists()
+    assert here.get("job").status == "downloading"
+    assert here.subscribers("job") == {"job"}
+
+
+def test_cleanup_keeps_finished_file_for_other_subscribers(two_processes, tmp_path):
+    _, other = two_processes
+    video = tmp_path / "job" / "video.mp4"
+    video.parent.mkdir()
+    video.write_bytes(b"data")
+    other.update("job", status="completed", filename="video.mp4", filepath=str(video))
+    other.subscribe("job", "job")
+    other.subscribe("job", "alias")
+
+    assert asyncio.run(app.cleanup_file("job")) == {"status": "released"}
+    assert video.exists()
+    assert asyncio.run(app.cleanup_file("alias")) == {"status": "deleted"}
+    assert not video.parent.exists()
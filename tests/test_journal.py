@@ -0,0 +1,43 @@
+"""Общий журнал для нескольких процессов: каждую задачу забирает один владелец"""
+import sqlite3
+
+from journal import JobJournal
+
+
+def test_claim_gives_entry_to_one_owner(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    first = JobJournal(path, owner="a", lease_seconds=30)
+    second = JobJournal(path, owner="b", lease_seconds=30)
+    first.add("job1", "http://example.com/1", {})
+    first.release()   # Как после штатной остановки
+
+    assert [entry.id for entry in second.claim()] == ["job1"]
+    assert first.claim() == []
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    dead = JobJournal(path, owner="dead", lease_seconds=-1)
+    alive = JobJournal(path, owner="alive", lease_seconds=30)
+    dead.add("job1", "http://example.com/1", {})
+    alive.add("job2", "http://example.com/2", {})
+
+    # Своя запись с живой арендой не забирается повторно
+    assert [entry.id for entry in alive.claim()] == ["job1"]
+    alive.renew()
+    assert JobJournal(path, owner="other").claim() == []
+
+
+def test_old_journal_is_migrated(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, url TEXT NOT NULL, options TEXT NOT NULL, cache_key TEXT,"
+        " subscribers TEXT NOT NULL DEFAULT '[]', output_path TEXT, bytes_done INTEGER NOT NULL DEFAULT 0,"
+        " fragment_index INTEGER, resume_state TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO jobs (id, url, options, created_at, updated_at) VALUES ('job1', 'u', '{}', 0, 0)")
+    conn.commit()
+    conn.close()
+
+    assert [entry.id for entry in JobJournal(path, owner="a").claim()] == ["job1"]
@@ -0,0 +1,13 @@
+"""Метки метрик: хосты из пользовательских ссылок сводятся к известному списку"""
+from metrics import host_label
+
+KNOWN = ["youtube.com", "vimeo.com"]
+
+
+def test_host_label():
+    assert host_label("youtube.com", KNOWN) == "youtube.com"
+    assert host_label("www.YouTube.com.", KNOWN) == "youtube.com"
+    assert host_label("player.vimeo.com", KNOWN) == "vimeo.com"
+    assert host_label("notyoutube.com", KNOWN) == "other"
+    assert host_label("random-123.example.org", KNOWN) == "other"
+    assert host_label("", KNOWN) == "other"
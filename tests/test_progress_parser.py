@@ -0,0 +1,136 @@
+"""Разбор вывода yt-dlp на записанных транскриптах (tests/fixtures/ytdlp_*.txt).
+
+progressive, hls, legacy и error записаны с yt-dlp 2023.11.16 против локального
+источника из bench.py; merge повторяет вывод yt-dlp с ffmpeg (137+140 → Merger).
+"""
+from pathlib import Path
+
+import pytest
+
+from progress_parser import (
+    FILEPATH_TEMPLATE,
+    POSTPROCESS_TEMPLATE,
+    PROGRESS_MARKER,
+    PROGRESS_TEMPLATE,
+    YtDlpOutputParser,
+)
+
+FIXTURES = Path(__file__).parent / "fixtures"
+FINAL_PATH = "/tmp/video_downloader/job/video.mp4"
+
+
+def replay(name):
+    """Прогоняет транскрипт через парсер; возвращает парсер и все ненулевые обновления"""
+    parser = YtDlpOutputParser()
+    updates = []
+    for line in (FIXTURES / f"ytdlp_{name}.txt").read_text(encoding="utf-8").splitlines():
+        update = parser.feed(line + "\n")
+        if update is not None:
+            updates.append(update)
+    return parser, updates
+
+
+def test_templates_use_markers():
+    assert PROGRESS_TEMPLATE.startswith(f"download:{PROGRESS_MARKER} ")
+    assert POSTPROCESS_TEMPLATE.startswith("postprocess:")
+    assert FILEPATH_TEMPLATE.startswith("after_move:")
+
+
+def test_progressive_json_progress():
+    parser, updates = replay("progressive")
+    progress = [u for u in updates if "downloaded_bytes" in u]
+    assert progress[0]["downloaded_bytes"] == 1024
+    assert progress[0]["total_bytes"] == 3145728
+    # NA из шаблона превращается в None, а не ломает разбор
+    assert progress[0]["speed"] is None
+    assert progress[-1]["progress"] == 100.0
+    assert [u["progress"] for u in progress] == sorted(u["progress"] for u in progress)
+    assert parser.downloaded_bytes == parser.total_bytes == 3145728
+    assert parser.speed == pytest.approx(2112148.4765625075)
+
+
+def test_progressive_filepath_from_after_move():
+    parser, _ = replay("progressive")
+    assert parser.final_path == FINAL_PATH
+    assert parser.filename == FINAL_PATH
+    # Служебные строки не попадают в буфер для диагностики
+    assert not any(line.startswith("[vd-") for line in parser.recent)
+
+
+def test_progressive_postprocess_stage():
+    parser, updates = replay("progressive")
+    assert parser.stage == "postprocess"
+    assert {"message": "Перемещение файла..."} in updates
+
+
+def test_hls_fragments():
+    parser, updates = replay("hls")
+    progress = [u for u in updates if "fragment_count" in u]
+    assert progress[0]["fragment_index"] == 0
+    assert progress[0]["fragment_count"] == 4
+    # Без total_bytes используется оценка
+    assert progress[0]["total_bytes"] == 261696.0
+    fragments = [u for u in progress if u["fragment_count"]]
+    assert fragments[-1]["fragment_index"] == 4
+    assert fragments[-1]["message"] == "Загрузка фрагментов: 4/4 (100.0%)"
+    # В строке finished yt-dlp уже не сообщает фрагменты, зато даёт точный размер
+    assert progress[-1]["fragment_count"] is None
+    assert progress[-1]["total_bytes"] == 261696
+    assert progress[-1]["progress"] == 100.0
+    assert parser.final_path == FINAL_PATH
+    # Предупреждение в конце не считается ошибкой
+    assert not parser.errors
+
+
+def test_legacy_download_lines():
+    parser, updates = replay("legacy")
+    assert updates[0] == {"message": "Запуск: [generic] Extracting URL: http://127.0.0.1:8000/video.mp4"}
+    progress = [u for u in updates if "progress" in u]
+    assert progress[0] == {"progress": 0.0, "message": "Загрузка: 0.0% (3.00MiB)"}
+    assert progress[-1]["progress"] == 100.0
+    assert parser.filename == FINAL_PATH
+    assert parser.final_path is None
+
+
+def test_merge_reports_postprocessor_and_final_file():
+    parser, updates = replay("merge")
+    messages = [u.get("message") for u in updates]
+    assert "Объединение видео и аудио..." in messages
+    # Прогресс второй дорожки начинается заново, а не продолжает первую
+    audio = [u for u in updates if u.get("total_bytes") == 5242880]
+    assert audio[0]["progress"] == pytest.approx(1024 / 5242880 * 100, abs=0.1)
+    assert parser.stage == "postprocess"
+    assert parser.final_path == FINAL_PATH
+
+
+def test_merger_line_without_postprocess_template():
+    parser = YtDlpOutputParser()
+    update = parser.feed('[Merger] Merging formats into "/tmp/x/video.mp4"')
+    assert update == {"message": "Объединение видео и аудио..."}
+    assert parser.filename == "/tmp/x/video.mp4"
+    assert parser.stage == "postprocess"
+
+
+def test_error_summary():
+    parser, updates = replay("error")
+    assert updates[-1]["message"].startswith("Ошибка: ERROR: [generic] Unable to download webpage")
+    assert parser.error_summary().startswith("[generic] Unable to download webpage: HTTP Error 404")
+
+
+def test_malformed_lines_are_ignored():
+    parser, updates = replay("malformed")
+    # Оборванный и нечитаемый JSON пропускается, следующий целый — разбирается
+    progress = [u for u in updates if "downloaded_bytes" in u]
+    assert len(progress) == 1
+    assert progress[0]["progress"] == 50.0
+    assert parser.filename is None
+    assert not parser.errors
+    assert parser.lines_read == 11
+
+
+def test_error_summary_without_errors_uses_recent_lines():
+    parser = YtDlpOutputParser(history=2)
+    for line in ("first", "second", "third"):
+        parser.feed(line)
+    assert parser.error_summary() == "second\nthird"
+    assert YtDlpOutputParser().error_summary() == "Неизвестная ошибка при загрузке"
@@ -0,0 +1,54 @@
+"""Деление общей полосы: фиксированные доли процессов yt-dlp и меняемые доли"""
+import random
+
+from ratelimit import BandwidthAllocator
+
+TOTAL = 10_000_000
+SLOTS = 4
+
+
+def test_fixed_shares_leave_room_for_later_jobs():
+    allocator = BandwidthAllocator(TOTAL, 0, SLOTS)
+    rates = [allocator.add(f"job{i}") for i in range(SLOTS)]
+    assert rates == [TOTAL // SLOTS] * SLOTS
+    assert sum(rates) <= TOTAL
+
+
+def test_adjustable_jobs_share_what_is_left():
+    allocator = BandwidthAllocator(TOTAL, 0, SLOTS)
+    changes = []
+    allocator.add("adjustable", changes.append)
+    assert allocator.share() == TOTAL
+    fixed = allocator.add("fixed")
+    # Процесс получил долю остатка на свободный слот, меняемая задача — всё остальное
+    assert fixed == TOTAL // SLOTS
+    assert changes[-1] == TOTAL - fixed
+    allocator.remove("fixed")
+    assert changes[-1] == TOTAL
+
+
+def test_sum_of_shares_never_exceeds_total():
+    allocator = BandwidthAllocator(TOTAL, 0, SLOTS)
+    rng = random.Random(1)
+    rates = {}
+    for step in range(2000):
+        if rates and (len(rates) == SLOTS or rng.random() < 0.5):
+            job_id = rng.choice(sorted(rates))
+            del rates[job_id]
+            allocator.remove(job_id)
+        else:
+            job_id = f"job{step}"
+            if rng.random() < 0.5:
+                rates[job_id] = allocator.add(job_id)
+            else:
+                def on_change(rate, job_id=job_id):
+                    rates[job_id] = rate
+                rates[job_id] = allocator.add(job_id, on_change)
+        assert sum(rates.values()) <= TOTAL
+
+
+def test_per_job_limit_and_unlimited():
+    assert BandwidthAllocator(0, 0, SLOTS).add("job") == 0
+    allocator = BandwidthAllocator(0, 500, SLOTS)
+    assert allocator.add("fixed") == 500
+    assert allocator.add("adjustable", lambda rate: None) == 500
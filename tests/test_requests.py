@@ -0,0 +1,26 @@
+"""Тела запросов API: необязательные поля принимают null из JSON"""
+import os
+import tempfile
+
+# Настройки читаются при импорте приложения: рабочие файлы тестов — во временной папке
+os.environ.setdefault("VD_TEMP_DIR", tempfile.mkdtemp(prefix="vd-tests-"))
+os.environ.setdefault("VD_JOURNAL_ENABLED", "0")
+os.environ.setdefault("VD_CACHE_ENABLED", "0")
+
+from app import BatchRequest, DownloadRequest  # noqa: E402
+
+
+def test_download_request_accepts_nulls():
+    request = DownloadRequest.model_validate_json(
+        '{"url": "http://example.com/v", "max_height": null, "container": null, "profile": null}'
+    )
+    assert request.format_options() == DownloadRequest(url="http://example.com/v").format_options()
+
+
+def test_batch_request_accepts_nulls():
+    request = BatchRequest.model_validate_json(
+        '{"urls": ["http://example.com/v"], "playlist_url": null, "parallel": null,'
+        ' "max_height": null, "container": null, "profile": null}'
+    )
+    assert request.playlist_url is None and request.parallel is None
+    assert request.format_options() == BatchRequest().format_options()
@@ -0,0 +1,129 @@
+"""Встроенная загрузка HLS/DASH против локального источника из bench.py"""
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import bench
+from segmented import (
+    SegmentDownloadError,
+    SegmentedDownloader,
+    UnsupportedManifest,
+    parse_dash_manifest,
+)
+
+SEGMENTS = 6
+SEGMENT_SIZE = 64 * 1024
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server, base_url = bench.start_origin(1024 * 1024, SEGMENTS, SEGMENT_SIZE, 0)
+    yield base_url
+    server.shutdown()
+
+
+def download(base_url, path, output, **kwargs):
+    async def run():
+        async with httpx.AsyncClient() as client:
+            downloader = SegmentedDownloader(client, concurrency=3, retries=0, **kwargs)
+            tracks = await downloader.resolve(base_url + path)
+            for track in tracks:
+                await downloader.download_track(track, output)
+            return downloader, tracks
+    return asyncio.run(run())
+
+
+def test_hls_fragments_written_in_order(origin, tmp_path):
+    output = tmp_path / "video.ts"
+    downloader, tracks = download(origin, "/hls/index.m3u8", output)
+    assert len(tracks) == 1 and len(tracks[0].fragments) == SEGMENTS
+    expected = b"".join(bench.OriginHandler.files[f"/hls/seg{i}.ts"] for i in range(SEGMENTS))
+    assert output.read_bytes() == expected
+    assert downloader.fragments_done == SEGMENTS
+    assert downloader.bytes_done == len(expected)
+
+
+def test_hls_resume_from_fragment(origin, tmp_path):
+    output = tmp_path / "video.ts"
+    segment = bench.OriginHandler.files["/hls/seg0.ts"]
+    # До перезапуска записаны два фрагмента и кусок третьего
+    output.write_bytes(segment * 2 + b"garbage")
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            downloader = SegmentedDownloader(client, concurrency=2, retries=0)
+            track, = await downloader.resolve(origin + "/hls/index.m3u8")
+            await downloader.download_track(track, output, start_fragment=2, start_bytes=len(segment) * 2)
+            return downloader
+    downloader = asyncio.run(run())
+    assert output.read_bytes() == segment * SEGMENTS
+    assert downloader.fragments_done == SEGMENTS
+
+
+def test_failed_fragment_is_reported_without_waiting(origin, tmp_path):
+    bench.OriginHandler.files["/broken/index.m3u8"] = bench.make_playlist(SEGMENTS, 2).replace(
+        b"seg3.ts", b"/missing.ts"
+    ).replace(b"seg", b"/hls/seg")
+    started = time.monotonic()
+    with pytest.raises(SegmentDownloadError, match="missing.ts"):
+        download(origin, "/broken/index.m3u8", tmp_path / "video.ts")
+    # Ошибка воркера доходит до записи сразу, без опроса по таймауту
+    assert time.monotonic() - started < 1.0
+
+
+def test_oversized_fragment_falls_back_to_ytdlp(origin, tmp_path):
+    with pytest.raises(UnsupportedManifest, match="Слишком большой фрагмент"):
+        download(origin, "/hls/index.m3u8", tmp_path / "video.ts", max_fragment_bytes=SEGMENT_SIZE // 2)
+
+
+def test_dash_single_file_track_falls_back_to_ytdlp():
+    mpd = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT10S">
+  <Period>
+    <AdaptationSet contentType="video">
+      <Representation id="v1" bandwidth="1000000" height="720">
+        <BaseURL>video.mp4</BaseURL>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>"""
+    with pytest.raises(UnsupportedManifest):
+        parse_dash_manifest(mpd, "http://127.0.0.1:8000/manifest.mpd")
+
+
+def test_dash_segment_template():
+    mpd = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT6S">
+  <Period>
+    <AdaptationSet contentType="video">
+      <SegmentTemplate initialization="init-$RepresentationID$.mp4" media="seg-$RepresentationID$-$Number%03d$.m4s"
+                       startNumber="1" timescale="1000" duration="2000"/>
+      <Representation id="v1" bandwidth="1000000" height="720"/>
+      <Representation id="v2" bandwidth="3000000" height="1080"/>
+    </AdaptationSet>
+  </Period>
+</MPD>"""
+    track, = parse_dash_manifest(mpd, "http://127.0.0.1:8000/dash/manifest.mpd", max_height=720)
+    assert track.init.url == "http://127.0.0.1:8000/dash/init-v1.mp4"
+    assert [f.url.rsplit("/", 1)[1] for f in track.fragments] == ["seg-v1-001.m4s", "seg-v1-002.m4s", "seg-v1-003.m4s"]
+
+
+def test_dash_template_with_formatted_bandwidth():
+    mpd = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT4S">
+  <Period>
+    <AdaptationSet contentType="video">
+      <SegmentTemplate initialization="init-$Bandwidth$.mp4" media="$Bandwidth%08d$/seg-$Number$.m4s"
+                       timescale="1" duration="2"/>
+      <Representation id="v1" bandwidth="800000" height="480"/>
+    </AdaptationSet>
+  </Period>
+</MPD>"""
+    track, = parse_dash_manifest(mpd, "http://127.0.0.1:8000/dash/manifest.mpd")
+    assert track.init.url == "http://127.0.0.1:8000/dash/init-800000.mp4"
+    assert [f.url for f in track.fragments] == [
+        "http://127.0.0.1:8000/dash/00800000/seg-1.m4s",
+        "http://127.0.0.1:8000/dash/00800000/seg-2.m4s",
+    ]
@@ -0,0 +1,349 @@
+"""Обработка готовых файлов через ffmpeg: смена контейнера и профили перекодирования"""
+import asyncio
+import json
+import os
+import struct
+import time
+
+
+class TranscodeError(Exception):
+    """ffmpeg/ffprobe не смог обработать файл"""
+
+
+class InvalidMediaError(TranscodeError):
+    """Файл повреждён, обрезан или не содержит дорожек"""
+
+
+# Какие кодеки (имена ffprobe) контейнер принимает без перекодирования; None — любые
+CONTAINER_CODECS = {
+    "mp4": ({"h264", "hevc", "av1", "vp9", "mpeg4"}, {"aac", "mp3", "opus", "ac3", "eac3", "alac", "flac"}),
+    "mkv": (None, None),
+    "webm": ({"vp8", "vp9", "av1"}, {"opus", "vorbis"}),
+    "m4a": (set(), {"aac", "alac"}),
+    "mp3": (set(), {"mp3"}),
+}
+CONTAINERS = tuple(CONTAINER_CODECS)
+AUDIO_CONTAINERS = ("m4a", "mp3")
+
+# Расширения, которые уже являются нужным контейнером
+CONTAINER_ALIASES = {"m4v": "mp4"}
+
+# Контейнеры ISO BMFF: у них индекс (атом moov) может оказаться в конце файла
+ISO_EXTENSIONS = ("mp4", "m4v", "m4a", "mov")
+
+# Перенос индекса в начало без перекодирования
+FASTSTART_ARGS = ["-map", "0", "-c", "copy", "-dn", "-movflags", "+faststart"]
+
+# Чем кодировать дорожку, которую нельзя скопировать: (видео, аудио)
+_DEFAULT_ENCODERS = {
+    "mp4": ("libx264", "aac"),
+    "mkv": ("libx264", "aac"),
+    "webm": ("libvpx-vp9", "libopus"),
+    "m4a": (None, "aac"),
+    "mp3": (None, "libmp3lame"),
+}
+
+# Имя кодека в ffprobe для кодировщика ffmpeg
+_ENCODER_CODECS = {"libx264": "h264", "libvpx-vp9": "vp9", "aac": "aac", "libopus": "opus", "libmp3lame": "mp3"}
+
+# Настройки кодировщиков: быстрее реального времени на обычном процессоре
+_VIDEO_ENCODER_ARGS = {
+    "libx264": ["-preset", "veryfast", "-crf", "23", "-pix_fmt", "yuv420p"],
+    "libvpx-vp9": ["-crf", "33", "-b:v", "0", "-deadline", "good", "-cpu-used", "4", "-row-mt", "1"],
+}
+
+
+class TranscodeProfile:
+    """Именованный профиль: контейнер, предельная высота кадра и кодировщики.
+
+    Кодировщик None — дорожка копируется, если её кодек подходит контейнеру.
+
+    optimize=False — файл не проверяется ffprobe и индекс не переносится в начало.
+    """
+
+    __slots__ = ("name", "container", "description", "max_height", "video_encoder", "audio_encoder", "audio_bitrate",
+                 "optimize")
+
+    def __init__(self, name, container, description, max_height=None, video_encoder=None,
+                 audio_encoder=None, audio_bitrate="128k", optimize=True):
+        self.name = name
+        self.container = container
+        self.description = description
+        self.max_height = max_height
+        self.video_encoder = video_encoder
+        self.audio_encoder = audio_encoder
+        self.audio_bitrate = audio_bitrate
+        self.optimize = optimize
+
+    @property
+    def audio_only(self):
+        return self.container in AUDIO_CONTAINERS
+
+    @property
+    def remux_only(self):
+        """Профиль только меняет контейнер, дорожки не трогает"""
+        return self.max_height is None and self.video_encoder is None and self.audio_encoder is None
+
+
+PROFILES = {profile.name: profile for profile in (
+    TranscodeProfile("mp4", "mp4", "MP4, дорожки копируются без перекодирования, если это возможно"),
+    TranscodeProfile("mp4-raw", "mp4", "MP4 как скачан: без проверки файла и переноса индекса", optimize=False),
+    TranscodeProfile("mkv", "mkv", "MKV, дорожки всегда копируются"),
+    TranscodeProfile("mp4-1080p", "mp4", "H.264/AAC, не выше 1080p", 1080, "libx264", "aac"),
+    TranscodeProfile("mp4-720p", "mp4", "H.264/AAC, не выше 720p", 720, "libx264", "aac"),
+    TranscodeProfile("mp4-480p", "mp4", "H.264/AAC, не выше 480p", 480, "libx264", "aac", "96k"),
+    TranscodeProfile("mp4-360p", "mp4", "H.264/AAC, не выше 360p", 360, "libx264", "aac", "96k"),
+    TranscodeProfile("m4a", "m4a", "Только звук, AAC", audio_encoder="aac"),
+    TranscodeProfile("mp3", "mp3", "Только звук, MP3 192 кбит/с", audio_encoder="libmp3lame", audio_bitrate="192k"),
+)}
+
+
+async def probe_media(path):
+    """Контейнер, кодеки, размер кадра и длительность файла через ffprobe.
+
+    Если ffprobe не может разобрать файл, бросает InvalidMediaError с его сообщением.
+    """
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error",
+        "-show_entries",
+        "format=format_name,duration,bit_rate:stream=codec_type,codec_name,width,height:stream_disposition=attached_pic",
+        "-of", "json",
+        str(path),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise InvalidMediaError(f"ffprobe: {stderr.decode('utf-8', errors='ignore').strip()[:300]}")
+
+    data = json.loads(stdout or b"{}")
+    streams = data.get("streams") or []
+    # Обложка (attached_pic) — тоже видеодорожка, но не видео
+    video = next((s for s in streams if s.get("codec_type") == "video"
+                  and not (s.get("disposition") or {}).get("attached_pic")), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    fmt = data.get("format") or {}
+    try:
+        duration = float(fmt.get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    try:
+        bit_rate = int(fmt.get("bit_rate"))
+    except (TypeError, ValueError):
+        bit_rate = None
+    return {"video": video, "audio": audio, "duration": duration, "format": fmt.get("format_name"), "bit_rate": bit_rate}
+
+
+def check_media(media, require_video=False):
+    """Бросает InvalidMediaError, если в файле нет нужных дорожек или длительности.
+
+    Видео обязательно только при require_video: у источника может и не быть картинки
+    (подкаст, музыка), и селектор "best" тогда честно выбирает звук.
+    """
+    if media["video"] is None and media["audio"] is None:
+        raise InvalidMediaError("В файле нет ни видео, ни звука")
+    if media["video"] is None and require_video:
+        raise InvalidMediaError("В файле нет видеодорожки (только звук)")
+    if not media["duration"] or media["duration"] <= 0:
+        raise InvalidMediaError("Не удалось определить длительность: файл, вероятно, обрезан")
+
+
+def summarize_media(media):
+    """Результат ffprobe для записи задачи"""
+    video, audio = media["video"], media["audio"]
+    return {
+        "format": media.get("format"),
+        "duration": media["duration"],
+        "bit_rate": media.get("bit_rate"),
+        "video": {"codec": video.get("codec_name"), "width": video.get("width"), "height": video.get("height")}
+        if video else None,
+        "audio": {"codec": audio.get("codec_name")} if audio else None,
+    }
+
+
+def read_iso_boxes(path):
+    """Атомы верхнего уровня файла ISO BMFF (mp4/mov): список (тип, смещение, размер).
+
+    Бросает InvalidMediaError, если атом выходит за конец файла (файл обрезан).
+    Возвращает None, если файл не похож на ISO BMFF.
+    """
+    file_size = os.path.getsize(path)
+    boxes = []
+    with open(path, "rb") as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(16)
+            if len(header) < 8:
+                raise InvalidMediaError(f"Файл обрезан: неполный заголовок атома на {offset} байте")
+            size, kind = struct.unpack(">I4s", header[:8])
+            kind = kind.decode("latin-1")
+            if not boxes and kind not in ("ftyp", "styp", "moov", "mdat", "free", "skip", "wide"):
+                return None
+            if size == 1:      # Размер в 64 битах следом за типом
+                if len(header) < 16:
+                    raise InvalidMediaError(f"Файл обрезан: неполный заголовок атома {kind}")
+                size = struct.unpack(">Q", header[8:16])[0]
+            elif size == 0:    # Атом до конца файла
+                size = file_size - offset
+            if size < 8:
+                raise InvalidMediaError(f"Повреждённый атом {kind!r} на {offset} байте")
+            if offset + size > file_size:
+                raise InvalidMediaError(
+                    f"Файл обрезан: атом {kind} объявлен на {size} байт, а в файле осталось {file_size - offset}"
+                )
+            boxes.append((kind, offset, size))
+            offset += size
+    return boxes
+
+
+def needs_faststart(boxes):
+    """Индекс (moov) после данных (mdat): плеер не начнёт воспроизведение до конца загрузки"""
+    kinds = [kind for kind, _, _ in boxes]
+    if "moov" not in kinds:
+        raise InvalidMediaError("В файле нет индекса (атом moov): загрузка, вероятно, оборвалась")
+    return "mdat" in kinds and kinds.index("mdat") < kinds.index("moov")
+
+
+def _codec_fits(codec, allowed, encoder):
+    if encoder is not None:
+        return codec == _ENCODER_CODECS.get(encoder)
+    return allowed is None or codec in allowed
+
+
+def plan_transcode(media, container, profile=None):
+    """Аргументы ffmpeg для приведения файла к контейнеру (и профилю).
+
+    Дорожка копируется, если её кодек подходит контейнеру и профилю и кадр не
+    выше предельного; иначе перекодируется. Возвращает (аргументы, "copy" или "encode").
+    """
+    video_codecs, audio_codecs = CONTAINER_CODECS[container]
+    default_video, default_audio = _DEFAULT_ENCODERS[container]
+    video, audio = media["video"], media["audio"]
+    args = []
+    encoded = False
+
+    if video is not None and container not in AUDIO_CONTAINERS:
+        max_height = profile.max_height if profile else None
+        encoder = profile.video_encoder if profile else None
+        too_tall = bool(max_height and (video.get("height") or 0) > max_height)
+        if not too_tall and _codec_fits(video.get("codec_name"), video_codecs, encoder):
+            args += ["-map", "0:V:0", "-c:v", "copy"]
+        else:
+            encoder = encoder or default_video
+            args += ["-map", "0:V:0", "-c:v", encoder, *_VIDEO_ENCODER_ARGS.get(encoder, [])]
+            if too_tall:
+                args += ["-vf", f"scale=-2:{max_height}"]
+            encoded = True
+
+    if audio is not None:
+        encoder = profile.audio_encoder if profile else None
+        if _codec_fits(audio.get("codec_name"), audio_codecs, encoder):
+            args += ["-map", "0:a:0", "-c:a", "copy"]
+        else:
+            bitrate = profile.audio_bitrate if profile else "128k"
+            args += ["-map", "0:a:0", "-c:a", encoder or default_audio, "-b:a", bitrate]
+            encoded = True
+
+    if not args:
+        raise TranscodeError(f"В файле нет дорожек для {container}")
+    if container in ("mp4", "m4a"):
+        args += ["-movflags", "+faststart"]   # Индекс в начале: воспроизведение до полной загрузки
+    return args, "encode" if encoded else "copy"
+
+
+class TranscodePool:
+    """Пул процессов ffmpeg, отдельный от пула загрузок.
+
+    Одновременно работает не больше workers процессов; каждому дано не больше
+    threads потоков и пониженный приоритет (nice), чтобы перекодирование не
+    отнимало процессор у загрузок и приёма запросов.
+    """
+
+    def __init__(self, workers, threads, niceness):
+        self.workers = max(1, workers)
+        self.threads = threads
+        self.niceness = niceness
+        self._slots = asyncio.Semaphore(self.workers)
+        self.active = 0
+        self.waiting = 0
+        self.copied = 0
+        self.encoded = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    async def run(self, src, dst, args, mode, duration=None, on_progress=None):
+        """Запускает ffmpeg src -> dst с аргументами из plan_transcode.
+
+        on_progress(процент) вызывается по мере обработки, если известна длительность.
+        """
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        started = time.monotonic()
+        try:
+            await self._ffmpeg(src, dst, args, duration, on_progress)
+        except BaseException:
+            self.failed += 1
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+            raise
+        else:
+            if mode == "copy":
+                self.copied += 1
+            else:
+                self.encoded += 1
+        finally:
+            self.active -= 1
+            self.busy_seconds += time.monotonic() - started
+            self._slots.release()
+
+    async def _ffmpeg(self, src, dst, args, duration, on_progress):
+        cmd = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-nostats", "-progress", "pipe:1",   # Прогресс строками key=value в stdout
+            "-i", str(src),
+            *args,
+            "-threads", str(self.threads),
+            str(dst),
+        ]
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=self._lower_priority if self.niceness and hasattr(os, "nice") else None,
+        )
+        try:
+            async for line in process.stdout:
+                key, _, value = line.decode("ascii", errors="ignore").strip().partition("=")
+                if key == "out_time_us" and duration and on_progress is not None and value.isdigit():
+                    on_progress(min(int(value) / 1e6 / duration * 100, 100))
+            stderr = await process.stderr.read()
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if returncode != 0:
+            raise TranscodeError(f"ffmpeg: {stderr.decode('utf-8', errors='ignore').strip()[:300]}")
+
+    def _lower_priority(self):
+        # Выполняется в дочернем процессе перед запуском ffmpeg
+        os.nice(self.niceness)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "threads": self.threads,
+            "active": self.active,
+            "waiting": self.waiting,
+            "copied": self.copied,
+            "encoded": self.encoded,
+            "failed": self.failed,
+            "busy_seconds": round(self.busy_seconds, 3),
+        }